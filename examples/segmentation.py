@@ -111,40 +111,28 @@ if __name__ == "__main__":
     head, ext = os.path.splitext(args.xs_file)
     tail = os.path.basename(head)
 
+    #Each step below is chained in memory, up to the LSMS smoothing which
+    #reads the prepared image directly
+
     #--------------------------
     # -------fusion -----------
     #--------------------------
 
-    #set of the instances and the parameters
     spot_pan = Raster(args.pan_file)
-    output_fusion = os.path.join(args.dir, tail + '_fusion.tif')
-
-    #Execution of the method
-    fus_img = spot_xs.fusion(spot_pan,output_fusion)
-    print "Fusion step has been realized succesfully\n"
+    fus_img = spot_xs.fusion(spot_pan, lazy=True)
 
     #--------------------------
     #------------ndvi----------
     #--------------------------
 
-    #set of the parameters
-    output_ndvi = os.path.join(args.dir, tail + '_ndvi.tif')
-
-    #Execution of the method
-    ndvi_img = fus_img.ndvi(args.idx_red, args.idx_nir, output_ndvi)
-    print "Writting the ndvi image has been realized succesfully\n"
+    ndvi_img = fus_img.ndvi(args.idx_red, args.idx_nir)
 
     #---------------------------
     #---extraction (optional)---
     #---------------------------
 
     if args.estep:
-        #set of the parameter
-        output_rmv = os.path.join(args.dir, tail + '_extracted.tif')
-
-        #Execution of the method
-        rmv_img = fus_img.remove_band(args.idx, output_rmv)
-        print "Extraction step has been realized succesfully\n"
+        rmv_img = fus_img.remove_bands(*args.idx)
     else:
         rmv_img = fus_img
 
@@ -152,28 +140,16 @@ if __name__ == "__main__":
     #--Concatenate the rmv_img and the ndvi_img--
     #--------------------------------------------
 
-    #set of the parameters
-    list_im = [ndvi_img]
-    output_concat = os.path.join(args.dir, tail + '_concatenated.tif')
-
-    #execution of the method
-    concat_img = rmv_img.concatenate( list_im, output_concat)
-    print "Concatenation step has been realized succesfully\n"
+    concat_img = concatenate_rasters(rmv_img, ndvi_img, lazy=True)
 
     #--------------------------------------------
     #-----------Apply a mask (optional)----------
     #--------------------------------------------
 
     if args.mask:
-        #Set of the instances and the output parameter
         mask_img = Raster(args.mask)
-        output_masked = os.path.join(args.dir, tail + '_masked.tif')
-
-        #Execution of the method
-        masked_img = concat_img.apply_mask( mask_img, args.in_mask_value,
-                                           output_masked,
-                                           out_mask_value = args.out_mask_value)
-        print "The mask has been applied succesfully\n"
+        masked_img = concat_img.apply_mask(mask_img, args.in_mask_value,
+                                           args.out_mask_value)
     else:
         masked_img = concat_img
 
@@ -181,49 +157,19 @@ if __name__ == "__main__":
     #-----------LSMS-----------
     #--------------------------
 
-    #first step : smoothing
-    out_smoothed_filename = os.path.join(args.dir, tail + "_spr_" + \
-                            str(args.spatialr) + "_rg_" + str(args.ranger) + \
-                            "_max_" + str(args.maxiter) + "_rga_" + \
-                            str(args.rangeramp) + "_th_" + str(args.thres)\
-                            + "_filtered.tif")
-    out_spatial_filename = os.path.join(args.dir, tail + '_spatial.tif')
-    smooth_img,pos_img = masked_img.lsms_smoothing(out_smoothed_filename,
-                                           args.spatialr, args.ranger,
-                                           out_spatial_filename, thres =
-                                           args.thres, rangeramp =
-                                           args.rangeramp, maxiter =
-                                           args.maxiter, modesearch =
-                                           args.modesearch)
-    print "smoothing step has been realized succesfully\n"
-
-    #second step : segmentation
-    if not(args.mstep or args.vstep): #If this is the final outup or not
-        output_seg = os.path.join(args.dir, args.out_file)
-    else:
-        output_seg = os.path.join(args.dir, tail + '_lsms_seg.tif')
-    seg_img = smooth_img.lsms_segmentation(pos_img, output_seg, args.spatialr,
-                                   args.ranger, tilesizex = args.tilesizex,
-                                   tilesizey = args.tilesizey)
-    print "segmentation step has been realized succesfully"
-
-    #third step (optional) : merging small regions
-    if args.mstep:
-        if not args.vstep : #If this is the final outup or not
-            output_merged = os.path.join(args.dir, args.out_file)
-        else:
-            output_merged = os.path.join(args.dir, tail + '_lsms_merged.tif')
-        merged_img = seg_img.lsms_merging(smooth_img, output_merged,
-                                          args.minsize, tilesizex = \
-                                          args.tilesizex,tilesizey = \
-                                          args.tilesizey)
-        print "merging step has been realized succesfully"
-    else:
-        merged_img = seg_img
-
-    #fourth step (optional) : vectorization
     if args.vstep:
+        output_seg = os.path.join(args.dir, tail + '_lsms_seg.tif')
         output_vector = os.path.join(args.dir, args.out_file)
-        merged_img.lsms_vectorization(concat_img, output_vector, tilesizex = \
-                                    args.tilesizex,tilesizey = args.tilesizey)
-        print "vectorization step has been realized succesfully"
+    else:
+        output_seg = os.path.join(args.dir, args.out_file)
+        output_vector = None
+    masked_img.lsms_segmentation(args.spatialr, args.ranger,
+                                 thres=args.thres,
+                                 rangeramp=args.rangeramp,
+                                 maxiter=args.maxiter,
+                                 object_minsize=args.minsize
+                                 if args.mstep else None,
+                                 block_size=(args.tilesizex, args.tilesizey),
+                                 out_filename=output_seg,
+                                 out_vector_filename=output_vector)
+    print "segmentation has been realized succesfully"
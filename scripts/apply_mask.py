@@ -1,7 +1,7 @@
 #!/usr/bin/env python2.7
 # -*- coding: utf-8 -*-
 
-from ymraster import Raster
+from ymraster import Raster, apply_mask
 
 import argparse
 
@@ -20,25 +20,25 @@ def command_line_arguments():
     parser.add_argument("-s", "--set_value",  type=int,
                         help='Value to set to the "masked" pixels in the '
                         "output file. Default is the max of the data type")
-    parser.add_argument("-o", "--out_file",
-                        help="Path to the output file. The original raster "
-                        "file is overwritten if omitted")
+    parser.add_argument("-o", "--out_file", nargs="+",
+                        help="Space separated list of paths to the output "
+                        "files, one per raster. The original raster files "
+                        "are overwritten if omitted")
     return parser.parse_args()
 
 
-def apply_mask(args):
+def apply_mask_to_rasters(args):
     mask_raster = Raster(args.mask)
-    for filename in args.raster:
-        raster = Raster(filename)
-        raster.apply_mask(mask_raster=mask_raster,
-                          mask_value=args.mask_value,
-                          set_value=args.set_value,
-                          out_filename=args.out_file)
+    rasters = [Raster(filename) for filename in args.raster]
+    apply_mask(mask_raster, *rasters,
+               mask_value=args.mask_value,
+               set_value=args.set_value,
+               out_filenames=args.out_file)
 
 
 def main():
     args = command_line_arguments()
-    apply_mask(args)
+    apply_mask_to_rasters(args)
 
 
 if __name__ == "__main__":
@@ -18,13 +18,17 @@ def command_line_arguments():
     parser.add_argument("-o", "--out_file",
                         help="Path of the output file. "
                         "The original raster file is overwritten if omitted")
+    parser.add_argument("-v", "--virtual", action="store_true",
+                        help="Write a VRT file referencing the kept bands "
+                        "instead of copying them (requires --out_file)")
     return parser.parse_args()
 
 
 def remove_bands(args):
     for filename in args.raster:
         raster = Raster(filename)
-        raster.remove_bands(*args.idxs, out_filename=args.out_file)
+        raster.remove_bands(*args.idxs, out_filename=args.out_file,
+                            virtual=args.virtual)
 
 
 def main():
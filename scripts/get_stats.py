@@ -18,6 +18,8 @@ def command_line_arguments():
                         help="Space separated fist of statistics to compute")
     parser.add_argument("-l", "--label_file", required=True,
                         help="Path to the label image")
+    parser.add_argument("-w", "--workers", type=int, default=1,
+                        help="Number of processes to use (default: 1)")
     parser.add_argument("-o", "--out_file",
                         help="Path to the output file. "
                         "A default name is chosen if omitted")
@@ -28,7 +30,7 @@ def label_stats(args):
     raster = Raster(args.raster)
     label_raster = Raster(args.label_file)
     raster.label_stats(args.stats, label_raster=label_raster,
-                       out_filename=args.out_file)
+                       workers=args.workers, out_filename=args.out_file)
 
 
 def main():
@@ -32,16 +32,23 @@ def command_line_arguments():
                         "No vector file is produced if omitted")
     parser.add_argument("-bw", "--block_width", type=int,
                         help="Block width "
-                        '(default: image "natural" block width)')
+                        "(default: planned from the memory budget)")
     parser.add_argument("-bh", "--block_height", type=int,
                         help="Block height "
-                        '(default: image "natural" block height)')
+                        "(default: planned from the memory budget)")
+    parser.add_argument("-mem", "--memory_budget", type=int,
+                        help="Memory available for a tile, in MB "
+                        "(default: OTB available RAM)")
     parser.add_argument("-o", "--out_file",
                         help="Path to the output file. "
                         "A default file name is chosen if omitted")
     return parser.parse_args()
 
 
+def print_plan(plan):
+    print "LSMS tiling: {}".format(plan)
+
+
 def lsms_segmentation(args):
     raster = Raster(args.raster)
     block_size = (args.block_width, args.block_height) \
@@ -51,6 +58,8 @@ def lsms_segmentation(args):
                              args.rangeramp, args.maxiter,
                              object_minsize=args.minsize,
                              block_size=block_size,
+                             memory_budget=args.memory_budget,
+                             report=print_plan,
                              out_vector_filename=args.vector_file,
                              out_filename=args.out_file)
 
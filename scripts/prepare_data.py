@@ -82,44 +82,28 @@ if __name__ == "__main__":
             print "Warning : --idx shoud not be specified without --estep.\n"
     print args, "\n"
 
-    #Extraction of the input file name
-    head, ext = os.path.splitext(args.xs_file)
-    tail = os.path.basename(head)
+    #Each step below is chained in memory: only the final product is written
+    #on disk
 
     #--------------------------
     # -------fusion -----------
     #--------------------------
 
-    #set of the instances and the parameters
     spot_pan = Raster(args.pan_file)
-    output_fusion = os.path.join(args.dir, tail + '_fusion.tif')
-
-    #Execution of the method
-    fus_img = spot_xs.fusion(spot_pan,output_fusion)
-    print "Fusion step has been realized succesfully\n"
+    fus_img = spot_xs.fusion(spot_pan, lazy=True)
 
     #--------------------------
     #------------ndvi----------
     #--------------------------
 
-    #set of the parameters
-    output_ndvi = os.path.join(args.dir, tail + '_ndvi.tif')
-
-    #Execution of the method
-    ndvi_img = fus_img.ndvi(args.idx_red, args.idx_nir, output_ndvi)
-    print "Writting the ndvi image has been realized succesfully\n"
+    ndvi_img = fus_img.ndvi(args.idx_red, args.idx_nir)
 
     #---------------------------
     #---extraction (optional)---
     #---------------------------
 
     if args.estep:
-        #set of the parameter
-        output_rmv = os.path.join(args.dir, tail + '_extracted.tif')
-
-        #Execution of the method
-        rmv_img = fus_img.remove_band(args.idx, output_rmv)
-        print "Extraction step has been realized succesfully\n"
+        rmv_img = fus_img.remove_bands(*args.idx)
     else:
         rmv_img = fus_img
 
@@ -127,32 +111,22 @@ if __name__ == "__main__":
     #--Concatenate the rmv_img and the ndvi_img--
     #--------------------------------------------
 
-    #set of the parameters
-    list_im = [ndvi_img]
-    if args.mask:
-        output_concat = os.path.join(args.dir, tail + '_concatenated.tif')
-    else:
-        output_concat = os.path.join(args.dir, args.out_file)
-
-    #execution of the method
-    concat_img = rmv_img.concatenate( list_im, output_concat)
-    print "Concatenation step has been realized succesfully\n"
+    concat_img = concatenate_rasters(rmv_img, ndvi_img, lazy=True)
 
     #--------------------------------------------
     #-----------Apply a mask (optional)----------
     #--------------------------------------------
 
     if args.mask:
-        #Set of the instances and the output parameter
         mask_img = Raster(args.mask)
-        output_masked = os.path.join(args.dir, args.out_file)
-
-        #Execution of the method
-        masked_img = concat_img.apply_mask( mask_img, args.in_mask_value,
-                                           output_masked,
-                                           out_mask_value = args.out_mask_value)
-        print "The mask has been applied succesfully\n"
+        masked_img = concat_img.apply_mask(mask_img, args.in_mask_value,
+                                           args.out_mask_value)
     else:
         masked_img = concat_img
 
+    #--------------------------------------------
+    #-----------Write the final product----------
+    #--------------------------------------------
 
+    masked_img.write(os.path.join(args.dir, args.out_file))
+    print "The data has been prepared succesfully\n"
@@ -8,7 +8,6 @@ import argparse
 import os
 from ymraster import classification as cla
 from ymraster import Raster
-from sklearn.cross_validation import train_test_split
 import matplotlib.pyplot as plt
 
 def command_line_arguments():
@@ -16,9 +15,9 @@ def command_line_arguments():
     desc = "From a roi(ground truth), a labeled and a satistic raster, "+\
             "perform a decision tree classification, supply the main "+\
             "classification metrics, and display a confusion matrix. Before "+\
-            "the very classification, ground truth samples are randomly split"+\
-            " into a training dataset and a validation one. The proportion "+\
-            "between the two of them can be specified."
+            "the very classification, ground truth pixels are randomly drawn"+\
+            " per class and split into a training dataset and a validation "+\
+            "one. The proportion between the two of them can be specified."
     parser = argparse.ArgumentParser(description= desc)
     parser.add_argument("--roi_file", "-roi", help="Path of the roi raster.",
                         required = True)
@@ -37,6 +36,12 @@ def command_line_arguments():
                         "and 1.0 and represent the proportion of the dataset "+
                         "used for training the classifier. Default value "+
                         "is 0.75.", default = 0.75, type = float)
+    parser.add_argument("--n_per_class","-n", help = "Maximum number of "+
+                        "ground truth pixels drawn per class. Default value "+
+                        "is 1000.", default = 1000, type = int)
+    parser.add_argument("--seed", help = "Seed of the random generator, to "+
+                        "get reproducible samples. Default value is None.",
+                        default = None, type = int)
     parser.add_argument("-out", "--out_file", help ="Name of the output file",
                         required = True, type = str)
     parser.add_argument("-d","--dir", default = "", help = "Path of the " +
@@ -45,24 +50,21 @@ def command_line_arguments():
 
 def stat_to_classification(args):
     
-    #Get the sample-feature matrix from the roi 
-    X, Y = cla.get_samples_from_roi(args.label_file,args.roi_file,
-                                    args.stat_file)
-    
     #Get the sample-feature matrix from the labeled raster                                                 
-    X_label, reverse = cla.get_samples_from_label_img(args.label_file,
-                                                      args.stat_file )
+    X_label, labels = cla.get_samples_from_label_img(args.label_file,
+                                                     args.stat_file )
     
-    #Split the roi into two dataset 
-    X_train, X_test, Y_train, Y_test = train_test_split(X, Y,train_size =\
-                                                        args.train_size)
+    #Draw pixels of the roi and split them into two dataset
+    X_train, X_test, Y_train, Y_test = cla.sample_training_pixels(
+        Raster(args.roi_file), Raster(args.stat_file), args.n_per_class,
+        train_size = args.train_size, seed = args.seed)
     #set some parameters
-    stat = Raster(args.stat_file)
+    label = Raster(args.label_file)
     out_filename = os.path.join(args.dir,args.out_file)
     
     #Initialize the classifier, train it and perform it
-    Y_predict = cla.decision_tree(X_train, Y_train, X_test, X_label, reverse, 
-                                  stat,out_filename, ext = args.format)
+    Y_predict, _ = cla.decision_tree(X_train, Y_train, X_test, X_label, labels,
+                                     label,out_filename, ext = args.format)
     
     #Compute the classification metrics and the confusion matrix
     cm, report, accuracy = cla.pred_error_metrics(Y_predict, Y_test,
@@ -4,7 +4,9 @@ import unittest
 import doctest
 import tempfile
 
-from ymraster import write_file, concatenate_rasters, Raster, RasterDataType
+from ymraster import write_file, concatenate_rasters, relabel, Raster, \
+    RasterDataType, FeatureCache, StageCache, Workspace, config, \
+    plan_lsms_tiles, lsms_sweep, classification
 from osgeo import ogr, osr
 import numpy as np
 
@@ -332,6 +334,537 @@ class TestRaster(unittest.TestCase):
                      date_time=dt.strftime('%Y:%m:%d %H:%M:%S'))
         self.assertEqual(raster.meta['date_time'], dt)
 
+    def test_raster_should_extract_bands(self):
+        raster = Raster('data/l8_20130714.tif')
+        for virtual, suffix in ((False, '.tif'), (True, '.vrt')):
+            out_file = tempfile.NamedTemporaryFile(suffix=suffix)
+            result = raster.extract_bands(5, 2, out_filename=out_file.name,
+                                          virtual=virtual)
+            self.assertEqual(result.count, 2)
+            self.assertEqual(result.dtype.lstr_dtype, 'int16')
+            self.assertEqual(result.date_time, raster.date_time)
+            self.assertTrue(result.srs.IsSame(raster.srs))
+            np.testing.assert_array_equal(
+                result.array_from_bands(mask_nodata=False),
+                raster.array_from_bands(5, 2, mask_nodata=False))
+
+    def test_raster_should_apply_mask_to_all_bands(self):
+        raster = Raster('data/l8_20130714.tif')
+        mask_file = tempfile.NamedTemporaryFile(suffix='.tif')
+        mask = np.zeros((raster.height, raster.width), dtype=np.uint8)
+        mask[:, :10] = 1
+        write_file(mask_file.name, array=mask, srs=raster.srs,
+                   transform=raster.transform)
+        out_file = tempfile.NamedTemporaryFile(suffix='.tif')
+        result = raster.apply_mask(Raster(mask_file.name), set_value=-1,
+                                   out_filename=out_file.name)
+        self.assertEqual(result.nodata_value, -1)
+        array = result.array_from_bands(mask_nodata=False)
+        self.assertTrue((array[:, :10, :] == -1).all())
+        np.testing.assert_array_equal(
+            array[:, 10:, :],
+            raster.array_from_bands(mask_nodata=False)[:, 10:, :])
+
+    def test_raster_should_compute_indices_in_one_pass(self):
+        raster = Raster('data/l8_20130714.tif')
+        out_file = tempfile.NamedTemporaryFile(suffix='.tif')
+        result = raster.compute_indices('ndvi', 'mndwi', 'savi',
+                                        green_idx=3, red_idx=4, nir_idx=5,
+                                        mir_idx=6, scale=0.0001,
+                                        out_filename=out_file.name)
+        self.assertEqual(result.count, 3)
+        self.assertEqual(result.dtype.lstr_dtype, 'float32')
+        self.assertEqual(result.date_time, raster.date_time)
+        bands = raster.array_from_bands(3, 4, 5, 6,
+                                        mask_nodata=False).astype(float)
+        green, red, nir, mir = np.rollaxis(bands * 0.0001, 2)
+        array = result.array_from_bands(mask_nodata=False)
+        np.testing.assert_allclose(array[:, :, 0],
+                                   (nir - red) / (nir + red), rtol=1e-5)
+        np.testing.assert_allclose(array[:, :, 1],
+                                   (green - mir) / (green + mir), rtol=1e-5)
+        np.testing.assert_allclose(array[:, :, 2],
+                                   1.5 * (nir - red) / (nir + red + 0.5),
+                                   rtol=1e-5)
+
+    def test_compute_indices_should_set_nodata_pixels_to_nan(self):
+        in_file = tempfile.NamedTemporaryFile(suffix='.tif')
+        array = np.ones((10, 10, 2), dtype=np.uint16)
+        array[0, 0, 1] = 0
+        write_file(in_file.name, array=array)
+        raster = Raster(in_file.name)
+        raster.nodata_value = 0
+        out_file = tempfile.NamedTemporaryFile(suffix='.tif')
+        result = raster.compute_indices('ndvi', red_idx=1, nir_idx=2,
+                                        out_filename=out_file.name)
+        self.assertTrue(np.isnan(result.nodata_value))
+        index = result.array_from_bands(1)
+        self.assertTrue(index.mask[0, 0])
+        self.assertEqual(index.mask.sum(), 1)
+
+
+class TestStatistics(unittest.TestCase):
+
+    def setUp(self):
+        self.raster = Raster('data/l8_20130714.tif')
+        self.label_file = tempfile.NamedTemporaryFile(suffix='.tif')
+        rows, cols = np.indices((self.raster.height, self.raster.width))
+        write_file(self.label_file.name,
+                   array=((rows // 8) * 10 + cols // 11).astype(np.uint32))
+        self.label_raster = Raster(self.label_file.name)
+
+    def test_label_stats_should_give_each_pixel_its_label_stat(self):
+        out_file = tempfile.NamedTemporaryFile(suffix='.tif')
+        self.raster.label_stats(stats=['mean', 'per:20'],
+                                label_raster=self.label_raster,
+                                out_filename=out_file.name)
+        result = Raster(out_file.name)
+        self.assertEqual(result.count, 2 * self.raster.count)
+        band = self.raster.array_from_bands(3, mask_nodata=False)
+        stat = result.array_from_bands(5, mask_nodata=False)
+        self.assertAlmostEqual(stat[0, 0], band[:8, :11].mean())
+        stat = result.array_from_bands(6, mask_nodata=False)
+        self.assertAlmostEqual(stat[9, 12], np.percentile(band[8:16, 11:22],
+                                                          20))
+
+    def test_label_stats_should_not_depend_on_workers(self):
+        serial_file = tempfile.NamedTemporaryFile(suffix='.tif')
+        parallel_file = tempfile.NamedTemporaryFile(suffix='.tif')
+        for workers, out_file in ((1, serial_file), (16, parallel_file)):
+            self.raster.label_stats(stats=['mean', 'std', 'min', 'max'],
+                                    label_raster=self.label_raster,
+                                    workers=workers,
+                                    out_filename=out_file.name)
+        np.testing.assert_allclose(
+            Raster(serial_file.name).array_from_bands(mask_nodata=False),
+            Raster(parallel_file.name).array_from_bands(mask_nodata=False))
+
+    def test_zonal_stats_should_compute_stats_inside_polygons(self):
+        tmpdir = tempfile.mkdtemp()
+        vector_filename = os.path.join(tmpdir, 'zones.shp')
+        ds = ogr.GetDriverByName('ESRI Shapefile').CreateDataSource(
+            vector_filename)
+        layer = ds.CreateLayer('zones', srs=self.raster.srs,
+                               geom_type=ogr.wkbPolygon)
+        layer.CreateField(ogr.FieldDefn('name', ogr.OFTString))
+        x0, xres, _, y0, _, yres = self.raster.transform
+        ring = ogr.Geometry(ogr.wkbLinearRing)
+        for col, row in ((0, 0), (11, 0), (11, 8), (0, 8), (0, 0)):
+            ring.AddPoint(x0 + col * xres, y0 + row * yres)
+        polygon = ogr.Geometry(ogr.wkbPolygon)
+        polygon.AddGeometry(ring)
+        feature = ogr.Feature(layer.GetLayerDefn())
+        feature.SetGeometry(polygon)
+        feature.SetField('name', 'corner')
+        layer.CreateFeature(feature)
+        ds = None
+
+        result = self.raster.zonal_stats(vector_filename,
+                                         stats=['mean', 'median'],
+                                         attribute='name')
+        band = self.raster.array_from_bands(2, mask_nodata=False)
+        self.assertAlmostEqual(result['corner']['mean'][1],
+                               band[:8, :11].mean())
+        self.assertAlmostEqual(result['corner']['median'][1],
+                               np.median(band[:8, :11]))
+        shutil.rmtree(tmpdir)
+
+    def test_aggregate_should_reduce_cells(self):
+        out_file = tempfile.NamedTemporaryFile(suffix='.tif')
+        result = self.raster.aggregate(4, stats=['mean', 'count'],
+                                       out_filename=out_file.name)
+        self.assertEqual(result.width, 17)
+        self.assertEqual(result.height, 14)
+        self.assertEqual(result.count, 2 * self.raster.count)
+        self.assertAlmostEqual(result.transform[1],
+                               4 * self.raster.transform[1])
+        band = self.raster.array_from_bands(1, mask_nodata=False)
+        array = result.array_from_bands(mask_nodata=False)
+        self.assertAlmostEqual(array[1, 2, 0], band[4:8, 8:12].mean())
+        self.assertEqual(array[0, 16, 1], 8)
+
+    def test_band_stats_should_compute_exact_stats_and_histogram(self):
+        tmp_file = tempfile.NamedTemporaryFile(suffix='.tif')
+        shutil.copyfile(self.raster.filename, tmp_file.name)
+        raster = Raster(tmp_file.name)
+        band = raster.array_from_bands(2, mask_nodata=False)
+        for _ in range(2):  # Second time, results come from the cache
+            stats = raster.band_stats(2, histogram_bins=10)[0]
+            self.assertEqual(stats['min'], band.min())
+            self.assertEqual(stats['max'], band.max())
+            self.assertAlmostEqual(stats['mean'], band.mean())
+            self.assertAlmostEqual(stats['std'], band.std())
+            self.assertEqual(stats['count'], band.size)
+            self.assertEqual(stats['histogram'][0].sum(), band.size)
+        os.remove(tmp_file.name + '.aux.xml')
+
+    def test_band_stats_should_handle_band_without_valid_value(self):
+        tmp_file = tempfile.NamedTemporaryFile(suffix='.tif')
+        write_file(tmp_file.name, array=np.zeros((10, 10), dtype=np.uint8))
+        raster = Raster(tmp_file.name)
+        raster.nodata_value = 0
+        stats = raster.band_stats(histogram_bins=10, use_cache=False)[0]
+        self.assertEqual(stats['count'], 0)
+        self.assertTrue(np.isnan(stats['min']))
+        self.assertEqual(stats['histogram'][0].sum(), 0)
+        self.assertTrue(np.isnan(stats['histogram'][1]).all())
+
+    def test_band_stats_should_compute_approx_stats(self):
+        stats = self.raster.band_stats(1, 3, approx=True, use_cache=False)
+        self.assertEqual(len(stats), 2)
+        band = self.raster.array_from_bands(3, mask_nodata=False)
+        self.assertTrue(stats[1]['approx'])
+        self.assertGreaterEqual(stats[1]['min'], band.min())
+        self.assertLessEqual(stats[1]['max'], band.max())
+
+    def test_rescale_bands_should_use_band_min_and_max(self):
+        out_file = tempfile.NamedTemporaryFile(suffix='.tif')
+        result = self.raster.rescale_bands(0, 1, 2,
+                                           out_filename=out_file.name)
+        band = result.array_from_bands(2, mask_nodata=False)
+        self.assertAlmostEqual(band.min(), 0)
+        self.assertAlmostEqual(band.max(), 1)
+        self.assertFalse(os.path.exists(self.raster.filename + '.aux.xml'))
+
+    def test_relabel_should_write_dense_ids(self):
+        out_file = tempfile.NamedTemporaryFile(suffix='.tif')
+        result = relabel(self.label_raster, out_file.name)
+        array = result.array_from_bands(mask_nodata=False)
+        self.assertEqual(result.dtype.lstr_dtype, 'uint32')
+        self.assertEqual(result.dense_label_count(), 42)
+        np.testing.assert_array_equal(np.unique(array), np.arange(42))
+        self.assertEqual(array[9, 12], 7)
+        table_filename = '{}_labels.csv'.format(
+            os.path.splitext(out_file.name)[0])
+        with open(table_filename) as table_file:
+            lines = table_file.read().splitlines()
+        self.assertEqual(lines[8], '7,11')
+        os.remove(table_filename)
+
+    def test_pca_should_give_uncorrelated_components(self):
+        out_file = tempfile.NamedTemporaryFile(suffix='.tif')
+        result, components, mean = self.raster.pca(
+            3, out_filename=out_file.name, workers=2)
+        self.assertEqual(result.count, 3)
+        np.testing.assert_allclose(np.dot(components, components.T),
+                                   np.eye(3), atol=1e-10)
+        pixels = result.array_from_bands(
+            mask_nodata=False).reshape((-1, 3))
+        covariance = np.cov(pixels.T)
+        np.testing.assert_allclose(covariance - np.diag(np.diag(covariance)),
+                                   0, atol=1e-6 * covariance[0, 0])
+        self.assertTrue(covariance[0, 0] >= covariance[1, 1]
+                        >= covariance[2, 2])
+
+    def test_linear_transform_should_combine_bands(self):
+        out_file = tempfile.NamedTemporaryFile(suffix='.tif')
+        matrix = np.zeros((1, self.raster.count))
+        matrix[0, 0], matrix[0, 1] = 2, -1
+        result = self.raster.linear_transform(matrix, offset=[3],
+                                              out_filename=out_file.name)
+        bands = self.raster.array_from_bands(1, 2, mask_nodata=False)
+        np.testing.assert_allclose(
+            result.array_from_bands(mask_nodata=False),
+            2. * bands[:, :, 0] - bands[:, :, 1] + 3)
+
+    def test_linear_transform_and_pca_should_mask_nodata_pixels(self):
+        in_file = tempfile.NamedTemporaryFile(suffix='.tif')
+        array = np.random.RandomState(0).randint(
+            1, 100, (10, 10, 2)).astype(np.uint16)
+        array[0, 0, 1] = 0
+        write_file(in_file.name, array=array)
+        raster = Raster(in_file.name)
+        raster.nodata_value = 0
+        out_files = [tempfile.NamedTemporaryFile(suffix='.tif')
+                     for _ in range(2)]
+        for result in (raster.linear_transform(
+                           [[1, 1]], out_filename=out_files[0].name),
+                       raster.pca(out_filename=out_files[1].name)[0]):
+            self.assertTrue(np.isnan(result.nodata_value))
+            transformed = result.array_from_bands(1)
+            self.assertTrue(transformed.mask[0, 0])
+            self.assertEqual(transformed.mask.sum(), 1)
+
+
+class TestClassification(unittest.TestCase):
+
+    def test_predict_pixels_should_keep_label_dtype(self):
+        X = np.arange(20, dtype=np.float64).reshape((10, 2))
+        for labels in (np.array(['water'] * 5 + ['forest'] * 5),
+                       np.repeat(np.array([3, 7], dtype=np.uint8), 5)):
+            estimator = classification.tree.DecisionTreeClassifier()
+            estimator.fit(X, labels)
+            classes, probas = classification._predict_pixels(
+                estimator, X, batch_size=3, proba=True)
+            self.assertEqual(classes.dtype, labels.dtype)
+            np.testing.assert_array_equal(classes, labels)
+            self.assertEqual(probas.shape, (10, 2))
+
+    def test_get_samples_from_roi_should_take_first_pixel_per_label(self):
+        stat = Raster('data/l8_20130714.tif')
+        rows, cols = np.indices((stat.height, stat.width))
+        label = ((rows // 8) * 10 + cols // 11).astype(np.uint32)
+        roi = ((rows + cols) % 3 == 0) * (1 + label % 2).astype(np.uint8)
+        label_file = tempfile.NamedTemporaryFile(suffix='.tif')
+        roi_file = tempfile.NamedTemporaryFile(suffix='.tif')
+        write_file(label_file.name, array=label)
+        write_file(roi_file.name, array=roi)
+        X, Y = classification.get_samples_from_roi(
+            label_file.name, roi_file.name, stat.filename)
+
+        #Expected samples, computed in memory
+        in_roi = np.flatnonzero(roi)
+        _, first = np.unique(label.ravel()[in_roi], return_index=True)
+        positions = in_roi[first]
+        features = stat.array_from_bands(mask_nodata=False).reshape(
+            (-1, stat.count))
+        np.testing.assert_array_equal(X, features[positions])
+        np.testing.assert_array_equal(Y, roi.ravel()[positions].reshape(
+            (-1, 1)))
+
+    def test_write_label_classification_should_map_labels_to_classes(self):
+        raster = Raster('data/l8_20130714.tif')
+        rows, cols = np.indices((raster.height, raster.width))
+        sparse = ((rows // 8) * 10 + cols // 11).astype(np.uint32)
+        dense = np.unique(sparse, return_inverse=True)[1].reshape(
+            sparse.shape).astype(np.uint32)
+        for label in (sparse, dense):
+            label_file = tempfile.NamedTemporaryFile(suffix='.tif')
+            write_file(label_file.name, array=label)
+            labels = np.unique(label)
+            classes = 1 + labels % 3
+            out_file = tempfile.NamedTemporaryFile(suffix='.tif')
+            result = classification.write_label_classification(
+                Raster(label_file.name), labels, classes, out_file.name)
+            np.testing.assert_array_equal(
+                result.array_from_bands(1, mask_nodata=False),
+                classes[np.searchsorted(labels, label)])
+
+            #Unknown labels are set to 0
+            result = classification.write_label_classification(
+                Raster(label_file.name), labels[:-1], classes[:-1],
+                out_file.name)
+            self.assertTrue((result.array_from_bands(
+                1, mask_nodata=False)[label == labels[-1]] == 0).all())
+
+    def test_apply_model_should_use_the_saved_model(self):
+        array = Raster('data/l8_20130714.tif').array_from_bands(
+            mask_nodata=False)
+        in_file = tempfile.NamedTemporaryFile(suffix='.tif')
+        write_file(in_file.name, array=array)
+        raster = Raster(in_file.name)
+        pixels = array.reshape((-1, raster.count)).astype(np.float64)
+        Y = 1 + (pixels[:, 0] > np.median(pixels[:, 0]))
+        model = classification.train_model(pixels[::7], Y[::7],
+                                           stats=['mean'])
+        model_file = tempfile.NamedTemporaryFile(suffix='.pkl')
+        model.save(model_file.name)
+        loaded = classification.Model.load(model_file.name)
+        self.assertEqual(loaded.stats, ['mean'])
+        np.testing.assert_array_equal(loaded.classes_, [1, 2])
+
+        out_file = tempfile.NamedTemporaryFile(suffix='.tif')
+        result, = classification.apply_model(model_file.name, [raster],
+                                             [out_file.name])
+        np.testing.assert_array_equal(
+            result.array_from_bands(1, mask_nodata=False),
+            model.estimator.predict(pixels).reshape(array.shape[:2]))
+
+    def test_object_classification_should_accept_any_estimator(self):
+        raster = Raster('data/l8_20130714.tif')
+        rows, cols = np.indices((raster.height, raster.width))
+        label = ((rows // 8) * 10 + cols // 11).astype(np.uint32)
+        label_file = tempfile.NamedTemporaryFile(suffix='.tif')
+        write_file(label_file.name, array=label)
+        labels = np.unique(label)
+        X_img = np.random.RandomState(0).random_sample((len(labels), 3))
+        Y = 1 + (X_img[:, 0] > 0.5)
+        estimator = classification.make_estimator('k_neighbors', n_jobs=2,
+                                                  n_neighbors=1)
+        self.assertEqual(estimator.get_params()['n_jobs'], 2)
+        out_file = tempfile.NamedTemporaryFile(suffix='.tif')
+        proba_file = tempfile.NamedTemporaryFile(suffix='.tif')
+        y_predict, estimator = classification.object_classification(
+            X_img, Y, X_img, labels, Raster(label_file.name), out_file.name,
+            estimator=estimator, X_test=X_img[:5], chunk_size=7,
+            proba_filename=proba_file.name)
+        self.assertIsInstance(estimator,
+                              classification.neighbors.KNeighborsClassifier)
+        np.testing.assert_array_equal(y_predict, Y[:5])
+        np.testing.assert_array_equal(
+            Raster(out_file.name).array_from_bands(1, mask_nodata=False),
+            Y[np.searchsorted(labels, label)])
+        self.assertEqual(Raster(proba_file.name).count, 3)
+
+    def test_classify_raster_should_refuse_non_positive_classes(self):
+        raster = Raster('data/l8_20130714.tif')
+        X = np.arange(10.0 * raster.count).reshape((10, raster.count))
+        out_file = tempfile.NamedTemporaryFile(suffix='.tif')
+        for labels in (np.repeat([0, 1], 5),
+                       np.array(['water'] * 5 + ['forest'] * 5)):
+            estimator = classification.tree.DecisionTreeClassifier()
+            estimator.fit(X, labels)
+            self.assertRaises(ValueError, classification.classify_raster,
+                              raster, estimator, out_file.name)
+            self.assertRaises(ValueError,
+                              classification.write_label_classification,
+                              raster, np.arange(10), labels, out_file.name)
+
+    def test_assess_accuracy_should_match_confusion_matrix(self):
+        rows, cols = np.indices((20, 30))
+        reference = ((rows // 5 + cols // 7) % 4).astype(np.uint8)
+        predicted = ((rows // 4 + cols // 7) % 3 + 1).astype(np.uint8)
+        reference_file = tempfile.NamedTemporaryFile(suffix='.tif')
+        classified_file = tempfile.NamedTemporaryFile(suffix='.tif')
+        write_file(reference_file.name, array=reference)
+        write_file(classified_file.name, array=predicted)
+        result = classification.assess_accuracy(
+            Raster(classified_file.name), Raster(reference_file.name),
+            block_size=(8, 8))
+        valid = reference != 0
+        np.testing.assert_array_equal(result['classes'], [1, 2, 3])
+        self.assertEqual(result['classes'].dtype, np.uint8)
+        np.testing.assert_array_equal(
+            result['confusion_matrix'],
+            classification.confusion_matrix(reference[valid],
+                                            predicted[valid]))
+        self.assertAlmostEqual(result['overall_accuracy'],
+                               (reference == predicted)[valid].mean())
+
+    def test_sample_training_pixels_should_be_stratified_and_seeded(self):
+        raster = Raster('data/l8_20130714.tif')
+        roi = np.zeros((raster.height, raster.width), dtype=np.uint8)
+        roi[10:, :] = 1
+        roi[0, :5] = 2
+        roi_file = tempfile.NamedTemporaryFile(suffix='.tif')
+        write_file(roi_file.name, array=roi)
+        samples = [classification.sample_training_pixels(
+            Raster(roi_file.name), raster, 20, train_size=0.75, seed=42)
+            for _ in range(2)]
+        X_train, X_test, Y_train, Y_test = samples[0]
+        self.assertEqual(X_train.shape, (15 + 4, raster.count))
+        self.assertEqual(X_test.shape, (5 + 1, raster.count))
+        np.testing.assert_array_equal(np.bincount(Y_train.ravel()),
+                                      [0, 15, 4])
+        np.testing.assert_array_equal(np.bincount(Y_test.ravel()),
+                                      [0, 5, 1])
+        for first, second in zip(*samples):
+            np.testing.assert_array_equal(first, second)
+
+    def test_kmeans_classify_should_give_k_clusters(self):
+        array = Raster('data/l8_20130714.tif').array_from_bands(
+            mask_nodata=False)
+        array[:5, :5, :] = 0
+        in_file = tempfile.NamedTemporaryFile(suffix='.tif')
+        write_file(in_file.name, array=array)
+        raster = Raster(in_file.name)
+        raster.nodata_value = 0
+        out_file = tempfile.NamedTemporaryFile(suffix='.tif')
+        result, centroids = classification.kmeans_classify(
+            raster, 3, out_file.name, sample_fraction=1.0, seed=0,
+            batch_size=100)
+        self.assertEqual(centroids.shape, (3, raster.count))
+        self.assertEqual(result.nodata_value, 0)
+        clusters = result.array_from_bands(1, mask_nodata=False)
+        nodata = (raster.array_from_bands(mask_nodata=False) == 0).any(axis=2)
+        self.assertTrue((clusters[nodata] == 0).all())
+        np.testing.assert_array_equal(np.unique(clusters[~nodata]),
+                                      [1, 2, 3])
+        os.remove('{}_centroids.csv'.format(os.path.splitext(
+            out_file.name)[0]))
+
+
+class TestFeatureCache(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.input_file = tempfile.NamedTemporaryFile(suffix='.tif')
+        shutil.copyfile('data/l8_20130714.tif', self.input_file.name)
+        self.calls = 0
+
+    def compute(self):
+        self.calls += 1
+        return np.arange(1000, dtype=np.float64), np.arange(3)
+
+    def test_cache_should_compute_only_once(self):
+        cache = FeatureCache(self.directory)
+        for _ in range(2):
+            X, labels = cache.fetch('compute', [self.input_file.name],
+                                    self.compute, param=1)
+        self.assertEqual(self.calls, 1)
+        np.testing.assert_array_equal(X, np.arange(1000))
+        cache.fetch('compute', [self.input_file.name], self.compute, param=2)
+        self.assertEqual(self.calls, 2)
+        cache.invalidate()
+        self.assertEqual(cache.keys(), [])
+
+    def test_cache_should_evict_least_recently_used_entries(self):
+        cache = FeatureCache(self.directory, max_bytes=10000)
+        for param in range(3):
+            cache.fetch('compute', [self.input_file.name], self.compute,
+                        param=param)
+        self.assertEqual(len(cache.keys()), 1)
+        self.assertLessEqual(cache.size(), 10000)
+
+    def test_stage_cache_should_keep_only_completed_stages(self):
+        cache = StageCache(self.directory)
+
+        def fail(directory):
+            open(os.path.join(directory, 'out.txt'), 'w').close()
+            raise RuntimeError()
+
+        def run(directory):
+            self.calls += 1
+            open(os.path.join(directory, 'out.txt'), 'w').close()
+
+        self.assertRaises(RuntimeError, cache.fetch, 'stage',
+                          [self.input_file.name], fail, param=1)
+        self.assertEqual(cache.keys(), [])
+        for _ in range(2):
+            entry_dir = cache.fetch('stage', [self.input_file.name], run,
+                                    param=1)
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(os.listdir(entry_dir), ['out.txt'])
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+
+class TestWorkspace(unittest.TestCase):
+
+    def test_workspace_should_give_unique_paths_and_clean_up(self):
+        with Workspace() as workspace, Workspace() as other:
+            self.assertNotEqual(workspace.root, other.root)
+            first = workspace.path('concat.tif')
+            second = workspace.path('concat.tif')
+            self.assertNotEqual(first, second)
+            write_file(first, array=np.zeros((10, 10), dtype=np.uint8))
+            self.assertTrue(os.path.exists(first))
+        self.assertFalse(os.path.exists(workspace.root))
+
+    def test_workspace_should_check_size_of_subspaces(self):
+        with Workspace(backing='vsimem', max_bytes=1000) as workspace:
+            subspace = workspace.subspace(gdal_only=True)
+            write_file(subspace.path('big.tif'),
+                       array=np.zeros((100, 100), dtype=np.uint8))
+            self.assertGreater(workspace.size(), 1000)
+            self.assertRaises(IOError, subspace.check_size)
+
+
+class TestConfig(unittest.TestCase):
+
+    def test_resources_should_restore_previous_settings(self):
+        otb_ram = config.get('otb_ram')
+        threads = os.environ.get(config.ITK_THREADS_VAR)
+        with config.resources(otb_ram=128, threads=2):
+            self.assertEqual(config.get('otb_ram'), 128)
+            self.assertEqual(os.environ[config.ITK_THREADS_VAR], '2')
+            app = config.create_app('BandMath')
+            self.assertEqual(app.GetParameterInt('ram'), 128)
+        self.assertEqual(config.get('otb_ram'), otb_ram)
+        self.assertEqual(os.environ.get(config.ITK_THREADS_VAR), threads)
+        self.assertRaises(ValueError, config.configure, ram=128)
+
 
 class TestConcatenateImages(unittest.TestCase):
 
@@ -354,6 +887,22 @@ class TestConcatenateImages(unittest.TestCase):
                      dtype=rasters[0].meta['dtype'].ustr_dtype,
                      proj=rasters[0].meta['srs'].ExportToProj4())
 
+    def test_concatenate_should_stack_virtually_then_materialize(self):
+        rasters = [Raster(os.path.join(self.folder, filename))
+                   for filename in ('l8_20130425.tif', 'l8_20130714.tif')]
+        vrt_file = tempfile.NamedTemporaryFile(suffix='.vrt')
+        result = concatenate_rasters(*rasters, out_filename=vrt_file.name,
+                                     virtual=True)
+        self.assertEqual(result.count, 2 * rasters[0].count)
+        self.assertEqual(result.dtype.lstr_dtype, 'int16')
+        out_file = tempfile.NamedTemporaryFile(suffix='.tif')
+        materialized = result.materialize(out_file.name,
+                                          profile={'compress': 'LZW'})
+        self.assertEqual(materialized.dtype.lstr_dtype, 'int16')
+        np.testing.assert_array_equal(
+            materialized.array_from_bands(8, mask_nodata=False),
+            rasters[1].array_from_bands(1, mask_nodata=False))
+
     def test_concatenate_should_raise_assertion_error_if_not_same_extent(self):
         rasters = [Raster(os.path.join(self.folder, 'shade.tif')),
                    Raster(os.path.join(self.folder, 'shade_crop.tif'))]
@@ -426,6 +975,82 @@ class TestOtbFunctions(unittest.TestCase):
                      date_time=self.raster.meta['date_time'],
                      proj=self.raster.meta['srs'].ExportToProj4())
 
+    def test_should_chain_operations_in_memory(self):
+        out_file = tempfile.NamedTemporaryFile(suffix='.tif')
+        ndvi = self.raster.ndvi(red_idx=4, nir_idx=5, lazy=True)
+        removed = self.raster.remove_bands(6, lazy=True)
+        result = concatenate_rasters(removed, ndvi,
+                                     lazy=True).write(out_file.name)
+        self.assertEqual(result.count, self.raster.count)
+        self.assertEqual(result.date_time, self.raster.date_time)
+        np.testing.assert_allclose(
+            result.array_from_bands(6, mask_nodata=False),
+            self.raster.array_from_bands(7, mask_nodata=False))
+
+    def test_lsms_segmentation_should_reuse_cached_steps(self):
+        cache_dir = tempfile.mkdtemp()
+        try:
+            for object_minsize in (10, 20):
+                out_file = tempfile.NamedTemporaryFile(suffix='.tif')
+                self.raster.lsms_segmentation(
+                    spatialr=5, ranger=15, maxiter=5,
+                    object_minsize=object_minsize,
+                    cache_dir=cache_dir, out_filename=out_file.name)
+                self.assertEqual(Raster(out_file.name).count, 1)
+            # Smoothing and segmentation only, computed once
+            self.assertEqual(len(StageCache(cache_dir).keys()), 2)
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_lsms_sweep_should_run_each_combination(self):
+        out_dir = tempfile.mkdtemp()
+        try:
+            rows = lsms_sweep(self.raster,
+                              {'spatialr': [5], 'ranger': [10, 15],
+                               'maxiter': [5], 'object_minsize': [10, 20]},
+                              out_dir, workers=2,
+                              cache_dir=os.path.join(out_dir, 'cache'))
+            self.assertEqual(len(rows), 4)
+            self.assertEqual([(row['ranger'], row['object_minsize'])
+                              for row in rows],
+                             [(10, 10), (15, 10), (10, 20), (15, 20)])
+            for row in rows:
+                self.assertTrue(os.path.exists(row['out_filename']))
+                self.assertGreater(row['object_count'], 0)
+            self.assertTrue(
+                os.path.exists(os.path.join(out_dir, 'lsms_sweep.csv')))
+            self.assertTrue(os.listdir(os.path.join(out_dir, 'cache')))
+        finally:
+            shutil.rmtree(out_dir)
+
+    def test_lsms_segmentation_should_report_plan_before_running(self):
+        class Stop(Exception):
+            pass
+        plans = []
+
+        def report(plan):
+            plans.append(plan)
+            raise Stop()
+
+        out_file = tempfile.NamedTemporaryFile(suffix='.tif')
+        self.assertRaises(Stop, self.raster.lsms_segmentation,
+                          spatialr=5, ranger=15, memory_budget=1,
+                          report=report, out_filename=out_file.name)
+        self.assertEqual(plans, [plan_lsms_tiles(
+            self.raster, 5, 1, dtype=RasterDataType(lstr_dtype='float32'))])
+
+    def test_plan_lsms_tiles_should_fit_memory_budget(self):
+        plan = plan_lsms_tiles(self.raster, spatialr=5, memory_budget=1)
+        self.assertLessEqual(plan.peak_memory, 1)
+        self.assertLessEqual(plan.tilesizex, self.raster.width)
+        self.assertLessEqual(plan.tilesizey, self.raster.height)
+        self.assertEqual(
+            plan.tile_count,
+            int(np.ceil(float(self.raster.width) / plan.tilesizex)
+                * np.ceil(float(self.raster.height) / plan.tilesizey)))
+        self.assertRaises(ValueError, plan_lsms_tiles, self.raster,
+                          spatialr=1000, memory_budget=1)
+
     def test_lsms_segmentation_should_compute_segmented_image(self):
         out_file = tempfile.NamedTemporaryFile(suffix='.tif')
         out_vector_filename = os.path.join(
@@ -2,7 +2,11 @@
 
 """ ymraster pacakge """
 
-from ymraster import write_file, concatenate_rasters, temporal_stats, Raster
+from ymraster import write_file, concatenate_rasters, apply_mask, \
+    temporal_stats, relabel, plan_lsms_tiles, lsms_sweep, Raster, OtbImage
 from raster_dtype import RasterDataType
+from cache import FeatureCache, StageCache
+from workspace import Workspace
+import config
 import classification
 
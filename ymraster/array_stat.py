@@ -14,6 +14,18 @@ _STATS = [
     'quartile1',
     'quartile3',
     'per',
+    'count',
+]
+
+# Stats which can be computed by merging partial results (see
+# `GroupAccumulator`)
+_MERGEABLE_STATS = [
+    'min',
+    'max',
+    'mean',
+    'std',
+    'range',
+    'count',
 ]
 
 _SUMMARY_STAT_FUNC = {}
@@ -27,6 +39,18 @@ _STAT_FUNC['mean'] = np.nanmean
 _STAT_FUNC['std'] = np.nanstd
 _STAT_FUNC['median'] = np.median
 _STAT_FUNC['range'] = np.ptp
+_STAT_FUNC['count'] = lambda a, axis=None: np.sum(~np.isnan(a), axis=axis)
+
+# Same functions, ignoring NaN values
+_NAN_STAT_FUNC = defaultdict(lambda: np.nanpercentile)
+_NAN_STAT_FUNC['min'] = np.nanmin
+_NAN_STAT_FUNC['max'] = np.nanmax
+_NAN_STAT_FUNC['mean'] = np.nanmean
+_NAN_STAT_FUNC['std'] = np.nanstd
+_NAN_STAT_FUNC['median'] = np.nanmedian
+_NAN_STAT_FUNC['range'] = \
+    lambda a, axis=None: np.nanmax(a, axis=axis) - np.nanmin(a, axis=axis)
+_NAN_STAT_FUNC['count'] = _STAT_FUNC['count']
 
 _COMMON_PERCENTILES = {
     'quartile1': 25,
@@ -35,17 +59,22 @@ _COMMON_PERCENTILES = {
 
 
 class ArrayStat(object):
-    """Represent a stat that is computable on a NumPy array"""
+    """Represent a stat that is computable on a NumPy array.
 
-    def __init__(self, s, axis=None):
+    If `skip_nan` is True, NaN values are ignored in the computation.
+    """
+
+    def __init__(self, s, axis=None, skip_nan=False):
         self.stat = s if ':' not in s else s.split(':')[0]
         if self.stat not in _STATS:
             raise ValueError("Not a recognized statistic: {}".format(s))
         self.percentage = None if ':' not in s else float(s.split(':')[1])
-        self.func = _STAT_FUNC[s]
+        self.func = _NAN_STAT_FUNC[s] if skip_nan else _STAT_FUNC[s]
         self.is_summary = s in _SUMMARY_STAT_FUNC
         self.summary_func = _SUMMARY_STAT_FUNC[s] if self.is_summary else None
-        if self.func is np.percentile and self.percentage is None:
+        self.is_mergeable = self.stat in _MERGEABLE_STATS
+        if self.func in (np.percentile, np.nanpercentile) \
+                and self.percentage is None:
             try:
                 self.percentage = _COMMON_PERCENTILES[s]
             except KeyError:
@@ -67,3 +96,247 @@ class ArrayStat(object):
             kw['axis'] = self.axis
 
         return self.summary_func(**kw)
+
+
+def _sorted_groups(labels, values):
+    """Returns labels and values sorted by label then by value, NaN values
+    being dropped, along with unique labels, start index and size of each
+    group"""
+    labels = np.ravel(labels)
+    values = np.ravel(values).astype(np.float64)
+    valid = ~np.isnan(values)
+    labels, values = labels[valid], values[valid]
+    order = np.lexsort((values, labels))
+    labels, values = labels[order], values[order]
+    unique_labels, starts = np.unique(labels, return_index=True)
+    sizes = np.diff(np.append(starts, len(labels)))
+    return values, unique_labels, starts, sizes
+
+
+def grouped_stats(labels, values, stats):
+    """Compute statistics on values grouped by label, without looping over
+    labels.
+
+    NaN values are ignored. Labels for which there is no valid value are
+    absent from the result.
+
+    Parameters
+    ----------
+    labels : numpy.ndarray
+        label of each value.
+    values : numpy.ndarray
+        values to compute statistics from, same size as `labels`.
+    stats : list of str
+        statistics to compute (eg. 'mean', 'per:20').
+
+    Returns
+    -------
+    tuple (numpy.ndarray, list of numpy.ndarray)
+        sorted unique labels and, for each statistic in order, an array giving
+        its value for each label.
+    """
+    values, unique_labels, starts, sizes = _sorted_groups(labels, values)
+    if len(unique_labels) == 0:
+        return unique_labels, [np.empty(0) for _ in stats]
+
+    means = np.add.reduceat(values, starts) / sizes
+    results = []
+    for statname in stats:
+        astat = ArrayStat(statname)
+        if astat.stat == 'count':
+            results.append(sizes.astype(np.float64))
+        elif astat.stat == 'min':
+            results.append(values[starts])
+        elif astat.stat == 'max':
+            results.append(values[starts + sizes - 1])
+        elif astat.stat == 'range':
+            results.append(values[starts + sizes - 1] - values[starts])
+        elif astat.stat == 'mean':
+            results.append(means)
+        elif astat.stat == 'std':
+            deviations = values - np.repeat(means, sizes)
+            results.append(
+                np.sqrt(np.add.reduceat(deviations ** 2, starts) / sizes))
+        else:
+            # Percentiles, with linear interpolation between closest ranks as
+            # done by np.percentile
+            percentage = 50 if astat.stat == 'median' else astat.percentage
+            position = percentage / 100. * (sizes - 1)
+            lower = np.floor(position).astype(np.int64)
+            upper = np.minimum(lower + 1, sizes - 1)
+            fraction = position - lower
+            results.append(values[starts + lower]
+                           + (values[starts + upper] - values[starts + lower])
+                           * fraction)
+    return unique_labels, results
+
+
+class GroupAccumulator(object):
+    """Accumulate count, mean, sum of squared deviations, min and max of values
+    grouped by label.
+
+    Accumulators computed on different parts of an image can be merged, which
+    allows to compute mergeable statistics (see `_MERGEABLE_STATS`) tile by
+    tile or process by process.
+    """
+
+    def __init__(self, labels=None, values=None):
+        self.labels = None
+        self.count = None
+        self.mean = None
+        self.m2 = None
+        self.min = None
+        self.max = None
+        if labels is not None:
+            self.update(labels, values)
+
+    def update(self, labels, values):
+        """Add the given values, grouped by the given labels"""
+        values, unique_labels, starts, sizes = _sorted_groups(labels, values)
+        other = GroupAccumulator()
+        other.labels = unique_labels
+        other.count = sizes.astype(np.float64)
+        if len(unique_labels):
+            other.mean = np.add.reduceat(values, starts) / sizes
+            deviations = values - np.repeat(other.mean, sizes)
+            other.m2 = np.add.reduceat(deviations ** 2, starts)
+            other.min = values[starts]
+            other.max = values[starts + sizes - 1]
+        else:
+            other.mean = other.m2 = other.min = other.max = np.empty(0)
+        self.merge(other)
+
+    def merge(self, other):
+        """Merge another accumulator into this one"""
+        if other.labels is None:
+            return
+        if self.labels is None:
+            for attr in ('labels', 'count', 'mean', 'm2', 'min', 'max'):
+                setattr(self, attr, getattr(other, attr).copy())
+            return
+
+        # Expand both accumulators onto the union of their labels
+        labels = np.union1d(self.labels, other.labels)
+        expanded = []
+        for acc in (self, other):
+            idx = np.searchsorted(labels, acc.labels)
+            count, mean, m2 = (np.zeros(len(labels)) for _ in range(3))
+            min_ = np.empty(len(labels))
+            min_.fill(np.inf)
+            max_ = np.empty(len(labels))
+            max_.fill(-np.inf)
+            count[idx], mean[idx], m2[idx] = acc.count, acc.mean, acc.m2
+            min_[idx], max_[idx] = acc.min, acc.max
+            expanded.append((count, mean, m2, min_, max_))
+        (count_a, mean_a, m2_a, min_a, max_a), \
+            (count_b, mean_b, m2_b, min_b, max_b) = expanded
+
+        # Pairwise update of mean and squared deviations (Chan et al.)
+        count = count_a + count_b
+        delta = mean_b - mean_a
+        with np.errstate(invalid='ignore', divide='ignore'):
+            self.mean = np.where(count > 0,
+                                 mean_a + delta * count_b / count,
+                                 0.)
+            self.m2 = np.where(count > 0,
+                               m2_a + m2_b + delta ** 2 * count_a * count_b
+                               / count,
+                               0.)
+        self.labels = labels
+        self.count = count
+        self.min = np.minimum(min_a, min_b)
+        self.max = np.maximum(max_a, max_b)
+
+    def result(self, statname):
+        """Returns the value of the given stat for each label, in the order of
+        `self.labels`"""
+        astat = ArrayStat(statname)
+        if not astat.is_mergeable:
+            raise ValueError(
+                "Statistic cannot be computed by merging: {}".format(statname))
+        if astat.stat == 'count':
+            return self.count
+        elif astat.stat == 'min':
+            return self.min
+        elif astat.stat == 'max':
+            return self.max
+        elif astat.stat == 'range':
+            return self.max - self.min
+        elif astat.stat == 'mean':
+            return self.mean
+        else:
+            return np.sqrt(self.m2 / self.count)
+
+
+class CovarianceAccumulator(object):
+    """Accumulate count, mean and sum of cross-products of deviations of
+    multivariate samples (eg. pixels as vectors of band values).
+
+    Like `GroupAccumulator`, accumulators computed on different parts of an
+    image can be merged, so that the covariance matrix of the bands can be
+    computed in one pass, block by block or process by process.
+    """
+
+    def __init__(self, values=None):
+        self.count = 0.
+        self.mean = None
+        self.comoment = None
+        if values is not None:
+            self.update(values)
+
+    def update(self, values):
+        """Add the given samples, a n*d array (n samples of d variables).
+        Samples with a NaN value are ignored."""
+        values = np.asarray(values, dtype=np.float64)
+        values = values[~np.isnan(values).any(axis=1)]
+        other = CovarianceAccumulator()
+        other.count = float(len(values))
+        if len(values):
+            other.mean = values.mean(axis=0)
+            deviations = values - other.mean
+            other.comoment = np.dot(deviations.T, deviations)
+        self.merge(other)
+
+    def merge(self, other):
+        """Merge another accumulator into this one"""
+        if not other.count:
+            return
+        if not self.count:
+            self.count = other.count
+            self.mean = other.mean.copy()
+            self.comoment = other.comoment.copy()
+            return
+
+        # Pairwise update of mean and co-moments (Chan et al.)
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.comoment = self.comoment + other.comoment \
+            + np.outer(delta, delta) * self.count * other.count / count
+        self.mean = self.mean + delta * other.count / count
+        self.count = count
+
+    def covariance(self, ddof=1):
+        """Returns the d*d covariance matrix of the accumulated samples"""
+        return self.comoment / (self.count - ddof)
+
+
+def map_labels(label_array, labels, values, fill_value=np.nan):
+    """Returns an array of same shape as `label_array` where each label is
+    replaced by its corresponding value.
+
+    Parameters
+    ----------
+    label_array : numpy.ndarray
+        array of labels to map.
+    labels : numpy.ndarray
+        sorted labels.
+    values : numpy.ndarray
+        value corresponding to each label.
+    fill_value : float, optional
+        value for labels which are not in `labels` (default: NaN).
+    """
+    if len(labels) == 0:
+        return np.full(label_array.shape, fill_value)
+    idx = np.searchsorted(labels, label_array)
+    idx[idx == len(labels)] = 0
+    return np.where(labels[idx] == label_array, values[idx], fill_value)
@@ -0,0 +1,341 @@
+# -*- coding: utf-8 -*-
+
+"""The `cache` module provides on-disk caches for costly results computed from
+raster files.
+"""
+
+try:
+    import numpy as np
+except ImportError as e:
+    raise ImportError(
+        str(e) + "\n\nPlease install NumPy.")
+
+import hashlib
+import os
+import shutil
+import tempfile
+
+
+def file_identity(filename):
+    """Returns a tuple identifying the current state of a file: absolute path,
+    size and modification time.
+
+    :param filename: path to the file
+    :type filename: str
+    :rtype: tuple
+    """
+    stat = os.stat(filename)
+    return (os.path.abspath(filename), stat.st_size, repr(stat.st_mtime))
+
+
+def cache_key(*parts):
+    """Returns a hexadecimal key computed from the representation of the given
+    parts (eg. file identities and parameters).
+
+    :param parts: values the key depends on
+    :rtype: str
+    """
+    return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()
+
+
+class _DirectoryCache(object):
+    """Base class of on-disk caches, where each entry is a directory named
+    after its key.
+
+    Entries are first written in a temporary directory, which is renamed
+    when complete, so that an entry is either complete or absent.
+    """
+
+    def __init__(self, directory, max_bytes=None):
+        """Create a new cache instance.
+
+        Parameters
+        ----------
+        directory : str
+            path to the cache directory. It is created if needed.
+        max_bytes : int, optional
+            maximum total size of the cache, in bytes. By default, the size is
+            not bounded.
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # Already exists, maybe just created by another process
+            if not os.path.isdir(directory):
+                raise
+
+    def key(self, name, filenames, **params):
+        """Returns the key of a computation.
+
+        Parameters
+        ----------
+        name : str
+            name of the computation (eg. the name of the function).
+        filenames : list of str
+            paths to the input files.
+        params : dict
+            parameters of the computation.
+
+        Returns
+        -------
+        str
+            the key.
+        """
+        return cache_key(name,
+                         [file_identity(filename) for filename in filenames],
+                         sorted(params.items()))
+
+    def _new_entry_dir(self):
+        """Returns the path to a new temporary directory, in which to write
+        an entry before committing it."""
+        return tempfile.mkdtemp(dir=self.directory, prefix='.tmp_')
+
+    def _commit(self, tmp_dir, key, replace=True):
+        """Renames a temporary directory into the directory of an entry.
+
+        If the entry already exists, it is replaced, or, if `replace` is
+        False, kept (eg. when it was completed meanwhile by another process)
+        and the temporary directory is removed.
+        """
+        entry_dir = os.path.join(self.directory, key)
+        if replace and os.path.isdir(entry_dir):
+            shutil.rmtree(entry_dir)
+        try:
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            if not os.path.isdir(entry_dir):
+                raise
+            shutil.rmtree(tmp_dir)
+        self._evict(keep=key)
+
+    def invalidate(self, key=None):
+        """Removes an entry, or all entries if no key is given.
+
+        Parameters
+        ----------
+        key : str, optional
+            key of the entry to remove.
+        """
+        keys = [key] if key else self.keys()
+        for k in keys:
+            entry_dir = os.path.join(self.directory, k)
+            if os.path.isdir(entry_dir):
+                shutil.rmtree(entry_dir)
+
+    def keys(self):
+        """Returns the keys of all entries, from the least to the most recently
+        used.
+
+        Returns
+        -------
+        list of str
+        """
+        keys = [filename for filename in os.listdir(self.directory)
+                if not filename.startswith('.')
+                and os.path.isdir(os.path.join(self.directory, filename))]
+        return sorted(keys, key=lambda k: os.path.getmtime(
+            os.path.join(self.directory, k)))
+
+    def entry_size(self, key):
+        """Returns the size in bytes of an entry.
+
+        Parameters
+        ----------
+        key : str
+            key of the entry.
+
+        Returns
+        -------
+        int
+        """
+        entry_dir = os.path.join(self.directory, key)
+        return sum(os.path.getsize(os.path.join(entry_dir, filename))
+                   for filename in os.listdir(entry_dir))
+
+    def size(self):
+        """Returns the total size in bytes of the cache.
+
+        Returns
+        -------
+        int
+        """
+        return sum(self.entry_size(key) for key in self.keys())
+
+    def _evict(self, keep=None):
+        """Removes least recently used entries (except the `keep` one) until
+        the cache is not bigger than its maximum size."""
+        if self.max_bytes is None:
+            return
+        keys = self.keys()
+        sizes = dict((key, self.entry_size(key)) for key in keys)
+        total = sum(sizes.values())
+        for key in keys:
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            self.invalidate(key)
+            total -= sizes[key]
+
+
+class FeatureCache(_DirectoryCache):
+    """Cache of arrays (eg. feature matrices extracted from a statistic raster
+    and a label raster), stored as NumPy files in a directory.
+
+    Each entry is keyed by the name of the computation, the identity (path,
+    size, modification time) of its input files and its parameters, so that
+    an entry is not used anymore when an input file changes. Arrays are
+    memory-mapped when read back.
+
+    If a maximum size is given, least recently used entries are evicted when
+    the cache grows bigger.
+    """
+
+    def get(self, key):
+        """Returns the arrays of an entry, memory-mapped, or None if there is
+        no such entry.
+
+        Parameters
+        ----------
+        key : str
+            key of the entry.
+
+        Returns
+        -------
+        list of numpy.ndarray or None
+            arrays of the entry, in the order they were stored.
+        """
+        entry_dir = os.path.join(self.directory, key)
+        if not os.path.isdir(entry_dir):
+            return None
+        os.utime(entry_dir, None)  # Mark the entry as recently used
+        filenames = sorted(filename for filename in os.listdir(entry_dir)
+                           if filename.endswith('.npy'))
+        return [np.load(os.path.join(entry_dir, filename), mmap_mode='r')
+                for filename in filenames]
+
+    def put(self, key, arrays):
+        """Stores arrays as an entry of the cache, then evicts least recently
+        used entries if the cache is too big.
+
+        Parameters
+        ----------
+        key : str
+            key of the entry.
+        arrays : list of numpy.ndarray
+            arrays to store.
+        """
+        tmp_dir = self._new_entry_dir()
+        for i, array in enumerate(arrays):
+            np.save(os.path.join(tmp_dir, '{:03d}.npy'.format(i)),
+                    np.asarray(array))
+        self._commit(tmp_dir, key)
+
+    def fetch(self, name, filenames, compute, **params):
+        """Returns the arrays of a computation, from the cache if available,
+        else by computing and storing them.
+
+        Parameters
+        ----------
+        name : str
+            name of the computation.
+        filenames : list of str
+            paths to the input files.
+        compute : function
+            function without argument returning the tuple of arrays.
+        params : dict
+            parameters of the computation.
+
+        Returns
+        -------
+        tuple of numpy.ndarray
+            the arrays of the computation.
+        """
+        key = self.key(name, filenames, **params)
+        arrays = self.get(key)
+        if arrays is None:
+            arrays = compute()
+            self.put(key, arrays)
+        return tuple(arrays)
+
+
+class StageCache(_DirectoryCache):
+    """Cache of the output files of the stages of a processing chain (eg. the
+    smoothed image of a LSMS segmentation), stored in a directory.
+
+    Each entry is keyed by the name of the stage, the identity (path, size,
+    modification time) of its input files and its parameters. Since the
+    output files of a cached stage do not change, they can be the input
+    files of the next stage: a chain interrupted, or run again with other
+    parameters for its last stages only, resumes from the last completed
+    stage having the same parameters.
+
+    Entries are never evicted, since their files may be used as inputs.
+    Several processes can share the cache: if they compute the same stage at
+    the same time, the first completed entry is kept.
+    """
+
+    def __init__(self, directory):
+        """Create a new `StageCache` instance.
+
+        Parameters
+        ----------
+        directory : str
+            path to the cache directory. It is created if needed.
+        """
+        super(StageCache, self).__init__(directory)
+
+    def get(self, key):
+        """Returns the path to the directory of an entry, or None if there is
+        no such entry.
+
+        Parameters
+        ----------
+        key : str
+            key of the entry.
+
+        Returns
+        -------
+        str or None
+        """
+        entry_dir = os.path.join(self.directory, key)
+        if not os.path.isdir(entry_dir):
+            return None
+        os.utime(entry_dir, None)  # Mark the entry as recently used
+        return entry_dir
+
+    def fetch(self, name, filenames, compute, **params):
+        """Returns the directory of the output files of a stage, from the
+        cache if available, else by running the stage.
+
+        Parameters
+        ----------
+        name : str
+            name of the stage.
+        filenames : list of str
+            paths to the input files.
+        compute : function
+            function writing the output files in the directory given as its
+            only argument.
+        params : dict
+            parameters of the stage.
+
+        Returns
+        -------
+        str
+            path to the directory of the entry.
+        """
+        key = self.key(name, filenames, **params)
+        entry_dir = self.get(key)
+        if entry_dir is None:
+            tmp_dir = self._new_entry_dir()
+            try:
+                compute(tmp_dir)
+            except:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+                raise
+            self._commit(tmp_dir, key, replace=False)
+            entry_dir = os.path.join(self.directory, key)
+        return entry_dir
@@ -5,14 +5,106 @@ Created on Wed Feb  4 14:54:42 2015
 @author:
 """
 import numpy as np
-from osgeo import gdal
-from ymraster import Raster, write_file
+import os
+from ymraster import Raster, write_file, _pool_imap
 from raster_dtype import RasterDataType
-from sklearn import tree
+import array_stat
+from sklearn import cluster, ensemble, linear_model, neighbors, tree
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
 from sklearn.metrics import confusion_matrix, classification_report,\
                              accuracy_score
 
-def get_samples_from_roi(in_rst_label,in_rst_roi,in_rst_stat ):
+def _first_pixel_per_label(label_raster, roi_raster=None):
+    """Scans a label raster block by block and returns, for each label, the
+    position of its first pixel (in row-major order).
+
+    If a ROI raster is given, only pixels whose value in the ROI is not 0 are
+    considered, and the ROI value of each found pixel is also returned.
+
+    :param label_raster: the label raster
+    :type label_raster: `Raster`
+    :param roi_raster: the ROI raster, of same size as the label raster
+    :type roi_raster: `Raster`
+    :returns: sorted labels, row and column of their first pixel, and ROI value
+              of these pixels (None if no ROI raster is given)
+    :rtype: tuple of numpy.ndarray
+    """
+    width = label_raster.width
+    found = []
+    for block_win in label_raster.block_windows():
+        x, y, xsize, _ = block_win
+        labels = label_raster.array_from_bands(
+            1, block_win=block_win, mask_nodata=False).ravel()
+        classes = None
+        if roi_raster is not None:
+            classes = roi_raster.array_from_bands(
+                1, block_win=block_win, mask_nodata=False).ravel()
+            in_roi = (classes != 0).nonzero()[0]
+            labels, classes = labels[in_roi], classes[in_roi]
+        else:
+            in_roi = np.arange(labels.size)
+        block_labels, first = np.unique(labels, return_index=True)
+        positions = (y + in_roi[first] // xsize) * width \
+            + x + in_roi[first] % xsize
+        found.append((block_labels, positions,
+                      classes[first] if classes is not None else None))
+
+    # Keep the first position of each label among all blocks
+    labels = np.concatenate([block_found[0] for block_found in found])
+    positions = np.concatenate([block_found[1] for block_found in found])
+    order = np.lexsort((positions, labels))
+    labels, first = np.unique(labels[order], return_index=True)
+    positions = positions[order][first]
+    classes = np.concatenate([block_found[2] for block_found in found])[
+        order][first] \
+        if roi_raster is not None \
+        else None
+    return labels, positions // width, positions % width, classes
+
+
+def _pixel_features(stat_raster, rows, cols):
+    """Returns the values of all bands of a raster at the given pixels.
+
+    Only the blocks containing at least one of the pixels are read.
+
+    :param stat_raster: the raster to read values from
+    :type stat_raster: `Raster`
+    :param rows: row of each pixel
+    :type rows: numpy.ndarray
+    :param cols: column of each pixel
+    :type cols: numpy.ndarray
+    :returns: a nXd matrix, where n is the number of pixels and d the number
+              of bands
+    :rtype: numpy.ndarray
+    """
+    X = np.empty((len(rows), stat_raster.count))
+    block_xsize, block_ysize = stat_raster.block_size
+    blocks_per_row = stat_raster.width // block_xsize + 1
+    block_ids = (rows // block_ysize) * blocks_per_row + cols // block_xsize
+    for block_id in np.unique(block_ids):
+        in_block = (block_ids == block_id).nonzero()[0]
+        y = rows[in_block[0]] // block_ysize * block_ysize
+        x = cols[in_block[0]] // block_xsize * block_xsize
+        block_win = (x, y,
+                     min(block_xsize, stat_raster.width - x),
+                     min(block_ysize, stat_raster.height - y))
+        array = np.atleast_3d(stat_raster.array_from_bands(
+            block_win=block_win, mask_nodata=False))
+        X[in_block] = array[rows[in_block] - y, cols[in_block] - x]
+    return X
+
+
+def _check_same_size(*rasters):
+    """Raises a ValueError if the given rasters have not the same size"""
+    if len(set((raster.width, raster.height) for raster in rasters)) > 1:
+        raise ValueError('Images should be of the same size: {}'.format(
+            ', '.join('{:f}'.format(raster) for raster in rasters)))
+
+
+def get_samples_from_roi(in_rst_label,in_rst_roi,in_rst_stat, cache=None):
     '''
     The function, thanks to a label image, picks the index of one pixel per
     sample in a sample raster. Then it takes for each sample the statistic
@@ -21,12 +113,20 @@ def get_samples_from_roi(in_rst_label,in_rst_roi,in_rst_stat ):
     match with the segmentation objects of the label image. The input rasters
     could be any file that GDAL can open.
 
+    The rasters are read block by block: the ROI and label rasters are
+    scanned to locate one pixel per sample, then only the blocks of the
+    statistic raster which contain these pixels are read. Memory use is thus
+    proportional to the number of samples, not to the size of the image.
+
     :param in_rst_label: name of the label image, supposedly created previously
                         during a segmentation.
     :param in_rst_roi: name of the sample raster, all the samples should
                         correspond to a object in the label image
     :param in_rst_stat: name of the statistic features raster of the
                         segmentation objects
+    :param cache: a FeatureCache object. If given, the result is read from
+                  the cache if the rasters did not change since it was
+                  computed, else it is computed and stored in the cache.
     :returns:
             X: the sample matrix. A nXd matrix, where n is the number of
             referenced samples and d is the number of features. Each line of
@@ -35,154 +135,351 @@ def get_samples_from_roi(in_rst_label,in_rst_roi,in_rst_stat ):
             Y: the classes of the samples in a vertical n matrix. 
     ''' 
     
+    if cache is not None:
+        return cache.fetch('get_samples_from_roi',
+                           [in_rst_label, in_rst_roi, in_rst_stat],
+                           lambda: get_samples_from_roi(in_rst_label,
+                                                        in_rst_roi,
+                                                        in_rst_stat))
+
     ## Open data
-    stat = gdal.Open(in_rst_stat,gdal.GA_ReadOnly)
-    if stat is None:
-        print 'Impossible to open '+ in_rst_stat
-        exit()
-
-    roi = gdal.Open(in_rst_roi,gdal.GA_ReadOnly)
-    if roi is None:
-        print 'Impossible to open '+ in_rst_roi
-        exit()
-
-    label = gdal.Open(in_rst_label, gdal.GA_ReadOnly)
-    if label is None:
-        print 'Impossible to open '+ in_rst_label
-        exit()
-    ##Test the size
-    if not((stat.RasterXSize == roi.RasterXSize) and (stat.RasterYSize ==
-    roi.RasterYSize) and (stat.RasterXSize == label.RasterXSize) and
-    (stat.RasterYSize == label.RasterYSize) ):
-        print 'Images should be of the same size'
-        exit()
-
-    ## Get the number of features
-    d  = stat.RasterCount
-
-    ## load the ROI array
-    ROI = roi.GetRasterBand(1).ReadAsArray()
-    t = (ROI == 0).nonzero()
-
-    ##load the label array and set negative value where the objects don't
-    #correspond to samples
-    LABEL = label.GetRasterBand(1).ReadAsArray()
-    LABEL[t] = -99
-
-    ##get the indices of one pixel per sample
-    #sort the label by their id and get the indices of the first occurrences
-    #of the unique values in the (flattened) original array (LABEL)
-    l, l_ind  = np.unique(LABEL,return_index = True)
-    #Delete the first id, corresponding to -99
-    l_ind = l_ind[1:len(l_ind)]
-    nb_samp = len(l_ind)
-    col = LABEL.shape[1]
-    #Get the index of each sample in the non-flattened original array
-    indices = [np.empty(nb_samp),np.empty(nb_samp)]
-    indices[0] = [l_ind // col]    #the rows
-    indices[1] = [l_ind % col]    #the columns
-
-    ##set the Y array, ie taking the classes values of each sample
-    Y = ROI[indices].reshape((nb_samp,1))
-    del ROI
-    roi = None
+    stat = Raster(in_rst_stat)
+    roi = Raster(in_rst_roi)
+    label = Raster(in_rst_label)
+    _check_same_size(stat, roi, label)
+
+    ## Get the position of one pixel per sample, and its class
+    _, rows, cols, classes = _first_pixel_per_label(label, roi_raster=roi)
+    Y = classes.reshape((len(classes), 1))
 
     ##set the X array, ie taking all the statistic features for each sample
-    try:
-        X = np.empty((nb_samp,d))
+    X = _pixel_features(stat, rows, cols)
 
-    except MemoryError:
-        print 'Impossible to allocate memory: roi too big'
-        exit()
+    return X,Y
 
-    for i in range(d):
-        temp = stat.GetRasterBand(i+1).ReadAsArray()
-        X[:,i] = temp[indices]
+def sample_training_pixels(roi_raster, feature_raster, n_per_class,
+                           train_size=0.75, seed=None, min_distance=None):
+    """
+    Draw a stratified random sample of pixels from a ROI raster, and split it
+    into a training and a validation dataset.
 
-    #close the files and release memory
-    stat = None
-    del temp, indices, d, nb_samp, col, t, l, l_ind
+    The ROI raster is read once, block by block, and at most n_per_class
+    pixels per class are kept by reservoir sampling, so that candidate pixels
+    are never all held in memory. Then only the blocks of the feature raster
+    containing drawn pixels are read.
 
-    return X,Y
+    :param roi_raster: The ROI Raster object, where each pixel value is a
+                        class, 0 meaning no class.
+    :param feature_raster: The Raster object of features, of same size.
+    :param n_per_class: Maximum number of pixels to draw per class.
+    :param train_size: Should be between 0.0 and 1.0 and represent the
+                        proportion of drawn pixels of each class used for
+                        training. Default value is 0.75.
+    :param seed: Seed of the random generator, to get reproducible samples.
+    :param min_distance: If given, candidates are snapped to a grid: only
+                        pixels whose row and column are multiples of
+                        min_distance are kept, so that two drawn pixels are
+                        at least min_distance pixels apart. This also thins
+                        the candidates by a factor of min_distance**2, even
+                        where pixels of a class are scarce.
+    :returns:
+            X_train, X_test: The sample-features matrices of the training and
+                        validation datasets.
+
+            Y_train, Y_test: The classes of the samples in vertical matrices.
+    """
+    _check_same_size(roi_raster, feature_raster)
+    rng = np.random.RandomState(seed)
+    width = roi_raster.width
+
+    #For each class, the reservoir of pixel positions and the number of
+    #candidates seen so far
+    reservoirs = {}
+    for block_win in roi_raster.block_windows():
+        x, y, xsize, ysize = block_win
+        roi = roi_raster.array_from_bands(1, block_win=block_win,
+                                          mask_nodata=False)
+        rows, cols = np.nonzero(roi)
+        classes = roi[rows, cols]
+        rows, cols = rows + y, cols + x
+        if min_distance:
+            on_grid = (rows % min_distance == 0) & (cols % min_distance == 0)
+            rows, cols = rows[on_grid], cols[on_grid]
+            classes = classes[on_grid]
+        for cls in np.unique(classes):
+            candidates = rows[classes == cls] * width + cols[classes == cls]
+            reservoir, seen = reservoirs.get(
+                cls, (np.empty(n_per_class, dtype=np.int64), 0))
+            ranks = seen + np.arange(len(candidates))
+
+            #Fill the reservoir, then replace a random item with probability
+            #n_per_class / (rank + 1) (algorithm R)
+            filling = ranks < n_per_class
+            reservoir[ranks[filling]] = candidates[filling]
+            slots = (rng.random_sample(len(candidates))
+                     * (ranks + 1)).astype(np.int64)
+            replacing = ~filling & (slots < n_per_class)
+            reservoir[slots[replacing]] = candidates[replacing]
+            reservoirs[cls] = (reservoir, seen + len(candidates))
+
+    #Split each class into training and validation samples
+    train, test = [], []
+    for cls in sorted(reservoirs):
+        reservoir, seen = reservoirs[cls]
+        positions = rng.permutation(reservoir[:min(seen, n_per_class)])
+        n_train = int(round(train_size * len(positions)))
+        train.append((positions[:n_train], cls))
+        test.append((positions[n_train:], cls))
+
+    #Read features of drawn pixels only
+    datasets = []
+    for samples in (train, test):
+        positions = np.concatenate([pos for pos, _ in samples]) \
+            if samples \
+            else np.empty(0, dtype=np.int64)
+        Y = np.concatenate([np.repeat(cls, len(pos))
+                            for pos, cls in samples]) \
+            if samples \
+            else np.empty(0)
+        X = _pixel_features(feature_raster, positions // width,
+                            positions % width)
+        datasets.append((X, Y.reshape((len(Y), 1))))
+    (X_train, Y_train), (X_test, Y_test) = datasets
+
+    return X_train, X_test, Y_train, Y_test
 
-def get_samples_from_label_img(in_rst_label, in_rst_stat):
+def get_samples_from_label_img(in_rst_label, in_rst_stat, cache=None):
     """
     The function, given a label and statistic image, compute in a 2d array the
     feature per label.The two input rasters should be of the same size. The
     input rasters could be any file that GDAL can open. The function also
-    compute a reverse matrix that can permit to rebuild an image from the
-    result of an object classification
+    returns the label of each line of the feature matrix, which permits to
+    rebuild an image from the result of an object classification (see
+    write_label_classification()).
+
+    As in get_samples_from_roi(), rasters are read block by block.
 
     :param in_rst_label: name of the label image, supposedly created previously
                         during a segmentation.
     :param in_rst_stat: name of the statistic features raster of the
                         segmentation objects
+    :param cache: a FeatureCache object (cf. get_samples_from_roi()).
     :returns:
             X: the sample matrix. A nXd matrix, where n is the number of
             label and d is the number of features. Each line of
             the matrix is label.
 
-            reverse: everse matrix that can permit to rebuild an image from the
-            result of an object classification.
+            labels: the sorted labels, one per line of X.
     """
+    if cache is not None:
+        return cache.fetch('get_samples_from_label_img',
+                           [in_rst_label, in_rst_stat],
+                           lambda: get_samples_from_label_img(in_rst_label,
+                                                              in_rst_stat))
+
     ## Open data
-    stat = gdal.Open(in_rst_stat,gdal.GA_ReadOnly)
-    if stat is None:
-        print 'Impossible to open '+ in_rst_stat
-        exit()
-
-    label = gdal.Open(in_rst_label, gdal.GA_ReadOnly)
-    if label is None:
-        print 'Impossible to open '+ in_rst_label
-        exit()
-
-    ##Test the size
-    if not((stat.RasterXSize == label.RasterXSize) and
-    (stat.RasterYSize == label.RasterYSize) ):
-        print 'Images should be of the same size'
-        exit()
-
-    ## Get the number of features
-    d  = stat.RasterCount
-
-    ##load the label array
-    LABEL = label.GetRasterBand(1).ReadAsArray()
-
-    ##get the indices of one pixel per label
-    #sort the label by their id and get the indices of the first occurrences
-    #of the unique values in the (flattened) original array (LABEL). Compute
-    #also the reverse matrix that can permit to rebuild the original array.
-    l, l_ind, reverse  = np.unique(LABEL,return_index = True,
-                                   return_inverse = True)
-    nb_samp = len(l_ind)
-
-    #Get the index of each sample in the non-flattened original array
-    col = LABEL.shape[1]
-    indices = [np.empty(nb_samp),np.empty(nb_samp)]
-    indices[0] = [l_ind // col]#the rows
-    indices[1] = [l_ind % col]#the columns
-
-    ##set the X array, ie taking all the statistic features for each label
+    stat = Raster(in_rst_stat)
+    label = Raster(in_rst_label)
+    _check_same_size(stat, label)
+
+    ##get the position of one pixel per label, then its features
+    labels, rows, cols, _ = _first_pixel_per_label(label)
+    X = _pixel_features(stat, rows, cols)
+
+    return X, labels
+
+def _write_label_values(label_raster, labels, values, out_filename, dtype):
+    """
+    Write an image where each label of a label image is replaced by its
+    values (one band per column of values), block by block.
+
+    Direct indexing is used if the label image has dense ids (see
+    ymraster.relabel()), else a binary search in the sorted labels. Pixels
+    whose label is unknown are set to 0.
+
+    :param label_raster: The label raster.
+    :param labels: The sorted labels.
+    :param values: The n*k array of values of each label.
+    :param out_filename: Name of the image to be written.
+    :param dtype: The numpy data type of the image to be written.
+    :returns: the written raster.
+    """
+    dense = label_raster.dense_label_count() == len(labels) \
+        and np.array_equal(labels, np.arange(len(labels)))
+
+    meta = label_raster.meta
+    meta['dtype'] = RasterDataType(numpy_dtype=dtype)
+    meta['count'] = values.shape[1]
+    write_file(out_filename, overwrite=True, **meta)
+    for block_win in label_raster.block_windows():
+        label_array = label_raster.array_from_bands(1, block_win=block_win,
+                                                    mask_nodata=False)
+        if dense:
+            block = values[label_array]
+        else:
+            block = np.dstack([array_stat.map_labels(label_array, labels,
+                                                     values[:, i],
+                                                     fill_value=0)
+                               for i in range(values.shape[1])])
+        block = block.astype(dtype)
+        write_file(out_filename,
+                   array=block if values.shape[1] > 1 else block[:, :, 0],
+                   xoffset=block_win[0], yoffset=block_win[1])
+
+    return Raster(out_filename)
+
+def _check_classes(classes):
+    """
+    Raise a ValueError if some classes can not be written in a classification
+    image, that is if they are not positive integers fitting in uint32: 0 is
+    the value of NODATA pixels and unknown labels.
+
+    :param classes: The classes, eg. the classes_ attribute of a fitted
+                    estimator.
+    """
+    classes = np.asarray(classes)
+    if classes.dtype.kind not in 'uif' \
+            or np.any(classes != np.round(classes)) \
+            or np.any(classes < 1) \
+            or np.any(classes > np.iinfo(np.uint32).max):
+        raise ValueError('Classes should be positive integers to be written '
+                         'in a classification image (0 is NODATA), got: '
+                         '{}'.format(np.unique(classes)))
+
+def write_label_classification(label_raster, labels, classes, out_filename):
+    """
+    Write a classification image from the classes predicted for each label of
+    a label image.
+
+    The label image is read block by block and each label is replaced by its
+    class, using direct indexing if the label image has dense ids (see
+    ymraster.relabel()), or a binary search in the sorted labels otherwise.
+    Memory use thus does not depend on the size of the image. Pixels whose
+    label is unknown are set to 0.
+
+    :param label_raster: The label raster.
+    :param labels: The sorted labels, eg. as returned by
+                   get_samples_from_label_img().
+    :param classes: The class of each label, positive integers (a ValueError
+                    is raised otherwise).
+    :param out_filename: Name of the classification image to be written.
+    :returns: the classification raster.
+    """
+    _check_classes(classes)
+    return _write_label_values(label_raster, labels,
+                               np.ravel(classes).reshape((-1, 1)),
+                               out_filename, np.uint32)
+
+def write_label_probabilities(label_raster, labels, probas, out_filename):
+    """
+    Write an image of class probabilities from the probabilities predicted
+    for each label of a label image, block by block (see
+    write_label_classification()).
+
+    The image is of type float32 and has one band per class, in the order of
+    the columns of probas, plus a last band of confidence, that is the
+    probability of the predicted class.
+
+    :param label_raster: The label raster.
+    :param labels: The sorted labels.
+    :param probas: The n*k array of class probabilities of each label, eg. as
+                   returned by the predict_proba() method of an estimator.
+    :param out_filename: Name of the image to be written.
+    :returns: the probability raster.
+    """
+    return _write_label_values(
+        label_raster, labels,
+        np.hstack((probas, probas.max(axis=1).reshape((-1, 1)))),
+        out_filename, np.float32)
+
+#Estimators available by name in make_estimator()
+_ESTIMATORS = {'decision_tree': tree.DecisionTreeClassifier,
+               'random_forest': ensemble.RandomForestClassifier,
+               'extra_trees': ensemble.ExtraTreesClassifier,
+               'k_neighbors': neighbors.KNeighborsClassifier,
+               'logistic_regression': linear_model.LogisticRegression}
+
+def make_estimator(name='decision_tree', n_jobs=None, **params):
+    """
+    Create a scikit-learn classifier from its name.
+
+    :param name: One of 'decision_tree', 'random_forest', 'extra_trees',
+                 'k_neighbors' or 'logistic_regression'. Any other
+                 scikit-learn classifier can be given directly to the
+                 classification functions.
+    :param n_jobs: Number of jobs used by the estimator to fit and predict in
+                   parallel, for estimators which support it (eg. -1 to use
+                   all processors).
+    :param params: Other parameters of the estimator (eg. n_estimators).
+    :returns: The (unfitted) estimator.
+    """
     try:
-        X = np.empty((nb_samp,d))
+        estimator_class = _ESTIMATORS[name]
+    except KeyError:
+        raise ValueError('Unknown estimator: {}'.format(name))
+    estimator = estimator_class(**params)
+    if n_jobs is not None and 'n_jobs' in estimator.get_params():
+        estimator.set_params(n_jobs=n_jobs)
+    return estimator
+
+def object_classification(X_train, Y_train, X_img, labels, label_raster,
+                          out_filename, estimator=None, X_test=None,
+                          chunk_size=100000, proba_filename=None):
+    """
+    Perform an object-based classification with any scikit-learn
+    estimator: train it, predict the class of each label by chunks, and write
+    the classification image block by block.
 
-    except MemoryError:
-        print 'Impossible to allocate memory: label image too big'
-        exit()
+    :param X_train: The sample-features matrix used to train the model, a n*d
+                    array where n is the number of referenced samples and d is
+                    the number of features.
+    :param Y_train: The classes of the samples in a vertical n matrix,
+                    positive integers (0 is the value of unknown labels).
+    :param X_img: The sample-features matrix of all the labels of the image
+                    (cf. get_samples_from_label_img()).
+    :param labels: The label of each line of X_img.
+    :param label_raster: The label raster object.
+    :param out_filename: Name of the classification image to be written.
+    :param estimator: The scikit-learn estimator to use (cf.
+                    make_estimator()). By default, a decision tree.
+    :param X_test: The sample-features matrix of a validation dataset, if
+                    any.
+    :param chunk_size: Maximum number of labels predicted at once, to bound
+                    memory use.
+    :param proba_filename: If given, name of the image of class probabilities
+                    to be written (cf. write_label_probabilities()).
+    :returns:
+            y_predict: The classes predicted from the validation dataset, or
+                        None if there is no validation dataset.
+
+            estimator: The fitted estimator.
+    """
+    estimator = estimator if estimator is not None \
+        else tree.DecisionTreeClassifier()
+    estimator = estimator.fit(X_train, np.ravel(Y_train))
+    _check_classes(estimator.classes_)
 
-    for i in range(d):
-        temp = stat.GetRasterBand(i+1).ReadAsArray()
-        X[:,i] = temp[indices]
+    #Perform the prediction on the whole label image, by chunks
+    classif, probas = _predict_pixels(estimator, X_img, chunk_size,
+                                      proba=bool(proba_filename))
+    write_label_classification(label_raster, labels, classif, out_filename)
+    if proba_filename:
+        write_label_probabilities(label_raster, labels, probas,
+                                  proba_filename)
 
-    #close the files and release memory
-    stat = None
-    del temp, indices, d, nb_samp, col, l, l_ind
+    #Perform the prediction on the test sample
+    y_predict = _predict_pixels(estimator, X_test, chunk_size)[0] \
+        if X_test is not None \
+        else None
 
-    return X, reverse
+    return y_predict, estimator
 
-def decision_tree(X_train, Y_train, X_test, X_img, reverse_array, raster, 
+def decision_tree(X_train, Y_train, X_test, X_img, labels, label_raster,
                   out_filename, ext = 'Gtiff' ):
     """
+    Perform an object-based classification with a decision tree (cf.
+    object_classification() to use another estimator).
+
     :param X_train: The sample-features matrix used to train the model, a n*d 
                     array where n is the number of referenced samples and d is 
                     the number of features.
@@ -195,13 +492,12 @@ def decision_tree(X_train, Y_train, X_test, X_img, reverse_array, raster,
                     on which the model is applied, a n*d array where n is the 
                     number of referenced samples and d is the number of 
                     features.
-    :param reverse_array:The reverse matrix use to rebuild into the origin
-                        dimension the result of the classification. This matrix
-                        is supposed to be computed previously (cf. 
-                        get_samples_from_label_img() #TODO)
-    :param raster: The raster object that contains all the meta-data that should
-                    be set on the classification image written, eg : it could be
-                    the raster object of the labelled image.
+    :param labels: The label of each line of X_img, used to rebuild the
+                    classification image from the label image. It is supposed
+                    to be computed previously (cf. get_samples_from_label_img())
+    :param label_raster: The label raster object, which also contains all the
+                    meta-data that should be set on the classification image
+                    written.
     :param out_filename: Name of the classification image to be written.
     :param ext: Format of the output image to be written. Any formats
                 supported by GDAL. The default value is 'Gtiff'.
@@ -210,34 +506,506 @@ def decision_tree(X_train, Y_train, X_test, X_img, reverse_array, raster,
                         vertical n matrix. It is useful to compute prediction 
                         error metrics.
     """
-    #Get some parameters    
-    rows = raster.meta['height']
-    col = raster.meta['width']   
-    
-    #Set the DecisionTreeClassifier
-    clf = tree.DecisionTreeClassifier()
-    
-    #Train the model
-    clf = clf.fit(X_train, Y_train)
-    
-    #Perform the prediction on the whole label image
-    classif = clf.predict(X_img)
-    
-    #Perform the prediction on the test sample
-    y_predict = clf.predict(X_test)
-    
-    #Rebuild the image from the classif flat array with the given reverse array
-    classif = classif[reverse_array]
-    classif = classif.reshape(rows,col)
-    
-    #write the file
+    return object_classification(X_train, Y_train, X_img, labels,
+                                 label_raster, out_filename,
+                                 estimator=tree.DecisionTreeClassifier(),
+                                 X_test=X_test)
+
+class Model(object):
+    """
+    A fitted estimator along with the specification of the features it
+    expects: the bands of the rasters to use (in order), the statistics these
+    bands were computed with (informative, eg. the stats given to
+    Raster.label_stats()) and the data type features are converted to before
+    prediction.
+
+    A model can be saved to a file and loaded back, so that it can be applied
+    to many rasters without being trained again.
+    """
+
+    #Version of the file format written by save()
+    format_version = 1
+
+    def __init__(self, estimator, bands=None, stats=None, dtype='float64'):
+        """
+        :param estimator: A fitted scikit-learn estimator.
+        :param bands: Indices of the bands to use as features, in order
+                      (numbering starts at 1). By default, all bands.
+        :param stats: Statistics the features were computed with.
+        :param dtype: Data type of the features, as a lower string (eg.
+                      'float32').
+        """
+        self.estimator = estimator
+        self.bands = list(bands) if bands else None
+        self.stats = list(stats) if stats else None
+        self.dtype = dtype
+
+    @property
+    def classes_(self):
+        """The classes known by the estimator"""
+        return self.estimator.classes_
+
+    def save(self, filename):
+        """
+        Save the model to a file.
+
+        :param filename: Name of the file to be written.
+        """
+        with open(filename, 'wb') as f:
+            pickle.dump({'format_version': self.format_version,
+                         'estimator': self.estimator,
+                         'bands': self.bands,
+                         'stats': self.stats,
+                         'dtype': self.dtype},
+                        f, pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Load a model from a file written by save().
+
+        :param filename: Name of the model file.
+        :returns: The Model object.
+        """
+        with open(filename, 'rb') as f:
+            content = pickle.load(f)
+        if content.get('format_version') != cls.format_version:
+            raise ValueError('Unsupported model file format: {}'.format(
+                filename))
+        return cls(content['estimator'], bands=content['bands'],
+                   stats=content['stats'], dtype=content['dtype'])
+
+def _as_model(model):
+    """
+    Returns the given Model, the Model saved in the given file, or a Model
+    wrapping the given estimator.
+    """
+    if isinstance(model, Model):
+        return model
+    elif isinstance(model, basestring):
+        return Model.load(model)
+    return Model(model)
+
+def train_model(X_train, Y_train, estimator=None, bands=None, stats=None,
+                dtype='float64'):
+    """
+    Train an estimator and returns it as a Model, with its feature
+    specification.
+
+    :param X_train: The sample-features matrix used to train the model, a n*d
+                    array where n is the number of referenced samples and d is
+                    the number of features.
+    :param Y_train: The classes of the samples in a vertical n matrix.
+    :param estimator: The scikit-learn estimator to train. By default, a
+                      decision tree.
+    :param bands: Indices of the bands the features come from, in order. By
+                  default, all bands.
+    :param stats: Statistics the features were computed with.
+    :param dtype: Data type of the features, as a lower string.
+    :returns: The trained Model.
+    """
+    estimator = estimator if estimator is not None \
+        else tree.DecisionTreeClassifier()
+    estimator.fit(np.asarray(X_train, dtype=dtype), np.ravel(Y_train))
+    return Model(estimator, bands=bands, stats=stats, dtype=dtype)
+
+# Model used by classification worker processes (see _init_worker())
+_WORKER = {}
+
+def _init_worker(model):
+    """
+    Store the model to use in the current (worker) process.
+
+    :param model: A Model, the name of a model file or a fitted scikit-learn
+                  estimator.
+    """
+    _WORKER['model'] = _as_model(model)
+
+def _predict_pixels(model, pixels, batch_size, proba=False):
+    """
+    Predict the class (and optionally the class probabilities) of each pixel,
+    by batches of at most batch_size pixels.
+
+    :param model: A fitted scikit-learn estimator.
+    :param pixels: A n*d array, where n is the number of pixels and d the
+                    number of features.
+    :param batch_size: Maximum number of pixels predicted at once.
+    :param proba: If True, also predict class probabilities.
+    :returns:
+            classes: The class of each pixel, in a n array.
+
+            probas: The n*k array of class probabilities, k being the number
+                    of classes, or None if proba is False.
+    """
+    classes = np.empty(len(pixels), dtype=model.classes_.dtype)
+    probas = np.zeros((len(pixels), len(model.classes_))) if proba else None
+    for start in range(0, len(pixels), batch_size):
+        batch = pixels[start:start + batch_size]
+        classes[start:start + batch_size] = model.predict(batch)
+        if proba:
+            probas[start:start + batch_size] = model.predict_proba(batch)
+    return classes, probas
+
+def _valid_mask(pixels, nodata_value):
+    """
+    Returns the boolean mask of the pixels of a (pixels, bands) matrix which
+    have neither a NaN nor a NODATA value in any band.
+
+    :param pixels: A n*d array, where n is the number of pixels and d the
+                    number of bands.
+    :param nodata_value: The NODATA value of the raster, or None.
+    """
+    valid = ~np.isnan(pixels).any(axis=1)
+    if nodata_value is not None:
+        valid &= ~(pixels == nodata_value).any(axis=1)
+    return valid
+
+def _classify_block(task):
+    """
+    Classify the pixels of one block of a raster, with the model of the
+    current process. NODATA and NaN pixels are given the class 0 (and
+    probabilities 0).
+
+    :param task: The filename of the raster, the block window, the batch size
+                 and whether to compute class probabilities.
+    :returns: The block window and the block array of classes (and
+              probabilities and confidence, as additional bands, if asked).
+    """
+    filename, block_win, batch_size, proba = task
+    raster = Raster(filename)
+    model = _WORKER['model']
+
+    #Reshape the block into a (pixels, bands) matrix and skip NODATA pixels
+    bands = model.bands if model.bands else range(1, raster.count + 1)
+    array = np.atleast_3d(raster.array_from_bands(*bands,
+                                                  block_win=block_win,
+                                                  mask_nodata=False))
+    pixels = array.reshape((-1, len(bands)))
+    valid = _valid_mask(pixels, raster.nodata_value)
+
+    classes, probas = _predict_pixels(model.estimator,
+                                      pixels[valid].astype(model.dtype),
+                                      batch_size, proba)
+    result = np.zeros((len(pixels),
+                       2 + probas.shape[1] if proba else 1))
+    result[valid, 0] = classes
+    if proba:
+        result[valid, 1:-1] = probas
+        result[valid, -1] = probas.max(axis=1)
+    return block_win, result.reshape((array.shape[0], array.shape[1], -1))
+
+def classify_raster(raster, model, out_filename, block_size=None, workers=None,
+                    proba=False, batch_size=100000):
+    """
+    Perform a pixel-based classification of a raster: each pixel is
+    classified from the values of all its bands.
+
+    The raster is processed block by block, each block being reshaped into a
+    (pixels, bands) matrix and predicted by batches. Blocks can be classified
+    in parallel by several processes, the model being sent once to each of
+    them. NODATA pixels are not classified and get the class 0, which is set
+    as the NODATA value of the output: the classes of the model should thus
+    be positive integers, else a ValueError is raised.
+
+    :param raster: The Raster object to classify.
+    :param model: A Model (or the name of a model file), or a fitted
+                    scikit-learn estimator trained on features in the order
+                    of the bands of the raster.
+    :param out_filename: Name of the classification image to be written.
+    :param block_size: Size (xsize, ysize) of the blocks to classify. By
+                        default, the natural block size of the raster is used.
+    :param workers: Number of processes to use. By default, everything is done
+                    in the current process.
+    :param proba: If True, the output image also contains, after the class
+                    band, one band of probability per class (in the order of
+                    model.classes_) and a band of confidence (probability of
+                    the predicted class), and is of type float32. Else it is
+                    a one-band uint32 image.
+    :param batch_size: Maximum number of pixels predicted at once.
+    :returns: The classification raster.
+    """
+    model = _as_model(model)
+    _check_classes(model.classes_)
     meta = raster.meta
-    meta['driver'] = gdal.GetDriverByName(ext)
-    meta['dtype'] = RasterDataType(numpy_dtype = np.uint32)
-    meta['count'] = None
-    write_file(out_filename, overwrite=True, array=classif, **meta)
-                 
-    return y_predict, clf
+    meta['count'] = 2 + len(model.classes_) if proba else 1
+    meta['dtype'] = RasterDataType(numpy_dtype=np.float32) \
+        if proba \
+        else RasterDataType(numpy_dtype=np.uint32)
+    write_file(out_filename, overwrite=True, **meta)
+
+    tasks = ((raster.filename, block_win, batch_size, proba)
+             for block_win in raster.block_windows(block_size=block_size))
+    for block_win, result in _pool_imap(_classify_block, tasks, workers,
+                                        initializer=_init_worker,
+                                        initargs=(model,)):
+        result = result.astype(meta['dtype'].numpy_dtype)
+        write_file(out_filename,
+                   array=result if proba else result[:, :, 0],
+                   xoffset=block_win[0], yoffset=block_win[1])
+
+    out_raster = Raster(out_filename)
+    if not proba:
+        out_raster.nodata_value = 0
+    return out_raster
+
+def _apply_model_task(task):
+    """
+    Classify a whole raster with the model of the current process.
+
+    :param task: The filename of the raster, the name of the classification
+                 image to be written, the block size, the batch size and
+                 whether to compute class probabilities.
+    :returns: The name of the classification image.
+    """
+    filename, out_filename, block_size, batch_size, proba = task
+    classify_raster(Raster(filename), _WORKER['model'], out_filename,
+                    block_size=block_size, proba=proba, batch_size=batch_size)
+    return out_filename
+
+def apply_model(model, rasters, out_filenames=None, workers=None,
+                block_size=None, proba=False, batch_size=100000):
+    """
+    Apply a model to many rasters (pixel-based classification, see
+    classify_raster()).
+
+    Rasters are distributed over a pool of processes, each one loading the
+    model once, then classifying its rasters one after the other, block by
+    block.
+
+    :param model: A Model or the name of a model file (see Model.save()).
+    :param rasters: The list of Raster objects to classify.
+    :param out_filenames: Name of the classification image to be written for
+                          each raster. By default, it is the raster name with
+                          a '_classif.tif' suffix, in the current directory.
+    :param workers: Number of processes to use. By default, everything is done
+                    in the current process.
+    :param block_size: Size (xsize, ysize) of the blocks to classify.
+    :param proba: If True, also write class probabilities (see
+                  classify_raster()).
+    :param batch_size: Maximum number of pixels predicted at once.
+    :returns: The list of classification rasters, in the order of rasters.
+    """
+    out_filenames = out_filenames \
+        if out_filenames \
+        else ['{:b}_classif.tif'.format(raster) for raster in rasters]
+    tasks = [(raster.filename, out_filename, block_size, batch_size, proba)
+             for raster, out_filename in zip(rasters, out_filenames)]
+    return [Raster(out_filename)
+            for out_filename in _pool_imap(_apply_model_task, tasks, workers,
+                                           initializer=_init_worker,
+                                           initargs=(model,))]
+
+class _ClusterModel(object):
+    """
+    Wrap a fitted clustering estimator so that clusters are numbered from 1,
+    0 being the class of NODATA pixels in classify_raster().
+    """
+
+    def __init__(self, estimator):
+        self.estimator = estimator
+        self.classes_ = np.arange(1, estimator.n_clusters + 1)
+
+    def predict(self, X):
+        return self.estimator.predict(X) + 1
+
+def _valid_pixels(raster, block_win):
+    """
+    Returns the (pixels, bands) matrix of the non-NODATA, non-NaN pixels of a
+    block of a raster.
+    """
+    array = np.atleast_3d(raster.array_from_bands(block_win=block_win,
+                                                  mask_nodata=False))
+    pixels = array.reshape((-1, raster.count)).astype(np.float64)
+    return pixels[_valid_mask(pixels, raster.nodata_value)]
+
+def kmeans_classify(raster, k, out_filename, sample_fraction=0.1,
+                    block_size=None, workers=None, seed=None,
+                    batch_size=10000):
+    """
+    Perform an unsupervised pixel-based classification of a raster with
+    mini-batch k-means.
+
+    The model is fitted on a random sample of blocks: the valid pixels of
+    sampled blocks are buffered until there are at least max(k, batch_size)
+    of them, then the whole buffer is given to one partial_fit() call of the
+    mini-batch k-means. Then every block is assigned to clusters
+    (in parallel if wanted, cf. classify_raster()). Clusters are numbered
+    from 1 to k, 0 being the class of NODATA pixels.
+
+    The table of centroids is also written as a CSV file, with the same name
+    as the output image and a '_centroids.csv' suffix.
+
+    :param raster: The Raster object to classify.
+    :param k: The number of clusters.
+    :param out_filename: Name of the cluster image to be written.
+    :param sample_fraction: Proportion of the blocks used to fit the model.
+                            Default value is 0.1.
+    :param block_size: Size (xsize, ysize) of the blocks. By default, the
+                       natural block size of the raster is used.
+    :param workers: Number of processes used to assign clusters. By default,
+                    everything is done in the current process.
+    :param seed: Seed of the random generator, to get reproducible results.
+    :param batch_size: Minimum number of pixels buffered before each
+                       partial_fit() call. Mini-batches are made of whole
+                       blocks, so they are usually larger (and the last one
+                       may be smaller).
+    :returns:
+            out_raster: The cluster raster.
+
+            centroids: The k*d array of centroids, d being the number of
+                       bands.
+    """
+    rng = np.random.RandomState(seed)
+    kmeans = cluster.MiniBatchKMeans(n_clusters=k, random_state=seed)
+
+    #Fit on a sample of blocks, feeding mini-batches of at least k pixels
+    block_wins = list(raster.block_windows(block_size=block_size))
+    sampled = rng.random_sample(len(block_wins)) < sample_fraction
+    if not sampled.any():
+        sampled[rng.randint(len(block_wins))] = True
+    buffered = []
+    for block_win, is_sampled in zip(block_wins, sampled):
+        if not is_sampled:
+            continue
+        buffered.append(_valid_pixels(raster, block_win))
+        if sum(len(pixels) for pixels in buffered) >= max(k, batch_size):
+            kmeans.partial_fit(np.concatenate(buffered))
+            buffered = []
+    if buffered and (hasattr(kmeans, 'cluster_centers_')
+                     or sum(len(pixels) for pixels in buffered) >= k):
+        kmeans.partial_fit(np.concatenate(buffered))
+    if not hasattr(kmeans, 'cluster_centers_'):
+        raise ValueError("Not enough valid pixels in sampled blocks to fit {} "
+                         "clusters: '{:f}'".format(k, raster))
+
+    #Assign each block to clusters
+    out_raster = classify_raster(raster, _ClusterModel(kmeans), out_filename,
+                                 block_size=block_size, workers=workers)
+
+    #Save the centroids table
+    centroids = kmeans.cluster_centers_
+    with open('{}_centroids.csv'.format(os.path.splitext(out_filename)[0]),
+              'w') as table_file:
+        table_file.write('cluster,{}\n'.format(
+            ','.join('band{}'.format(i + 1)
+                     for i in range(centroids.shape[1]))))
+        for i, centroid in enumerate(centroids):
+            table_file.write('{},{}\n'.format(
+                i + 1, ','.join(repr(float(value)) for value in centroid)))
+
+    return out_raster, centroids
+
+def _confusion_block(task):
+    """
+    Compute the confusion matrix of one block of a classification image
+    against a reference image.
+
+    :param task: The filenames of the classification and reference images,
+                 the block window and the value of pixels to ignore.
+    :returns: The sorted classes found in the block and the confusion matrix
+              (reference classes in rows, predicted classes in columns).
+    """
+    classified_filename, reference_filename, block_win, nodata = task
+    classified = Raster(classified_filename)
+    predicted = classified.array_from_bands(1, block_win=block_win,
+                                            mask_nodata=False).ravel()
+    reference = Raster(reference_filename).array_from_bands(
+        1, block_win=block_win, mask_nodata=False).ravel()
+    valid = reference != nodata
+    if classified.nodata_value is not None:
+        valid &= predicted != classified.nodata_value
+    predicted, reference = predicted[valid], reference[valid]
+
+    classes = np.union1d(np.unique(reference), np.unique(predicted))
+    n = len(classes)
+    codes = np.searchsorted(classes, reference) * n \
+        + np.searchsorted(classes, predicted)
+    return classes, np.bincount(codes, minlength=n * n).reshape((n, n))
+
+def _merge_confusion(confusion_a, confusion_b):
+    """
+    Merge two confusion matrices computed on different classes.
+
+    :param confusion_a: The sorted classes and the confusion matrix.
+    :param confusion_b: The sorted classes and the confusion matrix.
+    :returns: The sorted union of classes and the sum of both matrices.
+    """
+    (classes_a, cm_a), (classes_b, cm_b) = confusion_a, confusion_b
+    classes = np.union1d(classes_a, classes_b)
+    cm = np.zeros((len(classes), len(classes)), dtype=np.int64)
+    for classes_i, cm_i in ((classes_a, cm_a), (classes_b, cm_b)):
+        idx = np.searchsorted(classes, classes_i)
+        cm[np.ix_(idx, idx)] += cm_i
+    return classes, cm
+
+def assess_accuracy(classified_raster, reference_raster, nodata=None,
+                    workers=None, block_size=None):
+    """
+    Assess the accuracy of a classification image against a reference
+    (validation) image of the same size, without loading them in memory.
+
+    A confusion matrix is accumulated block by block, optionally in parallel,
+    then the main accuracy metrics are derived from it.
+
+    :param classified_raster: The classification Raster object.
+    :param reference_raster: The reference Raster object.
+    :param nodata: Value of the pixels of the reference image to ignore. By
+                   default, the NODATA value of the reference image, or 0 if
+                   there is none. Pixels with the NODATA value of the
+                   classification image are also ignored.
+    :param workers: Number of processes to use. By default, everything is done
+                    in the current process.
+    :param block_size: Size (xsize, ysize) of the blocks to read. By default,
+                       the natural block size of the reference image is used.
+    :returns: A dictionary with the following keys:
+            classes: The sorted classes, of the data type of the images.
+
+            confusion_matrix: The confusion matrix, with reference classes in
+                              rows and predicted classes in columns.
+
+            overall_accuracy: The proportion of correctly classified pixels.
+
+            kappa: The Cohen's kappa coefficient.
+
+            precision: The precision (user's accuracy) of each class.
+
+            recall: The recall (producer's accuracy) of each class.
+    """
+    _check_same_size(classified_raster, reference_raster)
+    if nodata is None:
+        nodata = reference_raster.nodata_value \
+            if reference_raster.nodata_value is not None \
+            else 0
+
+    #Accumulate the confusion matrix block by block
+    tasks = ((classified_raster.filename, reference_raster.filename,
+              block_win, nodata)
+             for block_win in reference_raster.block_windows(
+                 block_size=block_size))
+    classes = np.empty(0, dtype=np.result_type(
+        classified_raster.dtype.numpy_dtype,
+        reference_raster.dtype.numpy_dtype))
+    cm = np.zeros((0, 0), dtype=np.int64)
+    for confusion in _pool_imap(_confusion_block, tasks, workers):
+        classes, cm = _merge_confusion((classes, cm), confusion)
+
+    #Derive the metrics
+    total = float(cm.sum())
+    true_totals = cm.sum(axis=1)
+    predicted_totals = cm.sum(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        overall_accuracy = np.trace(cm) / total
+        expected = (true_totals * predicted_totals).sum() / total ** 2
+        kappa = (overall_accuracy - expected) / (1 - expected)
+        precision = np.diag(cm) / predicted_totals.astype(np.float64)
+        recall = np.diag(cm) / true_totals.astype(np.float64)
+
+    return {'classes': classes,
+            'confusion_matrix': cm,
+            'overall_accuracy': overall_accuracy,
+            'kappa': kappa,
+            'precision': precision,
+            'recall': recall}
 
 def pred_error_metrics(Y_predict, Y_test, target_names = None):
     """This function calcul the main classification metrics and compute and 
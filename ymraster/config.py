@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+
+"""The `config` module sets the resources used by the Orfeo Toolbox
+applications and the GDAL datasets created by the library: available RAM of
+OTB applications, number of threads and GDAL block cache.
+
+Default values are read from environment variables when the module is
+imported:
+
+    * `YMRASTER_OTB_RAM`: RAM available to each OTB application, in MB,
+    * `YMRASTER_THREADS`: number of threads of OTB (ITK) applications,
+    * `YMRASTER_GDAL_CACHEMAX`: size of the GDAL block cache, in MB,
+    * `YMRASTER_GDAL_NUM_THREADS`: number of threads used by GDAL to compress
+      and decompress (eg. 4 or ALL_CPUS).
+
+They can be changed with `configure`, or temporarily with the `resources`
+context manager::
+
+    with config.resources(otb_ram=4096, threads=8):
+        raster.lsms_segmentation(...)
+"""
+
+try:
+    import otbApplication as otb
+except ImportError as e:
+    raise ImportError(
+        str(e)
+        + "\n\nPlease install Orfeo Toolbox if it isn't installed yet.\n\n"
+        "Also, add the otbApplication module path "
+        "(usually something like '/usr/lib/otb/python') "
+        "to the PYTHONPATH environment variable.")
+try:
+    from osgeo import gdal
+except ImportError as e:
+    raise ImportError(
+        str(e) + "\n\nPlease install GDAL.")
+
+from contextlib import contextmanager
+import os
+
+
+# Environment variable read by ITK to get its default number of threads
+ITK_THREADS_VAR = 'ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS'
+
+# Environment variable giving the default value of each setting
+_ENV_VARS = {'otb_ram': 'YMRASTER_OTB_RAM',
+             'threads': 'YMRASTER_THREADS',
+             'gdal_cache_max': 'YMRASTER_GDAL_CACHEMAX',
+             'gdal_num_threads': 'YMRASTER_GDAL_NUM_THREADS'}
+
+# Current settings (None means that the OTB or GDAL default is used)
+_settings = dict((name, None) for name in _ENV_VARS)
+
+
+def _from_env(name):
+    """Returns the value of a setting given by its environment variable, or
+    None."""
+    value = os.environ.get(_ENV_VARS[name])
+    if not value:
+        return None
+    if name == 'gdal_num_threads' and value.upper() == 'ALL_CPUS':
+        return 'ALL_CPUS'
+    return int(value)
+
+
+def get(name):
+    """Returns the current value of a setting.
+
+    Parameters
+    ----------
+    name : str
+        name of the setting: otb_ram, threads, gdal_cache_max or
+        gdal_num_threads.
+
+    Returns
+    -------
+    int, str or None
+        value of the setting, or None if the OTB or GDAL default is used.
+    """
+    return _settings[name]
+
+
+def configure(**settings):
+    """Changes settings and applies them. Settings which are not given are
+    left unchanged.
+
+    The number of threads of OTB applications is read by ITK when the first
+    application of a process runs, so it should be set before (for example,
+    before a pool of worker processes is started).
+
+    Parameters
+    ----------
+    otb_ram : int, optional
+        RAM available to each OTB application, in MB.
+    threads : int, optional
+        number of threads of OTB applications.
+    gdal_cache_max : int, optional
+        size of the GDAL block cache, in MB.
+    gdal_num_threads : int or str, optional
+        number of threads used by GDAL to compress and decompress blocks, or
+        'ALL_CPUS'.
+    """
+    for name in settings:
+        if name not in _settings:
+            raise ValueError("Unknown setting: {}".format(name))
+    _settings.update(settings)
+    if _settings['threads']:
+        os.environ[ITK_THREADS_VAR] = str(_settings['threads'])
+    if _settings['gdal_cache_max']:
+        gdal.SetCacheMax(_settings['gdal_cache_max'] * 1024 * 1024)
+    if _settings['gdal_num_threads']:
+        gdal.SetConfigOption('GDAL_NUM_THREADS',
+                             str(_settings['gdal_num_threads']))
+
+
+@contextmanager
+def resources(**settings):
+    """Context manager changing settings (see `configure`) inside a `with`
+    block, and restoring previous settings at the end."""
+    previous = dict(_settings)
+    previous_threads = os.environ.get(ITK_THREADS_VAR)
+    previous_cache_max = gdal.GetCacheMax()
+    previous_num_threads = gdal.GetConfigOption('GDAL_NUM_THREADS')
+    configure(**settings)
+    try:
+        yield
+    finally:
+        _settings.update(previous)
+        if previous_threads is None:
+            os.environ.pop(ITK_THREADS_VAR, None)
+        else:
+            os.environ[ITK_THREADS_VAR] = previous_threads
+        gdal.SetCacheMax(previous_cache_max)
+        gdal.SetConfigOption('GDAL_NUM_THREADS', previous_num_threads)
+
+
+def create_app(name):
+    """Returns a new OTB application, whose available RAM is set according
+    to the current settings.
+
+    Parameters
+    ----------
+    name : str
+        name of the application (eg. 'BandMath').
+
+    Returns
+    -------
+    otbApplication.Application
+    """
+    app = otb.Registry.CreateApplication(name)
+    if _settings['otb_ram'] and 'ram' in app.GetParametersKeys():
+        app.SetParameterInt('ram', _settings['otb_ram'])
+    return app
+
+
+configure(**dict((name, _from_env(name)) for name in _ENV_VARS))
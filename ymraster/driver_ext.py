@@ -17,7 +17,8 @@ class DriverExt(GenericDriverExt):
     """Class to map gdal.Driver instance with filename extensions"""
 
     drivername_map = {'.tif': 'GTiff',
-                      '.h5': 'HDF5'}
+                      '.h5': 'HDF5',
+                      '.vrt': 'VRT'}
 
     __slots__ = ()
 
@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+
+"""The `workspace` module provides scratch workspaces for the intermediate
+files written by raster operations.
+"""
+
+try:
+    from osgeo import gdal
+except ImportError as e:
+    raise ImportError(
+        str(e) + "\n\nPlease install GDAL.")
+
+import os
+import shutil
+import tempfile
+import uuid
+
+
+# Directory of the RAM disk used by tmpfs-backed workspaces, if available
+TMPFS_DIR = '/dev/shm'
+
+
+class Workspace(object):
+    """Scratch workspace giving unique paths to intermediate files.
+
+    Each workspace is a directory of its own, so that several jobs running
+    on the same machine never write the same scratch files. It can be backed
+    by:
+
+        * `disk`: a directory in the default temporary folder (or in the given
+          directory),
+        * `tmpfs`: a directory on a RAM disk (`/dev/shm`), if available,
+        * `vsimem`: GDAL in-memory files (`/vsimem/`), which can only be read
+          and written by GDAL, not by Orfeo Toolbox applications.
+
+    All files of the workspace are removed by `cleanup`, which is called when
+    leaving a `with` block. A maximum size can be given: `check_size` then
+    raises an error if the files of the workspace (and of its subspaces)
+    grow bigger.
+    """
+
+    def __init__(self, directory=None, backing='disk', max_bytes=None,
+                 parent=None):
+        """Create a new `Workspace` instance, and its directory.
+
+        Parameters
+        ----------
+        directory : str, optional
+            Folder in which to create the workspace directory. By default, the
+            default temporary folder (or the RAM disk for `tmpfs` backing).
+        backing : str, optional
+            `disk` (default), `tmpfs` or `vsimem`.
+        max_bytes : int, optional
+            Maximum size of the workspace, in bytes. By default, the size is
+            not bounded.
+        parent : `Workspace`, optional
+            Workspace this one is a subspace of (see `subspace`).
+        """
+        if backing not in ('disk', 'tmpfs', 'vsimem'):
+            raise ValueError("Unknown workspace backing: {}".format(backing))
+        if backing == 'tmpfs' and not directory and not os.path.isdir(
+                TMPFS_DIR):
+            backing = 'disk'
+        self.backing = backing
+        self.max_bytes = max_bytes
+        self.parent = parent
+        self.subspaces = []
+        self._names = set()
+        if backing == 'vsimem':
+            self.root = '/vsimem/ymraster_{}'.format(uuid.uuid4().hex)
+        else:
+            if not directory:
+                directory = TMPFS_DIR \
+                    if backing == 'tmpfs' \
+                    else tempfile.gettempdir()
+            self.root = tempfile.mkdtemp(prefix='ymraster_', dir=directory)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.cleanup()
+
+    def __repr__(self):
+        return "{}('{}')".format(self.__class__.__name__, self.root)
+
+    def path(self, filename):
+        """Returns a unique path in the workspace for the given filename. If
+        the filename has already been asked for, a number is appended to it.
+
+        Parameters
+        ----------
+        filename : str
+            Wanted filename (eg. 'concat.tif').
+
+        Returns
+        -------
+        str
+        """
+        base, ext = os.path.splitext(os.path.basename(filename))
+        name = base + ext
+        i = 1
+        while name in self._names:
+            name = '{}_{}{}'.format(base, i, ext)
+            i += 1
+        self._names.add(name)
+        return '{}/{}'.format(self.root, name)
+
+    def subspace(self, gdal_only=False):
+        """Returns a new workspace nested in this one, sharing its backing and
+        its maximum size. Its files are removed by its own `cleanup`.
+
+        Parameters
+        ----------
+        gdal_only : bool, optional
+            If False (default), the files of the subspace may be written by
+            Orfeo Toolbox applications: a `vsimem` workspace then gives a
+            `tmpfs` subspace.
+
+        Returns
+        -------
+        `Workspace`
+        """
+        if self.backing == 'vsimem' and not gdal_only:
+            workspace = Workspace(backing='tmpfs', parent=self)
+        elif self.backing == 'vsimem':
+            workspace = Workspace(backing='vsimem', parent=self)
+        else:
+            workspace = Workspace(directory=self.root, backing=self.backing,
+                                  parent=self)
+        self.subspaces.append(workspace)
+        return workspace
+
+    def _own_files(self):
+        """Yields the paths of all files in the workspace directory."""
+        if self.backing == 'vsimem':
+            for name in gdal.ReadDirRecursive(self.root) or []:
+                if not name.endswith('/'):  # Skip directories
+                    yield '{}/{}'.format(self.root, name)
+        else:
+            for dirpath, _, filenames in os.walk(self.root):
+                for filename in filenames:
+                    yield os.path.join(dirpath, filename)
+
+    def size(self):
+        """Returns the total size in bytes of the files of the workspace and
+        of its subspaces.
+
+        Returns
+        -------
+        int
+        """
+        total = 0
+        for path in self._own_files():
+            stat = gdal.VSIStatL(path)
+            if stat is not None:
+                total += stat.size
+        for workspace in self.subspaces:
+            if not workspace.root.startswith(self.root + '/'):
+                total += workspace.size()
+        return total
+
+    def check_size(self):
+        """Raises an IOError if this workspace, or a workspace it is nested
+        in, is bigger than its maximum size."""
+        workspace = self
+        while workspace is not None:
+            if workspace.max_bytes is not None \
+                    and workspace.size() > workspace.max_bytes:
+                raise IOError(
+                    "Workspace is bigger than {} bytes: '{}'".format(
+                        workspace.max_bytes, workspace.root))
+            workspace = workspace.parent
+
+    def move(self, path, out_filename):
+        """Moves a file of the workspace to the given path, out of the
+        workspace.
+
+        Parameters
+        ----------
+        path : str
+            Path of the file in the workspace.
+        out_filename : str
+            Destination path.
+        """
+        if path.startswith('/vsimem/'):
+            f = gdal.VSIFOpenL(path, 'rb')
+            data = gdal.VSIFReadL(1, gdal.VSIStatL(path).size, f)
+            gdal.VSIFCloseL(f)
+            with open(out_filename, 'wb') as out_file:
+                out_file.write(data)
+            gdal.Unlink(path)
+        else:
+            shutil.copy(path, out_filename)
+            os.remove(path)
+
+    def cleanup(self):
+        """Removes all files of the workspace and of its subspaces. This can
+        be called several times."""
+        for workspace in self.subspaces:
+            workspace.cleanup()
+        if self.backing == 'vsimem':
+            for path in list(self._own_files()):
+                gdal.Unlink(path)
+        elif os.path.isdir(self.root):
+            shutil.rmtree(self.root, ignore_errors=True)
@@ -24,7 +24,7 @@ except AttributeError:
         "(usually something like '/usr/lib/otb/applications') ")
 
 try:
-    from osgeo import osr, gdal
+    from osgeo import ogr, osr, gdal
     gdal.UseExceptions()
 except ImportError as e:
     raise ImportError(
@@ -40,15 +40,22 @@ except ImportError as e:
 from raster_dtype import RasterDataType
 from driver_ext import DriverExt
 import array_stat
+import config
+from cache import StageCache
+from workspace import Workspace
 
 from fix_proj_decorator import fix_missing_proj
 
-from collections import Sized
+from collections import Sized, namedtuple
 from datetime import datetime
-from time import mktime
+from itertools import product
+from multiprocessing import Pool, cpu_count
+from time import mktime, time
+import math
 import os
 import shutil
-from tempfile import gettempdir
+import warnings
+from xml.sax.saxutils import escape
 
 
 def _dt2float(dt):
@@ -61,6 +68,66 @@ def _dt2float(dt):
     return mktime(dt.timetuple())
 
 
+def _pool_map(func, tasks, workers=None):
+    """Returns the list of results of the given function applied to each
+    task, in order.
+
+    If more than one worker is wanted, tasks are distributed over a pool of
+    processes. The function must then be defined at module level, so that it
+    can be pickled.
+
+    :param func: function to apply to each task
+    :type func: function
+    :param tasks: tasks to process
+    :type tasks: list
+    :param workers: number of processes to use (default: current process only)
+    :type workers: int
+    :rtype: list
+    """
+    if not workers or workers < 2 or len(tasks) < 2:
+        return [func(task) for task in tasks]
+    pool = Pool(processes=min(workers, len(tasks)))
+    try:
+        return pool.map(func, tasks)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _pool_imap(func, tasks, workers=None, initializer=None, initargs=()):
+    """Yields the results of the given function applied to each task, in
+    order, as soon as they are available.
+
+    Unlike `_pool_map`, results are not gathered in a list, so that they can
+    be processed (eg. written) one by one.
+
+    :param func: function to apply to each task
+    :type func: function
+    :param tasks: tasks to process
+    :type tasks: iterable
+    :param workers: number of processes to use (default: current process only)
+    :type workers: int
+    :param initializer: function called with `initargs` in each process
+                        (or once in the current process) before any task
+    :type initializer: function
+    :param initargs: arguments of the initializer
+    :type initargs: tuple
+    """
+    if not workers or workers < 2:
+        if initializer:
+            initializer(*initargs)
+        for task in tasks:
+            yield func(task)
+        return
+    pool = Pool(processes=workers, initializer=initializer, initargs=initargs)
+    try:
+        for result in pool.imap(func, tasks):
+            yield result
+    finally:
+        pool.close()
+        pool.join()
+
+
 def write_file(out_filename, array=None, overwrite=False,
                xoffset=0, yoffset=0, band_idx=1, **kw):
     """Writes a NumPy array to an image file.
@@ -177,50 +244,163 @@ def concatenate_rasters(*rasters, **kw):
     Finally, if data types are different, then everything will be converted to
     the default data type in OTB (_float_ currently).
 
-    :param rasters: the rasters to concatenate
-    :type rasters: list of `Raster` instances
+    :param rasters: the rasters to concatenate. They can also be lazy
+                    `OtbImage` outputs, which are connected in memory.
+    :type rasters: list of `Raster` or `OtbImage` instances
     :param out_filename: path to the output file. If omitted, the append all
-                         rasters into the first one given
+                         rasters into the first one given, or, if `virtual`
+                         is True, the VRT file is written in the current
+                         directory, with the name of the first raster and a
+                         `_concat.vrt` suffix
     :type out_filename: str to the output file
+    :param lazy: if True, nothing is written and the concatenation is
+                 returned as an `OtbImage`, to be chained with other
+                 operations (default: False)
+    :type lazy: bool
+    :param workspace: workspace for scratch files (default: a new one in the
+                      temporary folder)
+    :type workspace: `Workspace`
+    :param virtual: if True, the output is a VRT file stacking the bands of
+                    the rasters, without copying any pixel (default: False).
+                    Its bands have the narrowest data type able to hold all
+                    input data types. It can be written later with
+                    `Raster.materialize`
+    :type virtual: bool
+    :returns: the concatenated raster (always returned if `virtual` is True),
+              or None if the first raster is overwritten
+    :rtype: `Raster`, `OtbImage` or None
     """
     # Check for proj, extent & type (and that list not empty)
     rasters = list(rasters)
     raster0 = rasters[0]
-    srs, extent, otb_dtype = (raster0.srs,
-                              raster0.gdal_extent,
-                              raster0.dtype.otb_dtype)
+    srs = raster0.srs
+    dtype = raster0.dtype
     assert srs, \
         "Image has no Coordinate Reference System: '{:f}'".format(raster0)
     same_type = True
     for raster in rasters:
         assert raster.srs \
             and raster.srs.IsSame(srs), \
-            "Images have not the same Coordinate Reference System: "
-        "'{:f}' and '{:f}'".format(raster0, raster)
-        assert raster.gdal_extent == extent, \
-            "Images have not the same extent: "
-        "'{:f}' and '{:f}'".format(raster0, raster)
-        if raster.dtype.otb_dtype != otb_dtype:
+            "Images have not the same Coordinate Reference System: " \
+            "'{:f}' and '{:f}'".format(raster0, raster)
+        if isinstance(raster, Raster) and isinstance(raster0, Raster):
+            assert raster.gdal_extent == raster0.gdal_extent, \
+                "Images have not the same extent: " \
+                "'{:f}' and '{:f}'".format(raster0, raster)
+        if raster.dtype is None or dtype is None \
+                or raster.dtype.otb_dtype != dtype.otb_dtype:
             same_type = False
 
-    # Out file
-    out_filename = kw['out_filename'] \
-        if kw.get('out_filename') \
-        else os.path.join(gettempdir(), 'concat.tif')
-
-    # Perform the concatenation
-    filenames = [raster.filename for raster in rasters]
-    ConcatenateImages = otb.Registry.CreateApplication("ConcatenateImages")
-    ConcatenateImages.SetParameterStringList("il", filenames)
-    ConcatenateImages.SetParameterString("out", out_filename)
-    if same_type:
-        ConcatenateImages.SetParameterOutputImagePixelType("out", otb_dtype)
-    ConcatenateImages.ExecuteAndWriteOutput()
+    # Virtual concatenation
+    if kw.get('virtual'):
+        assert all(isinstance(raster, Raster) for raster in rasters), \
+            "Only rasters read from files can be concatenated virtually"
+        out_filename = kw['out_filename'] \
+            if kw.get('out_filename') \
+            else '{:b}_concat.vrt'.format(raster0)
+        vrt_ds = _write_vrt(out_filename,
+                            [(raster, i)
+                             for raster in rasters
+                             for i in range(1, raster.count + 1)],
+                            dtype=_common_dtype(rasters))
+        vrt_ds = None
+        return Raster(out_filename)
 
-    # Overwrite if needed
-    if not kw.get('out_filename'):
-        shutil.copy(out_filename, raster0.filename)
-        os.remove(out_filename)
+    # Perform the concatenation, in memory
+    image = OtbImage(_concatenate_app(rasters),
+                     sum(raster.count for raster in rasters),
+                     inputs=rasters,
+                     name='{:b}_concat'.format(raster0),
+                     date_time=raster0.date_time,
+                     srs=srs,
+                     dtype=dtype if same_type else None)
+    if kw.get('lazy'):
+        return image
+
+    # Write the out file, or overwrite the first raster
+    if kw.get('out_filename'):
+        return image.write(kw['out_filename'])
+    with _scratch(kw) as workspace:
+        out_filename = workspace.path('concat.tif')
+        image.write(out_filename)
+        workspace.check_size()
+        workspace.move(out_filename, raster0.filename)
+
+
+def apply_mask(mask_raster, *rasters, **kw):
+    """Apply a mask to one or more rasters: set all masked pixels to a given
+    value, which is then set as the NODATA value of the outputs.
+
+    This is done in a single pass: each block of the mask is read once and
+    applied to every band of every raster. All rasters should have the same
+    extent as the mask.
+
+    :param mask_raster: mask to apply
+    :type mask_raster: `Raster`
+    :param rasters: rasters to mask
+    :type rasters: list of `Raster` instances
+    :param mask_value: value of "masked" pixels in the mask (default: 1)
+    :type mask_value: float
+    :param set_value: value to set to the "masked" pixels in the rasters. If
+                      omitted, the maximum value of the data type of each
+                      raster is chosen
+    :type set_value: float
+    :param out_filenames: paths to the output file of each raster. If omitted,
+                          rasters are masked in place
+    :type out_filenames: list of str
+    :param block_size: size (xsize, ysize) of the blocks to process. By
+                       default, the natural block size of the first raster is
+                       used
+    :type block_size: tuple of int
+    :returns: the masked rasters
+    :rtype: list of `Raster`
+    """
+    rasters = list(rasters)
+    for raster in rasters:
+        assert raster.has_same_extent(mask_raster), \
+            "Images have not the same extent: '{:f}' and '{:f}'".format(
+                raster, mask_raster)
+    mask_value = kw['mask_value'] \
+        if kw.get('mask_value') is not None \
+        else 1
+    set_values = [kw['set_value']
+                  if kw.get('set_value') is not None
+                  else _default_mask_value(raster.dtype)
+                  for raster in rasters]
+
+    # Output files: empty copies of the rasters, or the rasters themselves
+    in_place = not kw.get('out_filenames')
+    if in_place:
+        out_filenames = [raster.filename for raster in rasters]
+    else:
+        out_filenames = list(kw['out_filenames'])
+        if len(out_filenames) != len(rasters):
+            raise ValueError("One output filename per raster is needed")
+        for raster, out_filename in zip(rasters, out_filenames):
+            write_file(out_filename, overwrite=True, **raster.meta)
+
+    # Read each block of the mask once and apply it to all rasters
+    for block_win in rasters[0].block_windows(
+            block_size=kw.get('block_size')):
+        masked = mask_raster.array_from_bands(
+            1, block_win=block_win, mask_nodata=False) == mask_value
+        if in_place and not masked.any():
+            continue
+        for raster, out_filename, set_value in zip(rasters, out_filenames,
+                                                   set_values):
+            array = raster.array_from_bands(block_win=block_win,
+                                            mask_nodata=False)
+            array[masked] = set_value
+            write_file(out_filename, array=array,
+                       xoffset=block_win[0], yoffset=block_win[1])
+
+    # Indicate the NODATA value
+    out_rasters = []
+    for out_filename, set_value in zip(out_filenames, set_values):
+        out_raster = Raster(out_filename)
+        out_raster.nodata_value = set_value
+        out_rasters.append(out_raster)
+    return out_rasters
 
 
 def temporal_stats(*rasters, **kw):
@@ -316,6 +496,672 @@ def temporal_stats(*rasters, **kw):
                    xoffset=xoffset, yoffset=yoffset)
 
 
+# Number of blocks whose distinct labels are gathered before being merged
+_LABEL_MERGE_BLOCKS = 64
+
+
+def _distinct_labels(label_raster):
+    """Returns the sorted distinct labels of a label raster, read block by
+    block.
+
+    The distinct labels of blocks are merged by batches of blocks, so that
+    the labels already seen are not sorted again for each block.
+
+    :param label_raster: raster of labels
+    :type label_raster: `Raster`
+    :rtype: numpy.ndarray
+    """
+    parts = [np.empty(0, dtype=label_raster.dtype.numpy_dtype)]
+    for block_win in label_raster.block_windows():
+        parts.append(np.unique(label_raster.array_from_bands(
+            1, block_win=block_win, mask_nodata=False)))
+        if len(parts) > _LABEL_MERGE_BLOCKS:
+            parts = [np.unique(np.concatenate(parts))]
+    return np.unique(np.concatenate(parts))
+
+
+def relabel(label_raster, out_filename):
+    """Write a label raster where labels are replaced by dense ids, from 0 to
+    N-1 (N being the number of distinct labels), in the order of labels.
+
+    This is done block by block, in two passes: first collect the distinct
+    labels, then replace them using a lookup table. The output raster is of
+    type uint32. The number of labels is saved in its metadata (see
+    `Raster.dense_label_count`), and the table giving the original label of
+    each id is written alongside, in a CSV file with the same name as the
+    output raster and a `_labels.csv` suffix.
+
+    :param label_raster: raster of labels, eg. as returned by a LSMS
+                         segmentation
+    :type label_raster: `Raster`
+    :param out_filename: path to the output raster
+    :type out_filename: str
+    :returns: the raster of dense ids
+    :rtype: `Raster`
+    """
+    # First pass: collect distinct labels
+    labels = _distinct_labels(label_raster)
+
+    # Lookup table: direct indexing if labels are small enough integers, else
+    # a binary search in the sorted labels
+    direct = len(labels) > 0 \
+        and np.issubdtype(labels.dtype, np.integer) \
+        and labels[0] >= 0 \
+        and labels[-1] < 4 * len(labels) + 2 ** 16
+    if direct:
+        table = np.zeros(int(labels[-1]) + 1, dtype=np.uint32)
+        table[labels] = np.arange(len(labels), dtype=np.uint32)
+
+    # Second pass: replace labels by ids
+    meta = label_raster.meta
+    meta['count'] = 1
+    meta['dtype'] = RasterDataType(numpy_dtype=np.uint32)
+    write_file(out_filename, overwrite=True, **meta)
+    for block_win in label_raster.block_windows():
+        array = label_raster.array_from_bands(1, block_win=block_win,
+                                              mask_nodata=False)
+        ids = table[array] \
+            if direct \
+            else np.searchsorted(labels, array).astype(np.uint32)
+        write_file(out_filename, array=ids,
+                   xoffset=block_win[0], yoffset=block_win[1])
+
+    # Save the number of labels and the table of original labels
+    ds = gdal.Open(out_filename, gdal.GA_Update)
+    ds.SetMetadataItem('DENSE_LABEL_COUNT', str(len(labels)), 'YMRASTER')
+    ds = None
+    with open('{}_labels.csv'.format(os.path.splitext(out_filename)[0]),
+              'w') as table_file:
+        table_file.write('id,label\n')
+        for i, label in enumerate(labels):
+            table_file.write('{},{}\n'.format(i, label))
+
+    return Raster(out_filename)
+
+
+# Rough model of the memory used by OTB LSMS applications for each pixel of
+# a tile: each band is processed as float32 (or wider), plus the 2 bands of
+# the spatial image and the label, and each buffer exists both in the input
+# and in the output of the pipeline
+_LSMS_MIN_ITEMSIZE = 4
+_LSMS_EXTRA_BYTES = 3 * 4
+_LSMS_BUFFERS = 2
+
+# OTB default of the RAM available to applications, in MB
+_OTB_DEFAULT_RAM = 256
+
+
+class LsmsTilePlan(namedtuple('LsmsTilePlan', ['tilesizex', 'tilesizey',
+                                               'tile_count', 'peak_memory'])):
+    """Tiling of a LSMS segmentation, as returned by `plan_lsms_tiles`: size
+    of the tiles, number of tiles and predicted peak memory (in MB)."""
+
+    __slots__ = ()
+
+    def __str__(self):
+        return "{} tiles of {}x{} pixels, predicted peak memory: " \
+            "{:.1f} MB".format(self.tile_count, self.tilesizex,
+                               self.tilesizey, self.peak_memory)
+
+
+def plan_lsms_tiles(raster, spatialr, memory_budget=None, count=None,
+                    block_size=None, dtype=None):
+    """Returns the size of the tiles of a LSMS segmentation (see
+    `Raster.lsms_segmentation`) such that each tile, with its margin, fits in
+    the given memory budget.
+
+    Each tile is read with a margin of `spatialr` pixels on each side, so
+    tiles are as big and as square as possible to limit the overhead of
+    margins and of stitching tiles. Their width is a multiple of the natural
+    block width of the raster, unless a tile covers the whole width.
+
+    :param raster: raster to segment (eg. the smoothed raster)
+    :type raster: `Raster`
+    :param spatialr: spatial radius of the segmentation, in pixels
+    :type spatialr: int
+    :param memory_budget: memory available for a tile, in MB (default: the
+                          `otb_ram` setting of the `config` module, else the
+                          OTB default of 256 MB)
+    :type memory_budget: int
+    :param count: number of bands processed (default: the raster's count)
+    :type count: int
+    :param block_size: size of the tiles, if already chosen: only the number
+                       of tiles and the peak memory are then predicted
+    :type block_size: tuple of int (xsize, ysize)
+    :param dtype: data type of the processed bands (default: the raster's)
+    :type dtype: `RasterDataType`
+    :returns: size of the tiles, number of tiles and predicted peak memory
+    :rtype: `LsmsTilePlan`
+    """
+    memory_budget = memory_budget \
+        if memory_budget \
+        else config.get('otb_ram') or _OTB_DEFAULT_RAM
+    count = count if count else raster.count
+    dtype = dtype if dtype else raster.dtype
+    itemsize = max(np.dtype(dtype.numpy_dtype).itemsize, _LSMS_MIN_ITEMSIZE)
+    pixel_bytes = _LSMS_BUFFERS * (count * itemsize + _LSMS_EXTRA_BYTES)
+    max_pixels = memory_budget * 1024 * 1024 // pixel_bytes
+    margin = 2 * spatialr
+
+    if block_size:
+        tilesizex, tilesizey = block_size
+    else:
+        # Square tiles, as wide as possible, aligned on natural blocks
+        side = int(math.sqrt(max_pixels)) - margin
+        if side < 1:
+            raise ValueError(
+                "Memory budget of {} MB is too small for a spatial radius of "
+                "{} pixels".format(memory_budget, spatialr))
+        tilesizex = min(side, raster.width)
+        block_width = raster.block_size[0]
+        if block_width < tilesizex < raster.width:
+            tilesizex -= tilesizex % block_width
+
+        # Narrow tiles leave room for taller tiles
+        tilesizey = min(
+            max_pixels // min(tilesizex + margin, raster.width) - margin,
+            raster.height)
+
+    tile_count = int(math.ceil(float(raster.width) / tilesizex)
+                     * math.ceil(float(raster.height) / tilesizey))
+    peak_memory = float(min(tilesizex + margin, raster.width)
+                        * min(tilesizey + margin, raster.height)
+                        * pixel_bytes) / (1024 * 1024)
+    return LsmsTilePlan(tilesizex, tilesizey, tile_count, peak_memory)
+
+
+def _cached_stage(cache, name, inputs, out_filenames, run, **params):
+    """Runs a stage of a processing chain writing some files, or reuses the
+    files written by a previous run from a stage cache.
+
+    :param cache: stage cache, or None to always run the stage
+    :type cache: `StageCache`
+    :param name: name of the stage
+    :type name: str
+    :param inputs: input rasters of the stage
+    :type inputs: list of `Raster`
+    :param out_filenames: paths to the files to write if there is no cache.
+                          In the cache, files are named after their basenames
+    :type out_filenames: list of str
+    :param run: function running the stage, called with the paths to the
+                files to write
+    :type run: function
+    :param params: parameters of the stage
+    :returns: paths to the written files
+    :rtype: list of str
+    """
+    if cache is None:
+        run(*out_filenames)
+        return out_filenames
+    basenames = [os.path.basename(filename) for filename in out_filenames]
+
+    def compute(directory):
+        run(*[os.path.join(directory, basename) for basename in basenames])
+
+    entry_dir = cache.fetch(name, [raster.filename for raster in inputs],
+                            compute, **params)
+    return [os.path.join(entry_dir, basename) for basename in basenames]
+
+
+# Parameters of the smoothing step of a LSMS segmentation, with their default
+# values: runs of a sweep with the same ones share the smoothed image
+_LSMS_SMOOTHING_PARAMS = (('spatialr', None), ('ranger', None), ('thres', 0.1),
+                          ('rangeramp', 0), ('maxiter', 10))
+
+# Columns of the results table of `lsms_sweep`
+_LSMS_SWEEP_COLUMNS = ('spatialr', 'ranger', 'thres', 'rangeramp', 'maxiter',
+                       'object_minsize', 'seconds', 'object_count',
+                       'out_filename', 'out_vector_filename')
+
+
+def _lsms_sweep_task(task):
+    """Runs the LSMS segmentations of a sweep sharing the same smoothing
+    parameters, one after another so that the smoothed image is computed
+    once, and returns their rows of the results table.
+
+    This is the unit of work distributed by `lsms_sweep`.
+
+    :param task: filename of the raster, path to the stage cache directory,
+                 and list of (index, parameters, output filename, output
+                 vector filename or None) for each run
+    :type task: tuple
+    :returns: the index and the row of each run
+    :rtype: list of tuple
+    """
+    filename, cache_dir, runs = task
+    raster = Raster(filename)
+    rows = []
+    for index, params, out_filename, out_vector_filename in runs:
+        start = time()
+        raster.lsms_segmentation(out_filename=out_filename,
+                                 out_vector_filename=out_vector_filename,
+                                 cache_dir=cache_dir,
+                                 **params)
+        row = dict(_LSMS_SMOOTHING_PARAMS)
+        row.update(params)
+        row['seconds'] = time() - start
+        row['object_count'] = len(_distinct_labels(Raster(out_filename)))
+        row['out_filename'] = out_filename
+        row['out_vector_filename'] = out_vector_filename
+        rows.append((index, row))
+    return rows
+
+
+def lsms_sweep(raster, grid, out_dir, workers=None, cache_dir=None, **kw):
+    """Runs a LSMS segmentation (see `Raster.lsms_segmentation`) of a raster
+    for each combination of the given parameter values, and returns a table
+    of results: parameters, duration in seconds, number of objects and output
+    paths of each run.
+
+    Runs are distributed over a pool of processes. Runs with the same
+    smoothing parameters (`spatialr`, `ranger`, `thres`, `rangeramp` and
+    `maxiter`) are done by the same process, one after another, so that they
+    share the smoothed image through a stage cache (see `StageCache`). Each
+    process applies the current resource settings of the `config` module,
+    updated with the given `settings`: by default, when several processes
+    are used and no number of threads is set, the CPUs are shared among
+    them.
+
+    The table is also written in the output directory, in a `lsms_sweep.csv`
+    file.
+
+    :param raster: raster to segment
+    :type raster: `Raster`
+    :param grid: values of each parameter of `Raster.lsms_segmentation`, eg.
+                 ``{'spatialr': [5, 10], 'ranger': [15], 'object_minsize':
+                 [10, 50]}``. `spatialr` and `ranger` are required
+    :type grid: dict
+    :param out_dir: directory of the output label rasters (and vector files)
+    :type out_dir: str
+    :param workers: number of processes to use (default: current process
+                    only)
+    :type workers: int
+    :param cache_dir: directory of the stage cache, which is kept after the
+                      sweep (default: a scratch directory, removed at the end)
+    :type cache_dir: str
+    :param settings: resource settings of each process (see
+                     `config.configure`), eg. ``{'otb_ram': 1024}``
+    :type settings: dict
+    :param vectorize: if True, also writes a vector file of objects for each
+                      run (default: False)
+    :type vectorize: bool
+    :returns: one row per run. Runs are ordered as the combinations given
+              by `itertools.product` on the values of the parameters, sorted
+              by name: the last parameter in alphabetical order varies
+              fastest
+    :rtype: list of dict
+    """
+    if 'spatialr' not in grid or 'ranger' not in grid:
+        raise ValueError("The grid must give values of spatialr and ranger")
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    # Created once here, not by each process
+    if cache_dir and not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+
+    # Group runs by smoothing parameters
+    names = sorted(grid)
+    groups = {}
+    for index, values in enumerate(
+            product(*[grid[name] for name in names])):
+        params = dict(zip(names, values))
+        smoothing_params = tuple(params.get(name, default)
+                                 for name, default in _LSMS_SMOOTHING_PARAMS)
+        suffix = '_'.join('{}{}'.format(name, params[name])
+                          for name in names)
+        out_filename = os.path.join(
+            out_dir, '{:b}_{}.tif'.format(raster, suffix))
+        out_vector_filename = os.path.join(
+            out_dir, '{:b}_{}.shp'.format(raster, suffix)) \
+            if kw.get('vectorize') \
+            else None
+        groups.setdefault(smoothing_params, []).append(
+            (index, params, out_filename, out_vector_filename))
+
+    # Settings of each process
+    settings = dict(kw.get('settings', {}))
+    processes = min(workers, len(groups)) if workers else 1
+    if processes > 1 and not (settings.get('threads')
+                              or config.get('threads')):
+        settings['threads'] = max(1, cpu_count() // processes)
+
+    # Run groups in parallel (processes inherit the settings)
+    with Workspace() as workspace, config.resources(**settings):
+        tasks = [(raster.filename, cache_dir or workspace.root, runs)
+                 for runs in groups.values()]
+        rows = [row
+                for rows in _pool_map(_lsms_sweep_task, tasks,
+                                      workers=workers)
+                for row in rows]
+    rows = [row for _, row in sorted(rows, key=lambda item: item[0])]
+
+    # Save the results table
+    with open(os.path.join(out_dir, 'lsms_sweep.csv'), 'w') as table_file:
+        table_file.write('{}\n'.format(','.join(_LSMS_SWEEP_COLUMNS)))
+        for row in rows:
+            table_file.write('{}\n'.format(','.join(
+                '' if row.get(column) is None else str(row[column])
+                for column in _LSMS_SWEEP_COLUMNS)))
+
+    return rows
+
+
+def _label_stats_task(task):
+    """Compute label statistics on one band of a raster, or on a window of this
+    band.
+
+    This is the unit of work distributed by `Raster.label_stats`. On a window,
+    only mergeable statistics can be computed, so a `GroupAccumulator` is
+    returned. On a whole band, the unique labels and the list of arrays of
+    statistics are returned.
+
+    :param task: filename of the raster, filename of the label raster, index of
+                 the band, block window (or None for the whole band) and list
+                 of stats to compute
+    :type task: tuple
+    """
+    filename, label_filename, band_idx, block_win, stats = task
+    raster = Raster(filename)
+    label_array = Raster(label_filename).array_from_bands(
+        1, block_win=block_win, mask_nodata=False)
+    band_array = raster.array_from_bands(
+        band_idx, block_win=block_win, mask_nodata=False).astype(np.float64)
+    if raster.nodata_value is not None:
+        band_array[band_array == raster.nodata_value] = np.nan
+    if block_win:
+        return array_stat.GroupAccumulator(label_array, band_array)
+    return array_stat.grouped_stats(label_array, band_array, stats)
+
+
+def _block_pixels(raster, block_win):
+    """Returns the pixels of a block of a raster as a (pixels, bands) float64
+    matrix, where pixels having a NODATA value in any band are set to NaN,
+    and the shape (rows, cols) of the block.
+
+    :param raster: raster to read
+    :type raster: `Raster`
+    :param block_win: block window (x, y, xsize, ysize)
+    :type block_win: tuple of int
+    """
+    array = np.atleast_3d(raster.array_from_bands(
+        block_win=block_win, mask_nodata=False)).astype(np.float64)
+    pixels = array.reshape((-1, raster.count))
+    if raster.nodata_value is not None:
+        pixels[(pixels == raster.nodata_value).any(axis=1)] = np.nan
+    return pixels, array.shape[:2]
+
+
+def _covariance_task(task):
+    """Accumulate the mean and co-moments of the bands on one block of a
+    raster. This is the unit of work distributed by `Raster.pca`.
+
+    :param task: filename of the raster and block window
+    :type task: tuple
+    :rtype: `array_stat.CovarianceAccumulator`
+    """
+    filename, block_win = task
+    pixels, _ = _block_pixels(Raster(filename), block_win)
+    return array_stat.CovarianceAccumulator(pixels)
+
+
+def _linear_transform_task(task):
+    """Apply a linear transformation to the pixels of one block of a raster.
+    This is the unit of work distributed by `Raster.linear_transform`.
+
+    :param task: filename of the raster, block window, matrix and offset
+    :type task: tuple
+    :returns: the block window and the transformed block
+    :rtype: tuple
+    """
+    filename, block_win, matrix, offset = task
+    pixels, shape = _block_pixels(Raster(filename), block_win)
+    transformed = np.dot(pixels, matrix.T) + offset
+    return block_win, transformed.reshape(shape + (len(matrix),))
+
+
+def _normalized_difference(a, b):
+    """Returns (a - b) / (a + b), NaN where a + b is 0."""
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(a + b != 0, (a - b) / (a + b), np.nan)
+
+
+def _savi(nir, red):
+    """Soil Adjusted Vegetation Index, with a soil factor of 0.5. Bands are
+    reflectances in [0, 1]."""
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return 1.5 * (nir - red) / (nir + red + 0.5)
+
+
+def _evi(blue, red, nir):
+    """Enhanced Vegetation Index (MODIS coefficients). Bands are reflectances
+    in [0, 1]."""
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return 2.5 * (nir - red) / (nir + 6. * red - 7.5 * blue + 1.)
+
+
+# For each radiometric index computed by `Raster.compute_indices`, the bands
+# it needs (in the order of the arguments of its function) and its function
+_INDICES = {
+    'ndvi': (('nir', 'red'), _normalized_difference),
+    'ndwi': (('nir', 'mir'), _normalized_difference),
+    'mndwi': (('green', 'mir'), _normalized_difference),
+    'ndsi': (('green', 'mir'), _normalized_difference),
+    'savi': (('nir', 'red'), _savi),
+    'evi': (('blue', 'red', 'nir'), _evi),
+    'nbr': (('nir', 'mir2'), _normalized_difference),
+}
+
+
+def _scratch(kw, gdal_only=False):
+    """Returns a new workspace for the scratch files of an operation: a
+    subspace of the workspace given as the `workspace` keyword argument, if
+    any, else a new disk-backed workspace.
+
+    :param kw: keyword arguments of the operation
+    :type kw: dict
+    :param gdal_only: True if scratch files are only read and written by GDAL
+    :type gdal_only: bool
+    :rtype: `Workspace`
+    """
+    return kw['workspace'].subspace(gdal_only=gdal_only) \
+        if kw.get('workspace') \
+        else Workspace()
+
+
+def _common_dtype(rasters):
+    """Returns the narrowest data type to which the data types of all the
+    given rasters can be safely cast (float64 if there is none).
+
+    :param rasters: rasters
+    :type rasters: list of `Raster`
+    :rtype: `RasterDataType`
+    """
+    common = reduce(np.promote_types,
+                    [np.dtype(raster.dtype.numpy_dtype) for raster in rasters])
+    try:
+        return RasterDataType(lstr_dtype=common.name)
+    except KeyError:
+        return RasterDataType(lstr_dtype='float64')
+
+
+def _write_vrt(out_filename, band_sources, dtype=None):
+    """Creates a VRT dataset whose bands are bands of other rasters, without
+    copying any pixel. All rasters should have the same size; the
+    geo-transformation, projection and date/time of the first one are used.
+
+    :param out_filename: path to the VRT file to write, or an empty string for
+                         a VRT dataset in memory
+    :type out_filename: str
+    :param band_sources: raster and index of each band of the VRT, in order
+    :type band_sources: list of (`Raster`, int) tuples
+    :param dtype: data type of the bands of the VRT. By default, each band
+                  has the data type of its source
+    :type dtype: `RasterDataType`
+    :returns: the VRT dataset (which is written when closed)
+    :rtype: gdal.Dataset
+    """
+    raster0 = band_sources[0][0]
+    vrt_ds = gdal.GetDriverByName('VRT').Create(out_filename,
+                                                raster0.width,
+                                                raster0.height,
+                                                0)
+    if raster0.transform:
+        vrt_ds.SetGeoTransform(raster0.transform)
+    if raster0.srs:
+        vrt_ds.SetProjection(raster0.srs.ExportToWkt())
+    if raster0.date_time:
+        vrt_ds.SetMetadata({'TIFFTAG_DATETIME':
+                            raster0.date_time.strftime('%Y:%m:%d %H:%M:%S')})
+    for raster, idx in band_sources:
+        band_dtype = dtype if dtype else raster.dtype
+        vrt_ds.AddBand(band_dtype.gdal_dtype)
+        band = vrt_ds.GetRasterBand(vrt_ds.RasterCount)
+        band.SetMetadataItem(
+            'source_0',
+            '<SimpleSource>'
+            '<SourceFilename relativeToVRT="0">{}</SourceFilename>'
+            '<SourceBand>{}</SourceBand>'
+            '</SimpleSource>'.format(escape(os.path.abspath(raster.filename)),
+                                     idx),
+            'new_vrt_sources')
+        if raster.nodata_value is not None:
+            band.SetNoDataValue(raster.nodata_value)
+    return vrt_ds
+
+
+def _copy_dataset(src_ds, out_filename, profile=None):
+    """Writes a copy of a dataset (eg. a VRT dataset) in the format given by
+    the extension of the output filename. GDAL copies it block by block.
+
+    :param src_ds: dataset to copy
+    :type src_ds: gdal.Dataset
+    :param out_filename: path to the output file
+    :type out_filename: str
+    :param profile: creation options of the output driver, eg. {'compress':
+                    'LZW', 'tiled': True}
+    :type profile: dict
+    """
+    _, ext = os.path.splitext(out_filename)
+    driver = DriverExt(extension=ext).gdal_driver
+    options = []
+    for name, value in sorted((profile or {}).items()):
+        if isinstance(value, bool):
+            value = 'YES' if value else 'NO'
+        options.append('{}={}'.format(name.upper(), value))
+    out_ds = driver.CreateCopy(out_filename, src_ds, 0, options)
+    out_ds = None
+
+
+def _set_input_image(app, key, image):
+    """Sets an input image parameter of an OTB application, either from a
+    `Raster` (its file is read) or from an `OtbImage` (the output of the
+    upstream application is connected in memory).
+
+    :param app: OTB application
+    :type app: otbApplication.Application
+    :param key: key of the input image parameter (eg. 'in')
+    :type key: str
+    :param image: input image
+    :type image: `Raster` or `OtbImage`
+    """
+    if isinstance(image, OtbImage):
+        app.SetParameterInputImage(key,
+                                   image.app.GetParameterOutputImage(
+                                       image.key))
+    else:
+        app.SetParameterString(key, image.filename)
+
+
+def _add_input_images(app, key, images):
+    """Adds images to an input image list parameter of an OTB application
+    (see `_set_input_image`).
+
+    :param app: OTB application
+    :type app: otbApplication.Application
+    :param key: key of the input image list parameter (eg. 'il')
+    :type key: str
+    :param images: input images
+    :type images: list of `Raster` or `OtbImage`
+    """
+    for image in images:
+        if isinstance(image, OtbImage):
+            app.AddImageToParameterInputImageList(
+                key, image.app.GetParameterOutputImage(image.key))
+        else:
+            app.AddParameterStringList(key, image.filename)
+
+
+def _fusion_app(xs, pan):
+    """Returns a `BundleToPerfectSensor` application sharpening the given
+    multi-spectral image with the given panchromatic image."""
+    app = config.create_app("BundleToPerfectSensor")
+    _set_input_image(app, "inp", pan)
+    _set_input_image(app, "inxs", xs)
+    return app
+
+
+def _radiometric_indices_app(image, indices, **kw):
+    """Returns a `RadiometricIndices` application computing the given indices
+    of the image. Band indices are given by the `blue_idx`, `green_idx`,
+    `red_idx`, `nir_idx` and `mir_idx` keyword arguments."""
+    app = config.create_app("RadiometricIndices")
+    _set_input_image(app, "in", image)
+    for channel in ('blue', 'green', 'red', 'nir', 'mir'):
+        if kw.get('{}_idx'.format(channel)):
+            app.SetParameterInt('channels.{}'.format(channel),
+                                kw['{}_idx'.format(channel)])
+    app.SetParameterStringList("list", list(indices))
+    return app
+
+
+def _extract_bands_app(image, idxs):
+    """Returns an `ExtractROI` application keeping only the given bands of
+    the image, in the given order."""
+    app = config.create_app("ExtractROI")
+    _set_input_image(app, "in", image)
+    app.UpdateParameters()
+    app.SetParameterStringList("cl", ['Channel{}'.format(i) for i in idxs])
+    return app
+
+
+def _concatenate_app(images):
+    """Returns a `ConcatenateImages` application stacking the bands of the
+    given images, in order."""
+    app = config.create_app("ConcatenateImages")
+    _add_input_images(app, "il", images)
+    return app
+
+
+def _mask_image(image, mask_raster, mask_value, set_value):
+    """Returns an `OtbImage` where pixels of the image which are masked in the
+    mask raster are set to the given value: one `BandMath` application per
+    band, concatenated in memory."""
+    band_images = []
+    for i in range(image.count):
+        app = config.create_app("BandMath")
+        _add_input_images(app, "il", [image, mask_raster])
+        app.SetParameterString("exp", "(im2b1 == {}) ? {} : im1b{}".format(
+            mask_value, set_value, i + 1))
+        band_images.append(OtbImage(app, 1, inputs=(image, mask_raster)))
+    return OtbImage(_concatenate_app(band_images), image.count,
+                    inputs=band_images,
+                    name='{:b}_masked'.format(image),
+                    date_time=image.date_time,
+                    srs=image.srs,
+                    nodata_value=set_value,
+                    dtype=image.dtype)
+
+
+def _default_mask_value(dtype):
+    """Returns the maximum value of the given data type (float32 if unknown),
+    used as the default value of masked pixels."""
+    numpy_dtype = dtype.numpy_dtype if dtype else np.float32
+    try:
+        return np.iinfo(numpy_dtype).max
+    except ValueError:
+        return np.finfo(numpy_dtype).max
+
+
 class Raster(Sized):
     """Represents a raster image that was read from a file.
 
@@ -517,6 +1363,22 @@ class Raster(Sized):
         return extents_almost_equals == ((True, True), (True, True),
                                          (True, True), (True, True))
 
+    def dense_label_count(self):
+        """Returns the number of labels if the raster is a label raster with
+        dense ids (as written by the `relabel` function), None otherwise.
+
+        With dense ids, labels can be used directly as array indices.
+
+        Returns
+        -------
+        int or None
+            number of labels in the raster.
+        """
+        ds = gdal.Open(self._filename, gdal.GA_ReadOnly)
+        count = ds.GetMetadataItem('DENSE_LABEL_COUNT', 'YMRASTER')
+        ds = None
+        return int(count) if count is not None else None
+
     def block_windows(self, block_size=None):
         """Yield coordinates of each block in the raster, in order.
 
@@ -609,7 +1471,11 @@ class Raster(Sized):
 
         # Returned a masked array if wanted or if no indication
         if kw.get('mask_nodata') or 'mask_nodata' not in kw:
-            return ma.masked_where(array == self._nodata_value, array)
+            nodata_mask = np.isnan(array) \
+                if self._nodata_value is not None \
+                and np.isnan(self._nodata_value) \
+                else array == self._nodata_value
+            return ma.masked_where(nodata_mask, array)
         else:
             return array
 
@@ -667,57 +1533,339 @@ class Raster(Sized):
             One or more indices of the band(s) to remove (numbering starts at 1)
         out_filename : str
             Path to the output file. If omitted, then the raster is overwritten
+        virtual : bool
+            If True, the output is a VRT file referencing the kept bands (see
+            `extract_bands`). An output filename is then required.
+        workspace : `Workspace`
+            Workspace for scratch files. By default, a new one is created in
+            the temporary folder.
+        lazy : bool
+            If True, nothing is written and the result is returned as an
+            `OtbImage`, to be chained with other operations in memory.
 
         Returns
         -------
-        `Raster` or None
+        `Raster`, `OtbImage` or None
             Output raster or None if the raster is overwritten
         """
         indices = list(idxs)
 
-        # Split the N-bands image into N mono-band images (in temp folder)
-        SplitImage = otb.Registry.CreateApplication("SplitImage")
-        SplitImage.SetParameterString("in", self._filename)
-        SplitImage.SetParameterString("out", os.path.join(gettempdir(),
-                                                          'splitted.tif'))
-        SplitImage.SetParameterOutputImagePixelType(
-            "out",
-            self._dtype.otb_dtype)
-        SplitImage.ExecuteAndWriteOutput()
+        # In memory with OTB
+        if kw.get('lazy'):
+            return OtbImage(_extract_bands_app(
+                                self,
+                                [i for i in range(1, self._count + 1)
+                                 if i not in indices]),
+                            self._count - len(set(indices)),
+                            inputs=(self,),
+                            name='{:b}_bands_removed'.format(self),
+                            date_time=self._date_time,
+                            srs=self._srs,
+                            dtype=self._dtype)
+
+        # Write the out file, or overwrite the raster
+        kept_idxs = [i for i in range(1, self._count + 1) if i not in indices]
+        if kw.get('out_filename'):
+            return self.extract_bands(*kept_idxs,
+                                      out_filename=kw['out_filename'],
+                                      virtual=kw.get('virtual'))
+        if kw.get('virtual'):
+            raise ValueError("A virtual raster cannot overwrite its source")
+        with _scratch(kw, gdal_only=True) as workspace:
+            out_filename = workspace.path('bands_removed.tif')
+            self.extract_bands(*kept_idxs, out_filename=out_filename)
+            workspace.check_size()
+            workspace.move(out_filename, self._filename)
+        self.refresh()
+
+    def extract_bands(self, *idxs, **kw):
+        """Saves a new raster made of the specified bands, in the given order.
+
+        If `virtual` is True, the output is a VRT file which only references
+        the bands of the raster: no pixel is copied. Else the bands are copied
+        block by block, in a single pass, keeping the data type and the
+        compression of the raster.
+
+        Parameters
+        ----------
+        idxs : int
+            One or more indices of the band(s) to keep (numbering starts at 1)
+        out_filename : str
+            Path to the output file. If omitted, a default filename will be
+            chosen.
+        virtual : bool
+            If True, write a VRT file (default: False).
+
+        Returns
+        -------
+        `Raster`
+            Output raster.
+        """
+        for i in idxs:
+            if not 1 <= i <= self._count:
+                raise IndexError("Band index out of range: {}".format(i))
 
         # Out file
         out_filename = kw['out_filename'] \
             if kw.get('out_filename') \
-            else os.path.join(gettempdir(), 'bands_removed.tif')
-
-        # Concatenate the mono-band images without the unwanted band
-        list_path = [os.path.join(gettempdir(), 'splitted_{}.tif'.format(i))
-                     for i in range(self._count)
-                     if i + 1 not in indices]
-        ConcatenateImages = otb.Registry.CreateApplication("ConcatenateImages")
-        ConcatenateImages.SetParameterStringList("il", list_path)
-        ConcatenateImages.SetParameterString("out", out_filename)
-        ConcatenateImages.SetParameterOutputImagePixelType(
-            "out",
-            self._dtype.otb_dtype)
-        ConcatenateImages.ExecuteAndWriteOutput()
-
-        # Delete mono-band images in temp folder
-        for i in range(self._count):
-            os.remove(os.path.join(gettempdir(), 'splitted_{}.tif'.format(i)))
+            else '{:b}_bands_{}.{}'.format(self,
+                                            '_'.join(str(i) for i in idxs),
+                                            'vrt' if kw.get('virtual')
+                                            else 'tif')
+
+        # Reference the bands in a VRT, then copy it if needed
+        if kw.get('virtual'):
+            vrt_ds = _write_vrt(out_filename, [(self, i) for i in idxs])
+            vrt_ds = None
+        else:
+            ds = gdal.Open(self._filename, gdal.GA_ReadOnly)
+            compression = ds.GetMetadataItem('COMPRESSION', 'IMAGE_STRUCTURE')
+            ds = None
+            profile = {'compress': compression} \
+                if compression and out_filename.endswith('.tif') \
+                else None
+            vrt_ds = _write_vrt('', [(self, i) for i in idxs])
+            _copy_dataset(vrt_ds, out_filename, profile=profile)
+            vrt_ds = None
+
+        return Raster(out_filename)
+
+    def materialize(self, out_filename, profile=None):
+        """Writes a copy of the raster, eg. to turn a virtual (VRT) raster into
+        a real one.
+
+        The copy is made by GDAL block by block, in a single pass, and keeps
+        the data type of each band (for a virtual concatenation, the narrowest
+        common data type of its inputs).
 
-        # Overwrite if wanted else return the new Raster
-        if not kw.get('out_filename'):
-            shutil.copy(out_filename, self._filename)
-            os.remove(out_filename)
+        Parameters
+        ----------
+        out_filename : str
+            Path to the output file. Its extension gives its format.
+        profile : dict, optional
+            Creation options of the output format, eg. {'compress': 'LZW',
+            'tiled': True}.
+
+        Returns
+        -------
+        `Raster`
+            Output raster.
+        """
+        ds = gdal.Open(self._filename, gdal.GA_ReadOnly)
+        _copy_dataset(ds, out_filename, profile=profile)
+        ds = None
+        return Raster(out_filename)
+
+    def _valid_values(self, array):
+        """Returns the flattened non-NODATA, non-NaN values of an array read
+        from the raster, as float64"""
+        values = np.ravel(array).astype(np.float64)
+        valid = ~np.isnan(values)
+        if self._nodata_value is not None:
+            valid &= values != self._nodata_value
+        return values[valid]
+
+    def _sample_band_values(self, idxs, sample_fraction):
+        """Returns, for each given band, a sample of its valid values, read
+        from an overview if there is one big enough, else from a regular
+        subset of blocks."""
+        ds = gdal.Open(self._filename, gdal.GA_ReadOnly)
+        samples = []
+        for idx in idxs:
+            band = ds.GetRasterBand(idx)
+            overviews = [band.GetOverview(i)
+                         for i in range(band.GetOverviewCount())]
+            overviews = [ovr for ovr in overviews
+                         if ovr.XSize * ovr.YSize
+                         >= sample_fraction * self._width * self._height]
+            if overviews:
+                smallest = min(overviews, key=lambda ovr: ovr.XSize)
+                samples.append(self._valid_values(smallest.ReadAsArray()))
+            else:
+                samples.append(None)
+        ds = None
+
+        # Bands without overview: read one block every step blocks
+        missing = [idx for idx, sample in zip(idxs, samples) if sample is None]
+        if missing:
+            step = max(1, int(round(1. / sample_fraction)))
+            blocks = [[] for _ in missing]
+            for i, block_win in enumerate(self.block_windows()):
+                if i % step:
+                    continue
+                array = self.array_from_bands(*missing, block_win=block_win,
+                                              mask_nodata=False)
+                if array.ndim == 2:
+                    array = array[:, :, np.newaxis]
+                for j in range(len(missing)):
+                    blocks[j].append(self._valid_values(array[:, :, j]))
+            values_by_idx = dict(zip(missing,
+                                     [np.concatenate(band_blocks)
+                                      for band_blocks in blocks]))
+            samples = [values_by_idx[idx] if sample is None else sample
+                       for idx, sample in zip(idxs, samples)]
+        return samples
+
+    def band_stats(self, *idxs, **kw):
+        """Returns statistics (min, max, mean, std, count of valid values and,
+        optionally, histogram) of one or more bands.
+
+        Exact statistics are computed in one streaming pass over the blocks of
+        the raster (two passes if a histogram is wanted). Approximate
+        statistics are computed from the smallest overview having enough
+        pixels or, without overview, from a regular subset of blocks.
+
+        Results are cached as band metadata in the GDAL auxiliary file
+        (.aux.xml), along with the modification time of the raster, so that
+        they are computed again only if the raster changes. Exact statistics
+        are also used to answer approximate requests.
+
+        Parameters
+        ----------
+        idxs : int, optional
+            Indices of the bands (numbering starts at 1). By default, all bands.
+        approx : bool, optional
+            If True, compute approximate statistics. False by default.
+        sample_fraction : float, optional
+            Approximate fraction of the pixels to read in approximate mode
+            (default: 0.1).
+        histogram_bins : int, optional
+            If given, also compute a histogram with this number of bins between
+            the min and the max of the band.
+        use_cache : bool, optional
+            If False, do not read nor write cached statistics. True by default.
+
+        Returns
+        -------
+        list of dict
+            For each band, a dictionary with 'min', 'max', 'mean', 'std',
+            'count' and 'approx' keys, and a 'histogram' key (tuple of counts
+            and bin edges) if asked.
+        """
+        idxs = list(idxs) if idxs else list(range(1, self._count + 1))
+        approx = kw.get('approx', False)
+        sample_fraction = kw['sample_fraction'] \
+            if kw.get('sample_fraction') \
+            else 0.1
+        bins = kw.get('histogram_bins')
+        use_cache = kw.get('use_cache', True)
+        mtime = repr(os.path.getmtime(self._filename))
+
+        # Look for cached results
+        stats = [None] * len(idxs)
+        if use_cache:
+            ds = gdal.Open(self._filename, gdal.GA_ReadOnly)
+            for i, idx in enumerate(idxs):
+                band = ds.GetRasterBand(idx)
+                cache = band.GetMetadata('YMRASTER')
+                if cache.get('MTIME') != mtime \
+                        or (cache.get('APPROX') == 'YES' and not approx):
+                    continue
+                band_stats = {
+                    'min': float(band.GetMetadataItem('STATISTICS_MINIMUM')),
+                    'max': float(band.GetMetadataItem('STATISTICS_MAXIMUM')),
+                    'mean': float(band.GetMetadataItem('STATISTICS_MEAN')),
+                    'std': float(band.GetMetadataItem('STATISTICS_STDDEV')),
+                    'count': int(cache['COUNT']),
+                    'approx': cache['APPROX'] == 'YES'}
+                if bins:
+                    hist = band.GetDefaultHistogram(force=False)
+                    if hist is None or hist[2] != bins \
+                            or not np.allclose((hist[0], hist[1]),
+                                               (band_stats['min'],
+                                                band_stats['max'])):
+                        continue
+                    band_stats['histogram'] = (
+                        np.array(hist[3]),
+                        np.linspace(hist[0], hist[1], bins + 1))
+                stats[i] = band_stats
+            ds = None
+        todo = [idx for idx, band_stats in zip(idxs, stats)
+                if band_stats is None]
+        if not todo:
+            return stats
+
+        # Compute statistics
+        if approx:
+            samples = self._sample_band_values(todo, sample_fraction)
+            accs = [array_stat.GroupAccumulator(np.zeros(len(sample)), sample)
+                    for sample in samples]
         else:
-            return Raster(out_filename)
+            accs = [array_stat.GroupAccumulator() for _ in todo]
+            for block_win in self.block_windows():
+                array = self.array_from_bands(*todo, block_win=block_win,
+                                              mask_nodata=False)
+                if array.ndim == 2:
+                    array = array[:, :, np.newaxis]
+                for j, acc in enumerate(accs):
+                    values = self._valid_values(array[:, :, j])
+                    acc.update(np.zeros(len(values)), values)
+        computed = []
+        for acc in accs:
+            empty = acc.labels is None or not len(acc.labels)
+            band_stats = {statname: np.nan
+                          if empty
+                          else float(acc.result(statname)[0])
+                          for statname in ('min', 'max', 'mean', 'std')}
+            band_stats['count'] = 0 if empty else int(acc.count[0])
+            band_stats['approx'] = bool(approx)
+            computed.append(band_stats)
+
+        # Histograms: from the samples, or in a second pass
+        if bins:
+            counts = [np.zeros(bins, dtype=np.int64) for _ in todo]
+            if approx:
+                value_blocks = [samples]
+            else:
+                value_blocks = (
+                    [self._valid_values(array)
+                     for array in np.atleast_3d(self.array_from_bands(
+                         *todo, block_win=block_win,
+                         mask_nodata=False)).transpose(2, 0, 1)]
+                    for block_win in self.block_windows())
+            for values_by_band in value_blocks:
+                for j, values in enumerate(values_by_band):
+                    if not computed[j]['count']:  # No valid value in band
+                        continue
+                    counts[j] += np.histogram(
+                        values, bins=bins,
+                        range=(computed[j]['min'], computed[j]['max']))[0]
+            for j, band_stats in enumerate(computed):
+                band_stats['histogram'] = (
+                    counts[j],
+                    np.linspace(band_stats['min'], band_stats['max'],
+                                bins + 1))
+
+        # Cache results in band metadata
+        if use_cache:
+            ds = gdal.Open(self._filename, gdal.GA_ReadOnly)
+            for idx, band_stats in zip(todo, computed):
+                if not band_stats['count']:
+                    continue
+                band = ds.GetRasterBand(idx)
+                band.SetStatistics(band_stats['min'], band_stats['max'],
+                                   band_stats['mean'], band_stats['std'])
+                band.SetMetadata({'MTIME': mtime,
+                                  'COUNT': str(band_stats['count']),
+                                  'APPROX': 'YES' if approx else 'NO'},
+                                 'YMRASTER')
+                if bins:
+                    band.SetDefaultHistogram(
+                        band_stats['min'], band_stats['max'],
+                        [int(c) for c in band_stats['histogram'][0]])
+            ds = None
+
+        computed_by_idx = dict(zip(todo, computed))
+        return [computed_by_idx[idx] if band_stats is None else band_stats
+                for idx, band_stats in zip(idxs, stats)]
 
     def rescale_bands(self, dstmin, dstmax, *idxs, **kw):
         """Rescales one or more bands in the raster.
 
         For each specified band, values are rescaled between given minimum and
-        maximum values.
+        maximum values. The minimum and maximum of each band are computed on
+        the whole band first (see `band_stats`), so that all blocks are
+        rescaled the same way. NODATA values are left unchanged.
 
         Parameters
         ----------
@@ -729,45 +1877,66 @@ class Raster(Sized):
             One or more indices of the bands to rescale.
         out_filename : str
             path to the output file. If omitted, then the raster is overwritten
+        use_cache : bool, optional
+            If True, read and write the minimum and maximum of the bands in
+            the GDAL auxiliary file of the raster (see `band_stats`). False by
+            default, so that no file is written next to the raster.
+        workspace : `Workspace`
+            Workspace for scratch files. By default, a new one is created in
+            the temporary folder.
 
         Returns
         -------
         `Raster` or None
             Output raster or None if the raster is overwritten
         """
-        # Create an empty file with same size and dtype of float64
-        out_filename = kw['out_filename'] \
-            if kw.get('out_filename') \
-            else os.path.join(gettempdir(), 'bands_rescaled.tif')
-        meta = self.meta
-        meta['dtype'] = RasterDataType(gdal_dtype=gdal.GDT_Float64)
-        write_file(out_filename, overwrite=True, **meta)
+        for i in idxs:
+            if not 1 <= i <= self._count:
+                raise IndexError("Band index out of range: {}".format(i))
 
-        # For each band, compute rescale if asked, then save band in empty file
-        #        for i in range(1, self._count+1):
-        for block_array, xoffset, yoffset in \
-                self.block_arrays(mask_nodata=True):
-            for i in idxs:
-                try:
-                    array = block_array[:, :, i]
-                except IndexError:
-                    if i != 1:
-                        raise IndexError(
-                            "Index out of range for mono-band image")
-                    array = block_array
-                srcmin = array.min()
-                srcmax = array.max()
-                array = dstmin + \
-                    ((dstmax - dstmin) / (srcmax - srcmin)) \
-                    * (array - srcmin)
-            write_file(out_filename, array, xoffset=xoffset, yoffset=yoffset)
-
-        # Overwrite if wanted else return the new Raster
-        if not kw.get('out_filename'):
-            shutil.copy(out_filename, self._filename)
-            os.remove(out_filename)
-        else:
-            return Raster(out_filename)
+        # First pass: global minimum and maximum of each band to rescale
+        srcstats = dict(zip(idxs, self.band_stats(
+            *idxs, use_cache=kw.get('use_cache', False))))
+
+        # Create an empty file with same size and dtype of float64 (in a
+        # scratch workspace if the raster is to be overwritten)
+        workspace = _scratch(kw, gdal_only=True)
+        try:
+            out_filename = kw['out_filename'] \
+                if kw.get('out_filename') \
+                else workspace.path('bands_rescaled.tif')
+            meta = self.meta
+            meta['dtype'] = RasterDataType(gdal_dtype=gdal.GDT_Float64)
+            write_file(out_filename, overwrite=True, **meta)
+
+            # Second pass: rescale each block of the bands and save it
+            for block_win in self.block_windows():
+                array = np.atleast_3d(self.array_from_bands(
+                    block_win=block_win,
+                    mask_nodata=False)).astype(np.float64)
+                for i in idxs:
+                    srcmin, srcmax = srcstats[i]['min'], srcstats[i]['max']
+                    scale = float(dstmax - dstmin) / (srcmax - srcmin) \
+                        if srcmax != srcmin \
+                        else 0.
+                    band_array = array[:, :, i - 1]
+                    rescaled = dstmin + scale * (band_array - srcmin)
+                    if self._nodata_value is not None:
+                        rescaled[band_array == self._nodata_value] = \
+                            self._nodata_value
+                    array[:, :, i - 1] = rescaled
+                write_file(out_filename,
+                           array if self._count > 1 else array[:, :, 0],
+                           xoffset=block_win[0], yoffset=block_win[1])
+
+            # Overwrite if wanted else return the new Raster
+            if kw.get('out_filename'):
+                return Raster(out_filename)
+            workspace.check_size()
+            workspace.move(out_filename, self._filename)
+            self.refresh()
+        finally:
+            workspace.cleanup()
 
     def fusion(self, pan, **kw):
         """Sharpen the raster with its corresponding panchromatic image.
@@ -782,10 +1951,16 @@ class Raster(Sized):
             Panchromatic image to use for sharpening.
         out_filename : str
             Path to the output file. If omitted, then the raster is overwritten.
+        workspace : `Workspace`
+            Workspace for scratch files. By default, a new one is created in
+            the temporary folder.
+        lazy : bool
+            If True, nothing is written and the result is returned as an
+            `OtbImage`, to be chained with other operations in memory.
 
         Returns
         -------
-        `Raster` or `None`
+        `Raster`, `OtbImage` or `None`
             Output raster or `None` if the raster is overwritten.
         """
         # Check extents
@@ -800,24 +1975,24 @@ class Raster(Sized):
                 self,
                 pan)
 
-        # Out file
-        out_filename = kw['out_filename'] \
-            if kw.get('out_filename') \
-            else os.path.join(gettempdir(), 'pan_sharpened.tif')
-
         # Actual sharpening
-        Pansharpening = otb.Registry.CreateApplication("BundleToPerfectSensor")
-        Pansharpening.SetParameterString("inp", pan.filename)
-        Pansharpening.SetParameterString("inxs", self._filename)
-        Pansharpening.SetParameterString("out", out_filename)
-        Pansharpening.ExecuteAndWriteOutput()
-
-        # Overwrite if wanted else return the new Raster
-        if not kw.get('out_filename'):
-            shutil.copy(out_filename, self._filename)
-            os.remove(out_filename)
-        else:
-            return Raster(out_filename)
+        image = OtbImage(_fusion_app(self, pan), self._count,
+                         inputs=(self, pan),
+                         name='{:b}_pan_sharpened'.format(self),
+                         date_time=self._date_time,
+                         srs=self._srs)
+        if kw.get('lazy'):
+            return image
+
+        # Write the out file, or overwrite the raster
+        if kw.get('out_filename'):
+            return image.write(kw['out_filename'])
+        with _scratch(kw) as workspace:
+            out_filename = workspace.path('pan_sharpened.tif')
+            image.write(out_filename)
+            workspace.check_size()
+            workspace.move(out_filename, self._filename)
+        self.refresh()
 
     @fix_missing_proj
     def radiometric_indices(self, *indices, **kw):
@@ -840,10 +2015,13 @@ class Raster(Sized):
         out_filename: str
             Path to the output file. If omitted, a default filename will be
             chosen.
+        lazy : bool
+            If True, nothing is written and the result is returned as an
+            `OtbImage`, to be chained with other operations in memory.
 
         Returns
         -------
-        `Raster`
+        `Raster` or `OtbImage`
             Output raster
         """
         # Out file
@@ -856,45 +2034,132 @@ class Raster(Sized):
             out_filename = '{:b}_{}.tif'.format(self, '_'.join(inames))
 
         # Actual computation
-        RadiometricIndices = otb.Registry.CreateApplication(
-            "RadiometricIndices")
-        RadiometricIndices.SetParameterString("in", self._filename)
-        try:
-            RadiometricIndices.SetParameterInt("channels.blue",
-                                               kw['blue_idx'])
-        except KeyError:
-            pass
-        try:
-            RadiometricIndices.SetParameterInt("channels.green",
-                                               kw['green_idx'])
-        except KeyError:
-            pass
-        try:
-            RadiometricIndices.SetParameterInt("channels.red",
-                                               kw['red_idx'])
-        except KeyError:
-            pass
-        try:
-            RadiometricIndices.SetParameterInt("channels.nir",
-                                               kw['nir_idx'])
-        except KeyError:
-            pass
-        try:
-            RadiometricIndices.SetParameterInt("channels.mir", kw['mir_idx'])
-        except KeyError:
-            pass
-        RadiometricIndices.SetParameterStringList("list", list(indices))
-        RadiometricIndices.SetParameterString("out", out_filename)
-        RadiometricIndices.ExecuteAndWriteOutput()
+        image = OtbImage(_radiometric_indices_app(self, indices, **kw),
+                         len(indices),
+                         inputs=(self,),
+                         name=os.path.splitext(
+                             os.path.basename(out_filename))[0],
+                         date_time=self._date_time,
+                         srs=self._srs)
+        if kw.get('lazy'):
+            return image
+        return image.write(out_filename)
+
+    def compute_indices(self, *indices, **kw):
+        """Saves radiometric indices of the raster, computed with NumPy.
+
+        All indices are computed in a single pass over the blocks of the
+        raster, reading only the bands they need. Indices can be written
+        together in a multi-band raster (one band per index, in the given
+        order) or each in its own single-band raster. Outputs are of type
+        float32, and get the date/time of the raster. Pixels having a NODATA
+        value in a needed band, and pixels where an index is undefined, are
+        set to NaN, which is the NODATA value of the outputs.
+
+        Available indices are: ndvi, ndwi ((nir - mir) / (nir + mir)), mndwi,
+        ndsi (same as mndwi), savi, evi and nbr ((nir - mir2) / (nir +
+        mir2)). The constants of savi and evi are defined for reflectances in
+        [0, 1]: they are meaningless on digital numbers, which should be
+        converted with `scale`. Normalized differences do not depend on it.
 
-        out_raster = Raster(out_filename)
-        if self._date_time:
-            out_raster.date_time = self._date_time
-        return out_raster
+        Parameters
+        ----------
+        indices : str
+            Names of the indices to compute (eg. 'ndvi').
+        blue_idx, green_idx, red_idx, nir_idx, mir_idx, mir2_idx : int
+            Index of the band of each color (numbering starts at 1). Only the
+            colors needed by the indices are required.
+        scale : float, optional
+            Factor converting pixel values to reflectances in [0, 1] (eg.
+            0.0001 for reflectances stored as integers multiplied by 10000).
+            By default, pixel values are supposed to be reflectances.
+        out_filename : str
+            Path to the multi-band output file. If omitted (and if
+            `out_filenames` is omitted too), a default filename will be
+            chosen.
+        out_filenames : list of str
+            Path to the output file of each index, to write one single-band
+            file per index instead of a multi-band one.
+        block_size : tuple of int (xsize, ysize), optional
+            Size of the blocks to process. By default, the "natural" block
+            size of the raster is used.
+
+        Returns
+        -------
+        `Raster` or list of `Raster`
+            Output raster, or list of output rasters if `out_filenames` is
+            given.
+        """
+        # Bands needed by the indices
+        indices = [name.lower() for name in indices]
+        for name in indices:
+            if name not in _INDICES:
+                raise ValueError("Unknown radiometric index: {}".format(name))
+        colors = sorted(set(color
+                            for name in indices
+                            for color in _INDICES[name][0]))
+        for color in colors:
+            if not 1 <= kw.get('{}_idx'.format(color), 0) <= self._count:
+                raise IndexError("Missing or out of range {}_idx".format(
+                    color))
+        color_idxs = [kw['{}_idx'.format(color)] for color in colors]
+
+        # Create empty output files of type float32
+        meta = self.meta
+        meta['dtype'] = RasterDataType(numpy_dtype=np.float32)
+        if kw.get('out_filenames'):
+            out_filenames = list(kw['out_filenames'])
+            if len(out_filenames) != len(indices):
+                raise ValueError("One output filename per index is needed")
+            meta['count'] = 1
+        else:
+            out_filenames = [kw['out_filename']
+                             if kw.get('out_filename')
+                             else '{:b}_{}.tif'.format(self,
+                                                       '_'.join(indices))]
+            meta['count'] = len(indices)
+        for out_filename in out_filenames:
+            write_file(out_filename, overwrite=True, **meta)
+
+        # Read the needed bands of each block once and compute all indices
+        for block_win in self.block_windows(block_size=kw.get('block_size')):
+            array = np.atleast_3d(self.array_from_bands(
+                *color_idxs, block_win=block_win,
+                mask_nodata=False)).astype(np.float64)
+            if self._nodata_value is not None:
+                array[(array == self._nodata_value).any(axis=2)] = np.nan
+            if kw.get('scale'):
+                array *= kw['scale']
+            bands = dict(zip(colors, np.rollaxis(array, 2)))
+            index_arrays = [
+                _INDICES[name][1](*[bands[color]
+                                    for color in _INDICES[name][0]])
+                .astype(np.float32)
+                for name in indices]
+            if len(out_filenames) > 1:
+                for out_filename, index_array in zip(out_filenames,
+                                                     index_arrays):
+                    write_file(out_filename, array=index_array,
+                               xoffset=block_win[0], yoffset=block_win[1])
+            else:
+                write_file(out_filenames[0],
+                           array=np.dstack(index_arrays)
+                           if len(index_arrays) > 1
+                           else index_arrays[0],
+                           xoffset=block_win[0], yoffset=block_win[1])
+
+        # Pixels having a NODATA value in a source band are NaN
+        out_rasters = [Raster(out_filename) for out_filename in out_filenames]
+        for out_raster in out_rasters:
+            out_raster.nodata_value = np.nan
+        return out_rasters \
+            if kw.get('out_filenames') \
+            else out_rasters[0]
 
     def ndvi(self, red_idx, nir_idx, **kw):
         """Saves the Normalized Difference Vegetation Index (NDVI) of the
-        raster.
+        raster, computed with NumPy (see `compute_indices`), or with OTB if
+        `lazy` is True.
 
         Parameters
         ----------
@@ -905,22 +2170,33 @@ class Raster(Sized):
         out_filename : str
             Path to the output file. If omitted, a default filename will be
             chosen.
+        lazy : bool
+            If True, nothing is written and the result is returned as an
+            `OtbImage`, to be chained with other operations in memory.
 
         Returns
         -------
-        `Raster`
+        `Raster` or `OtbImage`
             Output raster.
         """
         out_filename = kw['out_filename'] \
             if kw.get('out_filename') \
             else '{:b}_ndvi.tif'.format(self)
-        return self.radiometric_indices("Vegetation:NDVI",
-                                        red_idx=red_idx,
-                                        nir_idx=nir_idx,
-                                        out_filename=out_filename)
+        if kw.get('lazy'):
+            return self.radiometric_indices("Vegetation:NDVI",
+                                            red_idx=red_idx,
+                                            nir_idx=nir_idx,
+                                            out_filename=out_filename,
+                                            lazy=True)
+        return self.compute_indices('ndvi',
+                                    red_idx=red_idx,
+                                    nir_idx=nir_idx,
+                                    out_filename=out_filename)
 
     def ndwi(self, nir_idx, mir_idx, **kw):
-        """Saves the Normalized Difference Water Index (NDWI) of the raster.
+        """Saves the Normalized Difference Water Index (NDWI) of the raster,
+        computed with NumPy (see `compute_indices`), or with OTB if `lazy` is
+        True.
 
         Parameters
         ----------
@@ -931,23 +2207,33 @@ class Raster(Sized):
         out_filename : str
             path to the output file. If ommited, a default filename will be
             chosen.
+        lazy : bool
+            If True, nothing is written and the result is returned as an
+            `OtbImage`, to be chained with other operations in memory.
 
         Returns
         -------
-        `Raster`
+        `Raster` or `OtbImage`
             Output raster.
         """
         out_filename = kw['out_filename'] \
             if kw.get('out_filename') \
             else '{:b}_ndwi.tif'.format(self)
-        return self.radiometric_indices("Water:NDWI",
-                                        nir_idx=nir_idx,
-                                        mir_idx=mir_idx,
-                                        out_filename=out_filename)
+        if kw.get('lazy'):
+            return self.radiometric_indices("Water:NDWI",
+                                            nir_idx=nir_idx,
+                                            mir_idx=mir_idx,
+                                            out_filename=out_filename,
+                                            lazy=True)
+        return self.compute_indices('ndwi',
+                                    nir_idx=nir_idx,
+                                    mir_idx=mir_idx,
+                                    out_filename=out_filename)
 
     def mndwi(self, green_idx, mir_idx, **kw):
         """Saves the Modified Normalized Difference Water Index (MNDWI) of the
-        raster.
+        raster, computed with NumPy (see `compute_indices`), or with OTB if
+        `lazy` is True.
 
         Parameters
         ----------
@@ -958,19 +2244,28 @@ class Raster(Sized):
         out_filename : str
             Path to the output file. If ommited, a default filename will be
             chosen.
+        lazy : bool
+            If True, nothing is written and the result is returned as an
+            `OtbImage`, to be chained with other operations in memory.
 
         Returns
         -------
-        `Raster`
+        `Raster` or `OtbImage`
             Output raster.
         """
         out_filename = kw['out_filename'] \
             if kw.get('out_filename') \
             else '{:b}_mndwi.tif'.format(self)
-        return self.radiometric_indices("Water:MNDWI",
-                                        green_idx=green_idx,
-                                        mir_idx=mir_idx,
-                                        out_filename=out_filename)
+        if kw.get('lazy'):
+            return self.radiometric_indices("Water:MNDWI",
+                                            green_idx=green_idx,
+                                            mir_idx=mir_idx,
+                                            out_filename=out_filename,
+                                            lazy=True)
+        return self.compute_indices('mndwi',
+                                    green_idx=green_idx,
+                                    mir_idx=mir_idx,
+                                    out_filename=out_filename)
 
     ndsi = mndwi
 
@@ -983,12 +2278,15 @@ class Raster(Sized):
             One or more rasters to append after the current one.
         """
         raster_list = [self] + list(rasters)
-        concatenate_rasters(raster_list)
+        concatenate_rasters(*raster_list)
+        self.refresh()
 
     def apply_mask(self, mask_raster, mask_value=1, set_value=None, **kw):
         """Apply a mask to the raster: set all masked pixels to a given value.
 
-        NODATA will be set to set_value afterward.
+        NODATA will be set to set_value afterward. The mask is applied to all
+        bands in a single pass over the blocks of the raster (see the
+        `apply_mask` function, which can also mask several rasters at once).
 
         Parameters
         ----------
@@ -1002,10 +2300,16 @@ class Raster(Sized):
         out_filename : str
             Path of the output file. If omitted, a default filename will be
             chosen.
+        block_size : tuple of int (xsize, ysize), optional
+            Size of the blocks to process. By default, the "natural" block
+            size of the raster is used.
+        lazy : bool
+            If True, nothing is written and the result is returned as an
+            `OtbImage`, to be chained with other operations in memory.
 
         Returns
         -------
-        `Raster`
+        `Raster` or `OtbImage`
             Output raster.
         """
         # Check for extent
@@ -1014,47 +2318,25 @@ class Raster(Sized):
                 self,
                 mask_raster)
 
-        # Set value
-        try:
+        # In memory with OTB: each band is masked, then all masked bands are
+        # concatenated
+        if kw.get('lazy'):
             set_value = set_value \
-                if set_value \
-                else np.iinfo(self.dtype.numpy_dtype).max
-        except ValueError:
-            set_value = np.finfo(self.dtype.numpy_dtype).max
+                if set_value is not None \
+                else _default_mask_value(self._dtype)
+            return _mask_image(self, mask_raster, mask_value, set_value)
 
         # Out file
         out_filename = kw['out_filename'] \
             if kw.get('out_filename') \
-            else os.path.join(gettempdir(), 'masked.tif')
-
-        # Actual mask application
-        for i in range(self._count):  # For each band
-            # Compute the mask for that band
-            BandMath = otb.Registry.CreateApplication("BandMath")
-            expr = "(im2b1 == {}) ? {} : im1b{}".format(mask_value,
-                                                        set_value, i+1)
-            temp_name = os.path.join(gettempdir(),
-                                     'mono_masked_{}.tif'.format(i))
-            BandMath.SetParameterStringList(
-                "il",
-                [self._filename, mask_raster.filename])
-            BandMath.SetParameterString("out", temp_name)
-            BandMath.SetParameterString("exp", expr)
-            BandMath.ExecuteAndWriteOutput()
-        # Then concatenate all masked bands and indicate the nodata_value
-        masked_bands = [Raster(os.path.join(gettempdir(),
-                                            'mono_masked_{}.tif'.format(i)))
-                        for i in range(self._count)]
-        concatenate_rasters(*masked_bands, out_filename=out_filename)
-        out_raster = Raster(out_filename)
-        out_raster.nodata_value = set_value
+            else '{:b}_masked.tif'.format(self)
 
-        # Delete the temp files
-        for i in range(self._count):
-            os.remove(os.path.join(gettempdir(),
-                                   'mono_masked_{}.tif'.format(i)))
-
-        return out_raster
+        # Actual mask application, in one pass over the blocks
+        return apply_mask(mask_raster, self,
+                          mask_value=mask_value,
+                          set_value=set_value,
+                          out_filenames=[out_filename],
+                          block_size=kw.get('block_size'))[0]
 
     def _lsms_smoothing(self, spatialr, ranger, thres=0.1, rangeramp=0,
                         maxiter=10, **kw):
@@ -1102,9 +2384,9 @@ class Raster(Sized):
             else '{:b}_spatial.tif'.format(self)
 
         # Actual smoothing
-        MeanShiftSmoothing = otb.Registry.CreateApplication(
+        MeanShiftSmoothing = config.create_app(
             "MeanShiftSmoothing")
-        MeanShiftSmoothing.SetParameterString("in", self._filename)
+        _set_input_image(MeanShiftSmoothing, "in", self)
         MeanShiftSmoothing.SetParameterString("fout", out_filename)
         MeanShiftSmoothing.SetParameterString("foutpos", out_spatial_filename)
         MeanShiftSmoothing.SetParameterInt("spatialr", spatialr)
@@ -1146,13 +2428,18 @@ class Raster(Sized):
             radiometry unit)
         block_size : tuple of int (xsize, ysize)
             wanted size for the blocks. To save memory, the segmentation work on
-            blocks instead of the whole raster. If None, use the natural block
-            size of the raster.
+            blocks instead of the whole raster. If None, the size is planned
+            from the memory budget (see `plan_lsms_tiles`).
+        memory_budget : int
+            Memory available for a block, in MB, if no block size is given.
         spatial_raster : `Raster`
             Spatial raster associated to this raster (for example, as returned
             by the `lsms_smoothing` method)
         out_filename : str
             Path to the segmented image to be written
+        workspace : `Workspace`
+            Workspace for the scratch files of the tiles. By default, a new one
+            is created in the temporary folder.
 
         Returns
         -------
@@ -1160,26 +2447,30 @@ class Raster(Sized):
             Labeled raster.
         """
         # Blocks size
-        tilesizex, tilesizey = block_size if block_size else self.block_size
+        tilesizex, tilesizey = block_size \
+            if block_size \
+            else plan_lsms_tiles(self, spatialr, kw.get('memory_budget'))[:2]
 
         # Out file
         out_filename = kw['out_filename'] \
             if kw.get('out_filename') \
             else '{:b}_label.tif'.format(self)
 
-        # Actual segmentation
-        LSMSSegmentation = otb.Registry.CreateApplication("LSMSSegmentation")
-        LSMSSegmentation.SetParameterString("tmpdir", gettempdir())
-        LSMSSegmentation.SetParameterString("in", self._filename)
-        LSMSSegmentation.SetParameterString("inpos",
-                                            spatial_raster.filename)
-        LSMSSegmentation.SetParameterString("out", out_filename)
-        LSMSSegmentation.SetParameterFloat("ranger", ranger)
-        LSMSSegmentation.SetParameterFloat("spatialr", spatialr)
-        LSMSSegmentation.SetParameterInt("minsize", 0)
-        LSMSSegmentation.SetParameterInt("tilesizex", tilesizex)
-        LSMSSegmentation.SetParameterInt("tilesizey", tilesizey)
-        LSMSSegmentation.ExecuteAndWriteOutput()
+        # Actual segmentation, with tiles written in a scratch workspace
+        with _scratch(kw) as workspace:
+            LSMSSegmentation = config.create_app(
+                "LSMSSegmentation")
+            LSMSSegmentation.SetParameterString("tmpdir", workspace.root)
+            LSMSSegmentation.SetParameterString("in", self._filename)
+            LSMSSegmentation.SetParameterString("inpos",
+                                                spatial_raster.filename)
+            LSMSSegmentation.SetParameterString("out", out_filename)
+            LSMSSegmentation.SetParameterFloat("ranger", ranger)
+            LSMSSegmentation.SetParameterFloat("spatialr", spatialr)
+            LSMSSegmentation.SetParameterInt("minsize", 0)
+            LSMSSegmentation.SetParameterInt("tilesizex", tilesizex)
+            LSMSSegmentation.SetParameterInt("tilesizey", tilesizey)
+            LSMSSegmentation.ExecuteAndWriteOutput()
 
         return Raster(out_filename)
 
@@ -1211,43 +2502,53 @@ class Raster(Sized):
             by the `lsms_smoothing` method)
         block_size : tuple of int (xsize, ysize)
             Wanted size for the blocks. To save memory, the merging work on
-            blocks instead of the whole raster. If None, use the natural block
-            size of the raster.
+            blocks instead of the whole raster. If None, the size is planned
+            from the memory budget (see `plan_lsms_tiles`).
+        memory_budget : int
+            Memory available for a block, in MB, if no block size is given.
         out_filename : str
             path to the merged segmented image to be written.  If omitted,
             the raster will be overwritten.
+        workspace : `Workspace`
+            Workspace for scratch files. By default, a new one is created in
+            the temporary folder.
 
         Returns
         -------
         `Raster`
             Merged segmented raster.
         """
-        # Blocks size
-        tilesizex, tilesizey = block_size if block_size else self.block_size
-
-        # Out file
-        out_filename = kw['out_filename'] \
-            if kw.get('out_filename') \
-            else os.path.join(gettempdir(), 'labels.tif')
-
-        # Actual merging
-        LSMSSmallRegionsMerging = otb.Registry.CreateApplication(
-            "LSMSSmallRegionsMerging")
-        LSMSSmallRegionsMerging.SetParameterString("in",
-                                                   smoothed_raster.filename)
-        LSMSSmallRegionsMerging.SetParameterString("inseg", self._filename)
-        LSMSSmallRegionsMerging.SetParameterString("out", out_filename)
-        LSMSSmallRegionsMerging.SetParameterInt("minsize", object_minsize)
-        LSMSSmallRegionsMerging.SetParameterInt("tilesizex", tilesizex)
-        LSMSSmallRegionsMerging.SetParameterInt("tilesizey", tilesizey)
-        LSMSSmallRegionsMerging.ExecuteAndWriteOutput()
-
-        # Overwrite if wanted else return the new Raster
-        if not kw.get('out_filename'):
-            shutil.copy(out_filename, self._filename)
-            os.remove(out_filename)
-        else:
-            return Raster(out_filename)
+        # Blocks size (adjacent objects are found with a 1-pixel margin)
+        tilesizex, tilesizey = block_size \
+            if block_size \
+            else plan_lsms_tiles(smoothed_raster, 1,
+                                 kw.get('memory_budget'))[:2]
+
+        # Out file (in a scratch workspace if the raster is to be overwritten)
+        with _scratch(kw) as workspace:
+            out_filename = kw['out_filename'] \
+                if kw.get('out_filename') \
+                else workspace.path('labels.tif')
+
+            # Actual merging
+            LSMSSmallRegionsMerging = config.create_app(
+                "LSMSSmallRegionsMerging")
+            LSMSSmallRegionsMerging.SetParameterString(
+                "in", smoothed_raster.filename)
+            LSMSSmallRegionsMerging.SetParameterString("inseg", self._filename)
+            LSMSSmallRegionsMerging.SetParameterString("out", out_filename)
+            LSMSSmallRegionsMerging.SetParameterInt("minsize", object_minsize)
+            LSMSSmallRegionsMerging.SetParameterInt("tilesizex", tilesizex)
+            LSMSSmallRegionsMerging.SetParameterInt("tilesizey", tilesizey)
+            LSMSSmallRegionsMerging.ExecuteAndWriteOutput()
+
+            # Overwrite if wanted else return the new Raster
+            if kw.get('out_filename'):
+                return Raster(out_filename)
+            workspace.check_size()
+            workspace.move(out_filename, self._filename)
+        self.refresh()
+        return self
 
     def _lsms_vectorization(self, orig_raster, block_size=None, **kw):
         """Fourth and Last (optional) step in a LSMS segmentation: vectorize a
@@ -1269,12 +2570,14 @@ class Raster(Sized):
 
         Parameters
         ----------
-        orig_raster : `Raster`
+        orig_raster : `Raster` or `OtbImage`
             Original raster from which the segmentation was computed
         block_size : tuple of int (xsize, ysize)
             Wanted size for the blocks. To save memory, the vectorization work
-            on blocks instead of the whole raster. If None, use the natural
-            block size of the raster.
+            on blocks instead of the whole raster. If None, the size is planned
+            from the memory budget (see `plan_lsms_tiles`).
+        memory_budget : int
+            Memory available for a block, in MB, if no block size is given.
         out_filename : str
             Path to the output vector file. If omitted, a default filename will
             be chosen.
@@ -1282,7 +2585,8 @@ class Raster(Sized):
         # Blocks size
         tilesizex, tilesizey = block_size \
             if block_size \
-            else orig_raster.block_size
+            else plan_lsms_tiles(self, 1, kw.get('memory_budget'),
+                                 count=orig_raster.count + 1)[:2]
 
         # Out file
         out_filename = kw['out_filename'] \
@@ -1290,9 +2594,9 @@ class Raster(Sized):
             else '{:b}_label.shp'.format(self)
 
         # Actual vectorization
-        LSMSVectorization = otb.Registry.CreateApplication(
+        LSMSVectorization = config.create_app(
             "LSMSVectorization")
-        LSMSVectorization.SetParameterString("in", orig_raster.filename)
+        _set_input_image(LSMSVectorization, "in", orig_raster)
         LSMSVectorization.SetParameterString("inseg", self._filename)
         LSMSVectorization.SetParameterString("out", out_filename)
         LSMSVectorization.SetParameterInt("tilesizex", tilesizex)
@@ -1341,84 +2645,131 @@ class Raster(Sized):
             Threshold defining the minimum size in pixel of an object. If given,
             objects smaller than this size will be merged into a bigger adjacent
             object.
-        tilesizex : int
-            Horizontal size of each tile. To save memory, the segmentation work
-            on tiles instead of the whole image.  If None, use the natural tile
-            size of the image.
-        tilesizey : int
-            Vertical size of each tile. If None, use the natural tile size of
-            the image.
+        block_size : tuple of int (xsize, ysize)
+            Size of the tiles. To save memory, the segmentation work on tiles
+            instead of the whole image. If None, the size is planned from the
+            memory budget (see `plan_lsms_tiles`).
+        memory_budget : int
+            Memory available for a tile, in MB, if no block size is given. By
+            default, the `otb_ram` setting of the `config` module.
+        report : function
+            Function called with the `LsmsTilePlan` of the segmentation (size
+            of the tiles, number of tiles and predicted peak memory) before
+            running, eg. to display it. For an `OtbImage`, whose size is only
+            known once computed, it is called after the smoothing.
+        workspace : `Workspace`
+            Workspace for the intermediate images (smoothed, spatial and
+            label images). By default, a new one is created in the temporary
+            folder. All intermediate images are removed at the end.
+        cache_dir : str
+            Directory of a `StageCache` keeping the smoothed, spatial and
+            label images, keyed by the raster file and the parameters of each
+            step. Steps already computed with the same parameters (eg. when
+            only `object_minsize` changes, or when a previous run was
+            interrupted) are then not computed again.
 
         Returns
         -------
         `Raster`
             Labeled raster
         """
-
-        # Temp filenames
-        tmpdir = gettempdir()
-        out_smoothed_filename = os.path.join(
-            tmpdir, '{:b}_smoothed.tif'.format(self))
-        out_spatial_filename = os.path.join(
-            tmpdir, '{:b}_spatial.tif'.format(self))
-        out_label_filename = os.path.join(
-            tmpdir, '{:b}_label.tif'.format(self))
-
-        # Out files
-        out_filename = kw['out_filename'] \
-            if kw.get('out_filename') \
-            else '{:b}_label.tif'.format(self)
-        out_vector_filename = kw['out_vector_filename'] \
-            if kw.get('out_vector_filename') \
-            else '{:b}_label.shp'.format(self)
-
-        # First step: smoothing
-        smoothed_raster, spatial_raster = self._lsms_smoothing(
-            spatialr=spatialr,
-            ranger=ranger,
-            thres=thres,
-            rangeramp=rangeramp,
-            maxiter=maxiter,
-            out_filename=out_smoothed_filename,
-            out_spatial_filename=out_spatial_filename)
-
-        # Second step: actual object segmentation
-        label_raster = smoothed_raster._lsms_segmentation(
-            spatialr=spatialr,
-            ranger=ranger,
-            spatial_raster=spatial_raster,
-            block_size=block_size,
-            out_filename=out_label_filename)
-
-        # Optional third step: merge small objects (< minsize) into bigger ones
-        if object_minsize:
-            label_raster._lsms_merging(
-                object_minsize=object_minsize,
-                smoothed_raster=smoothed_raster,
+        cache = StageCache(kw['cache_dir']) if kw.get('cache_dir') else None
+        if cache is not None and not isinstance(self, Raster):
+            raise ValueError("Steps of a LSMS segmentation can only be cached "
+                             "for a raster file")
+
+        # Plan the tiles from the memory budget, for the smoothed image (of
+        # type float32)
+        def plan_tiles(raster):
+            plan = plan_lsms_tiles(
+                raster, spatialr, kw.get('memory_budget'),
                 block_size=block_size,
-                out_filename=out_filename)
-        else:
-            shutil.copy(out_label_filename, out_filename)
-
-        # Optional fourth step: convert into vector
-        if kw.get('out_vector_filename') \
-                or (not kw.get('out_vector_filename')
-                    and not kw.get('out_filename')):
-            out_raster = Raster(out_filename)
-            out_raster._lsms_vectorization(
-                orig_raster=self,
-                block_size=block_size,
-                out_filename=out_vector_filename)
+                dtype=RasterDataType(numpy_dtype=np.float32))
+            if kw.get('report'):
+                kw['report'](plan)
+            return plan
+        plan = plan_tiles(self) if isinstance(self, Raster) else None
+
+        with _scratch(kw) as workspace:
+            # Temp filenames
+            out_smoothed_filename = workspace.path(
+                '{:b}_smoothed.tif'.format(self))
+            out_spatial_filename = workspace.path(
+                '{:b}_spatial.tif'.format(self))
+            out_label_filename = workspace.path('{:b}_label.tif'.format(self))
+
+            # Out files (the label image is only temporary if not asked for)
+            out_filename = kw['out_filename'] \
+                if kw.get('out_filename') \
+                else workspace.path('{:b}_merged.tif'.format(self))
+            out_vector_filename = kw['out_vector_filename'] \
+                if kw.get('out_vector_filename') \
+                else '{:b}_label.shp'.format(self)
+
+            # First step: smoothing
+            def smoothing(out_smoothed_filename, out_spatial_filename):
+                self._lsms_smoothing(
+                    spatialr=spatialr,
+                    ranger=ranger,
+                    thres=thres,
+                    rangeramp=rangeramp,
+                    maxiter=maxiter,
+                    out_filename=out_smoothed_filename,
+                    out_spatial_filename=out_spatial_filename)
+            out_smoothed_filename, out_spatial_filename = _cached_stage(
+                cache, 'lsms_smoothing', [self],
+                [out_smoothed_filename, out_spatial_filename], smoothing,
+                spatialr=spatialr, ranger=ranger, thres=thres,
+                rangeramp=rangeramp, maxiter=maxiter)
+            smoothed_raster = Raster(out_smoothed_filename)
+            spatial_raster = Raster(out_spatial_filename)
+            workspace.check_size()
+
+            if plan is None:
+                plan = plan_tiles(smoothed_raster)
+            block_size = plan[:2]
+
+            # Second step: actual object segmentation
+            def segmentation(out_label_filename):
+                smoothed_raster._lsms_segmentation(
+                    spatialr=spatialr,
+                    ranger=ranger,
+                    spatial_raster=spatial_raster,
+                    block_size=block_size,
+                    out_filename=out_label_filename,
+                    workspace=workspace)
+            out_label_filename, = _cached_stage(
+                cache, 'lsms_segmentation', [smoothed_raster, spatial_raster],
+                [out_label_filename], segmentation,
+                spatialr=spatialr, ranger=ranger, block_size=tuple(block_size))
+            label_raster = Raster(out_label_filename)
+            workspace.check_size()
+
+            # Optional third step: merge small objects (< minsize) into bigger
+            # ones
+            if object_minsize:
+                label_raster._lsms_merging(
+                    object_minsize=object_minsize,
+                    smoothed_raster=smoothed_raster,
+                    block_size=block_size,
+                    out_filename=out_filename)
+            elif cache is not None:
+                shutil.copy(out_label_filename, out_filename)
+            else:
+                workspace.move(out_label_filename, out_filename)
 
-        # Remove temp files
-        for filename in (out_smoothed_filename, out_spatial_filename,
-                         out_label_filename):
-            os.remove(filename)
+            # Optional fourth step: convert into vector
+            if kw.get('out_vector_filename') \
+                    or (not kw.get('out_vector_filename')
+                        and not kw.get('out_filename')):
+                out_raster = Raster(out_filename)
+                out_raster._lsms_vectorization(
+                    orig_raster=self,
+                    block_size=block_size,
+                    out_filename=out_vector_filename)
 
-        if kw.get('out_filename'):
-            return Raster(out_filename)
-        else:
-            os.remove(out_filename)
+            if kw.get('out_filename'):
+                return Raster(out_filename)
 
     def label_stats(self,
                     stats=['mean', 'std', 'min', 'max', "per:20",
@@ -1430,6 +2781,13 @@ class Raster(Sized):
         max and the 20, 40, 50, 60, 80th percentiles. The output is an image at
         the given format that contains n_band * n_stat_features bands.
 
+        Computation can be distributed over several processes: each band is a
+        task and, when all statistics are mergeable (min, max, mean, std,
+        range) and there are more workers than bands, each band is further
+        split into horizontal strips whose partial results are merged in
+        order. The result is then equal, up to floating-point rounding, to the
+        result computed in a single pass.
+
         Parameters
         ----------
         label_raster : `Raster`
@@ -1437,6 +2795,9 @@ class Raster(Sized):
         stats : list of str
             List of statistics to compute. By default: mean, std, min, max,
             per:20, per:40, per:50, per:60, per:80.
+        workers : int, optional
+            Number of processes to use. By default, everything is computed in
+            the current process.
         out_filename : str
             Path of the output image. If omitted, a default filename is chosen.
         """
@@ -1449,25 +2810,624 @@ class Raster(Sized):
         meta['dtype'] = RasterDataType(gdal_dtype=gdal.GDT_Float64)
         write_file(out_filename, overwrite=True, **meta)
 
-        # Get array of labels from label file
+        # Label file and number of processes
         label_raster = kw['label_raster'] \
             if kw.get('label_raster') \
             else None
-        label_array = label_raster.array_from_bands()
-        # Get array of unique labels
-        unique_labels_array = np.unique(label_array)
-
-        # Compute label stats
-        i = 1
-        # For each band
-        for band_array, _ in self.band_arrays(mask_nodata=True):
-            for statname in stats:                              # For each stat
-                astat = array_stat.ArrayStat(statname)
-                for label in unique_labels_array:               # For each label
-                    # Compute stat for label
-                    label_indices = np.where(label_array == label)
-                    band_array[label_indices] = astat.compute(
-                        band_array[label_indices])
-                # Write the new band
-                write_file(out_filename, band_array, band_idx=i)
-                i += 1
+        workers = kw['workers'] \
+            if kw.get('workers') \
+            else 1
+
+        # Split the work into one task per band or, if all stats are
+        # mergeable, into one task per horizontal strip of each band
+        mergeable = all(array_stat.ArrayStat(statname).is_mergeable
+                        for statname in stats)
+        number_strips = int(math.ceil(float(workers) / self._count)) \
+            if mergeable and workers > self._count \
+            else 1
+        if number_strips > 1:
+            strip_height = int(math.ceil(float(self._height) / number_strips))
+            block_wins = list(self.block_windows(
+                block_size=(self._width, strip_height)))
+        else:
+            block_wins = [None]
+        tasks = [(self._filename, label_raster.filename, band_idx, block_win,
+                  stats)
+                 for band_idx in range(1, self._count + 1)
+                 for block_win in block_wins]
+        results = _pool_map(_label_stats_task, tasks, workers)
+
+        # Merge partial results in order, to get (labels, stat arrays) by band
+        band_results = []
+        for i in range(self._count):
+            band_tasks_results = results[i * len(block_wins):
+                                         (i + 1) * len(block_wins)]
+            if block_wins[0] is None:
+                band_results.append(band_tasks_results[0])
+            else:
+                acc = array_stat.GroupAccumulator()
+                for partial in band_tasks_results:
+                    acc.merge(partial)
+                band_results.append(
+                    (acc.labels, [acc.result(statname) for statname in stats]))
+
+        # Write label stats block by block, in band order then in stat order
+        for block_win in label_raster.block_windows():
+            label_array = label_raster.array_from_bands(
+                1, block_win=block_win, mask_nodata=False)
+            stat_arrays = [array_stat.map_labels(label_array, labels, values)
+                           for labels, stat_values in band_results
+                           for values in stat_values]
+            stat_stack = np.dstack(stat_arrays) \
+                if len(stat_arrays) > 1 \
+                else stat_arrays[0]
+            write_file(out_filename, array=stat_stack,
+                       xoffset=block_win[0], yoffset=block_win[1])
+
+    def zonal_stats(self, vector_filename,
+                    stats=['mean', 'std', 'min', 'max'],
+                    attribute=None, block_size=None):
+        """Compute statistics of each band of the raster inside each polygon of
+        a vector layer.
+
+        Polygons are rasterized in memory, block by block, so that no label
+        raster is ever written. Where polygons overlap, a pixel is counted in
+        the last polygon of the layer only. Rasters with a rotated
+        geo-transformation are not supported.
+
+        Mergeable statistics (min, max, mean, std, range) are accumulated
+        block by block, in constant memory. Other statistics (eg. median,
+        percentiles) need all the values of a polygon at once: the values of
+        all pixels covered by polygons are then kept in memory (8 bytes per
+        pixel and per band), which may be too much for large layers.
+
+        Parameters
+        ----------
+        vector_filename : str
+            Path to the vector file. Its first layer is used. It should have the
+            same projection as the raster.
+        stats : list of str, optional
+            List of statistics to compute. By default: mean, std, min, max.
+        attribute : str, optional
+            Name of the attribute identifying each polygon in the result. Its
+            values should be unique. By default, the feature id is used.
+        block_size : tuple of int (xsize, ysize), optional
+            Size of the blocks to rasterize. By default, the "natural" block
+            size of the raster is used.
+
+        Returns
+        -------
+        dict
+            For each polygon identifier, a dictionary giving for each statistic
+            the list of its values in each band. Statistics of a polygon
+            covering no valid pixel are NaN.
+        """
+        # Copy geometries in a memory layer, with an integer zone id
+        vector_ds = ogr.Open(vector_filename)
+        layer = vector_ds.GetLayer(0)
+        layer_srs = layer.GetSpatialRef()
+        assert layer_srs is None or self._srs is None \
+            or layer_srs.IsSame(self._srs), \
+            "Raster and vector have not the same Coordinate Reference " \
+            "System: '{:f}' and '{}'".format(self, vector_filename)
+        zone_ds = ogr.GetDriverByName('Memory').CreateDataSource('zones')
+        zone_layer = zone_ds.CreateLayer('zones', srs=layer_srs,
+                                         geom_type=layer.GetGeomType())
+        zone_layer.CreateField(ogr.FieldDefn('zone_id', ogr.OFTInteger))
+        keys = []
+        for feature in layer:
+            zone_feature = ogr.Feature(zone_layer.GetLayerDefn())
+            zone_feature.SetGeometry(feature.GetGeometryRef())
+            zone_feature.SetField('zone_id', len(keys) + 1)
+            zone_layer.CreateFeature(zone_feature)
+            keys.append(feature.GetField(attribute)
+                        if attribute
+                        else feature.GetFID())
+        vector_ds = None
+
+        # Rasterize polygons block by block and feed the grouped-stat engine
+        gt = self._transform
+        if gt[2] or gt[4]:
+            raise ValueError(
+                "Rasters with a rotated geo-transformation are not supported: "
+                "'{:f}'".format(self))
+        mergeable = all(array_stat.ArrayStat(statname).is_mergeable
+                        for statname in stats)
+        accumulators = [array_stat.GroupAccumulator()
+                        for _ in range(self._count)]
+        zone_values = [[] for _ in range(self._count)]
+        mem_driver = gdal.GetDriverByName('MEM')
+        ds = gdal.Open(self._filename, gdal.GA_ReadOnly)
+        for block_win in self.block_windows(block_size=block_size):
+            x, y, xsize, ysize = block_win
+            xmin = gt[0] + x * gt[1]
+            ymax = gt[3] + y * gt[5]
+            xmax = xmin + xsize * gt[1]
+            ymin = ymax + ysize * gt[5]
+            zone_layer.SetSpatialFilterRect(min(xmin, xmax), min(ymin, ymax),
+                                            max(xmin, xmax), max(ymin, ymax))
+            if zone_layer.GetFeatureCount() == 0:
+                continue
+            block_ds = mem_driver.Create('', xsize, ysize, 1, gdal.GDT_UInt32)
+            block_ds.SetGeoTransform((xmin, gt[1], 0, ymax, 0, gt[5]))
+            if self._srs:
+                block_ds.SetProjection(self._srs.ExportToWkt())
+            gdal.RasterizeLayer(block_ds, [1], zone_layer,
+                                options=['ATTRIBUTE=zone_id'])
+            zone_array = block_ds.GetRasterBand(1).ReadAsArray()
+            block_ds = None
+            covered = zone_array > 0
+            if not covered.any():
+                continue
+            zones = zone_array[covered]
+            for i in range(self._count):
+                values = ds.GetRasterBand(i + 1).ReadAsArray(
+                    *block_win)[covered].astype(np.float64)
+                if self._nodata_value is not None:
+                    values[values == self._nodata_value] = np.nan
+                if mergeable:
+                    accumulators[i].update(zones, values)
+                else:
+                    zone_values[i].append((zones, values))
+        ds = None
+
+        # Gather results by polygon
+        zone_ids = np.arange(1, len(keys) + 1)
+        result = {key: {statname: [] for statname in stats} for key in keys}
+        for i in range(self._count):
+            if mergeable and accumulators[i].labels is not None:
+                labels = accumulators[i].labels
+                stat_values = [accumulators[i].result(statname)
+                               for statname in stats]
+            elif zone_values[i]:
+                labels, stat_values = array_stat.grouped_stats(
+                    np.concatenate([zones for zones, _ in zone_values[i]]),
+                    np.concatenate([values for _, values in zone_values[i]]),
+                    stats)
+            else:
+                labels = np.empty(0)
+                stat_values = [np.empty(0) for _ in stats]
+            for statname, values in zip(stats, stat_values):
+                zone_stat = array_stat.map_labels(zone_ids, labels, values)
+                for key, value in zip(keys, zone_stat):
+                    result[key][statname].append(value)
+        return result
+
+    def aggregate(self, factor, stats=['mean'], **kw):
+        """Saves a coarser raster where each cell summarizes a square of
+        `factor` x `factor` pixels of the raster.
+
+        Cells are reduced all at once in each block by reshaping the block, so
+        that the raster is read only once. NODATA values are ignored. At right
+        and bottom edges, cells may cover less than `factor` x `factor` pixels.
+
+        The output raster has n_band * n_stats bands of type float64, in band
+        order then in stat order, and a geo-transformation giving cells the
+        right size and location.
+
+        Parameters
+        ----------
+        factor : int
+            Size of a cell, in number of pixels along each axis.
+        stats : list of str, optional
+            List of statistics to compute (eg. mean, min, max, std, count,
+            per:90). By default: mean.
+        out_filename : str
+            Path of the output image. If omitted, a default filename is chosen.
+
+        Returns
+        -------
+        `Raster`
+            Output raster.
+        """
+        # Create an empty file of the coarser size, with dtype float64
+        out_filename = kw['out_filename'] \
+            if kw.get('out_filename') \
+            else '{:b}_aggregated.tif'.format(self)
+        out_width = int(math.ceil(float(self._width) / factor))
+        out_height = int(math.ceil(float(self._height) / factor))
+        meta = self.meta
+        meta['width'] = out_width
+        meta['height'] = out_height
+        meta['count'] = len(stats) * self._count
+        meta['dtype'] = RasterDataType(gdal_dtype=gdal.GDT_Float64)
+        if self._transform:
+            meta['transform'] = tuple(
+                value * factor if i not in (0, 3) else value
+                for i, value in enumerate(self._transform))
+        write_file(out_filename, overwrite=True, **meta)
+
+        # Read strips whose height is a multiple of factor and reduce them
+        strip_height = factor * max(1, self.block_size[1] // factor)
+        astats = [array_stat.ArrayStat(statname, axis=3, skip_nan=True)
+                  for statname in stats]
+        for block_win in self.block_windows(
+                block_size=(self._width, strip_height)):
+            array = self.array_from_bands(block_win=block_win,
+                                          mask_nodata=False).astype(np.float64)
+            if array.ndim == 2:
+                array = array[:, :, np.newaxis]
+            if self._nodata_value is not None:
+                array[array == self._nodata_value] = np.nan
+
+            # Pad with NaN to get a whole number of cells
+            number_rows = int(math.ceil(float(block_win[3]) / factor))
+            padded = np.empty((number_rows * factor, out_width * factor,
+                               self._count))
+            padded.fill(np.nan)
+            padded[:array.shape[0], :array.shape[1], :] = array
+
+            # Shape (rows, cols, bands, factor * factor): one cell per line
+            cells = padded.reshape(number_rows, factor, out_width, factor,
+                                   self._count).transpose(0, 2, 4, 1, 3)
+            cells = cells.reshape(number_rows, out_width, self._count,
+                                  factor * factor)
+            with warnings.catch_warnings():  # All-NaN cells give NaN
+                warnings.simplefilter('ignore', RuntimeWarning)
+                stat_arrays = [astat.compute(cells) for astat in astats]
+            stat_stack = np.concatenate(
+                [stat_array[:, :, :, np.newaxis]
+                 for stat_array in stat_arrays],
+                axis=3).reshape(number_rows, out_width,
+                                len(stats) * self._count)
+            write_file(out_filename,
+                       array=stat_stack if stat_stack.shape[2] > 1
+                       else stat_stack[:, :, 0],
+                       yoffset=block_win[1] // factor)
+
+        return Raster(out_filename)
+
+    def linear_transform(self, matrix, **kw):
+        """Saves a raster whose bands are linear combinations of the bands of
+        this raster, eg. a tasseled cap transformation.
+
+        Each output band i is computed as ``sum_j(matrix[i][j] * band_j) +
+        offset[i]``. Blocks are transformed all at once by a matrix product,
+        possibly in parallel. Pixels having a NODATA value in any band are set
+        to NaN, which is the NODATA value of the output. The output raster is
+        of type float64.
+
+        Parameters
+        ----------
+        matrix : array_like
+            m*n matrix of coefficients, where n is the number of bands of the
+            raster and m the number of output bands.
+        offset : array_like, optional
+            Value added to each output band. By default, 0.
+        out_filename : str
+            Path of the output image. If omitted, a default filename is chosen.
+        block_size : tuple of int (xsize, ysize), optional
+            Size of the blocks to transform. By default, the "natural" block
+            size of the raster is used.
+        workers : int, optional
+            Number of processes to use. By default, everything is computed in
+            the current process.
+
+        Returns
+        -------
+        `Raster`
+            Output raster.
+        """
+        matrix = np.atleast_2d(np.asarray(matrix, dtype=np.float64))
+        if matrix.shape[1] != self._count:
+            raise ValueError(
+                "Matrix has {} columns but image has {} bands: '{:f}'".format(
+                    matrix.shape[1], self._count, self))
+        offset = np.asarray(kw['offset'], dtype=np.float64) \
+            if kw.get('offset') is not None \
+            else np.zeros(len(matrix))
+
+        # Create an empty file with one band per row of the matrix
+        out_filename = kw['out_filename'] \
+            if kw.get('out_filename') \
+            else '{:b}_transformed.tif'.format(self)
+        meta = self.meta
+        meta['count'] = len(matrix)
+        meta['dtype'] = RasterDataType(gdal_dtype=gdal.GDT_Float64)
+        write_file(out_filename, overwrite=True, **meta)
+
+        # Transform each block and save it
+        tasks = ((self._filename, block_win, matrix, offset)
+                 for block_win in self.block_windows(
+                     block_size=kw.get('block_size')))
+        for block_win, array in _pool_imap(_linear_transform_task, tasks,
+                                           kw.get('workers')):
+            write_file(out_filename,
+                       array=array if len(matrix) > 1 else array[:, :, 0],
+                       xoffset=block_win[0], yoffset=block_win[1])
+
+        # Pixels having a NODATA value in a source band are NaN
+        out_raster = Raster(out_filename)
+        out_raster.nodata_value = np.nan
+        return out_raster
+
+    def pca(self, n_components=None, **kw):
+        """Saves the principal components of the bands of the raster.
+
+        The raster is read twice, block by block: the first pass accumulates
+        the mean and the covariance matrix of the bands (accumulators of
+        blocks are merged, so blocks can be processed in parallel), the second
+        pass projects the centered pixels on the eigenvectors of the
+        covariance matrix (see `linear_transform`). Pixels having a NODATA
+        value in any band are ignored, and set to NaN in the output (its NODATA
+        value).
+
+        The variance explained by each component is saved in the metadata of
+        its band, in the `YMRASTER` domain.
+
+        Parameters
+        ----------
+        n_components : int, optional
+            Number of components to keep. By default, all components are kept.
+        out_filename : str
+            Path of the output image. If omitted, a default filename is chosen.
+        block_size : tuple of int (xsize, ysize), optional
+            Size of the blocks. By default, the "natural" block size of the
+            raster is used.
+        workers : int, optional
+            Number of processes to use. By default, everything is computed in
+            the current process.
+
+        Returns
+        -------
+        `Raster`
+            Output raster, of type float64, with one band per component in
+            decreasing order of variance.
+        numpy.ndarray
+            n_components*n matrix of the components (eigenvectors), n being the
+            number of bands.
+        numpy.ndarray
+            Mean of each band.
+        """
+        n_components = n_components \
+            if n_components \
+            else self._count
+        if not 1 <= n_components <= self._count:
+            raise ValueError(
+                "Number of components out of range: {}".format(n_components))
+
+        # First pass: mean and covariance of the bands
+        tasks = [(self._filename, block_win)
+                 for block_win in self.block_windows(
+                     block_size=kw.get('block_size'))]
+        acc = array_stat.CovarianceAccumulator()
+        for partial in _pool_map(_covariance_task, tasks, kw.get('workers')):
+            acc.merge(partial)
+        if acc.count < 2:
+            raise ValueError(
+                "Not enough valid pixels to compute covariance: '{:f}'".format(
+                    self))
+
+        # Eigenvectors, by decreasing eigenvalue
+        eigenvalues, eigenvectors = np.linalg.eigh(acc.covariance())
+        order = np.argsort(eigenvalues)[::-1][:n_components]
+        components = eigenvectors[:, order].T
+
+        # Second pass: project centered pixels
+        out_filename = kw['out_filename'] \
+            if kw.get('out_filename') \
+            else '{:b}_pca.tif'.format(self)
+        out_raster = self.linear_transform(
+            components, offset=-np.dot(components, acc.mean),
+            out_filename=out_filename, block_size=kw.get('block_size'),
+            workers=kw.get('workers'))
+
+        # Save explained variance of each component
+        ds = gdal.Open(out_filename, gdal.GA_Update)
+        for i, variance in enumerate(eigenvalues[order]):
+            ds.GetRasterBand(i + 1).SetMetadataItem(
+                'EXPLAINED_VARIANCE', repr(float(variance)), 'YMRASTER')
+        ds = None
+
+        return out_raster, components, acc.mean
+
+
+class OtbImage(object):
+    """Represents the output of an Orfeo Toolbox application which has been
+    executed but not written, eg. as returned by `Raster` methods called with
+    `lazy=True`.
+
+    Such an image can be given as input to other operations (its methods, or
+    `concatenate_rasters`), which are then connected to it in memory, so that
+    a chain of operations only touches the disk when its final product is
+    written (see `write`).
+
+    The upstream images and applications are kept referenced, so that the
+    pipeline stays alive as long as the image.
+    """
+
+    def __init__(self, app, count, inputs=(), key='out', name='image',
+                 date_time=None, srs=None, nodata_value=None, dtype=None):
+        """Create a new `OtbImage` instance, and execute the application (no
+        pixel is computed until the image is written).
+
+        Parameters
+        ----------
+        app : otbApplication.Application
+            OTB application whose output image is represented, with all its
+            parameters set except the output filename.
+        count : int
+            Number of bands of the output image.
+        inputs : list of `Raster` or `OtbImage`, optional
+            Input images of the application.
+        key : str, optional
+            Key of the output image parameter (default: 'out').
+        name : str, optional
+            Name of the image, used to choose default filenames.
+        date_time : datetime.datetime, optional
+            Date/time to write in the metadata of the image.
+        srs : osr.SpatialReference, optional
+            Projection to write in the metadata of the image, if the
+            application does not set it.
+        nodata_value : float, optional
+            NODATA value to write in the metadata of the image.
+        dtype : `RasterDataType`, optional
+            Data type of the image to write. By default, OTB default data type
+            is used (_float_ currently).
+        """
+        self.app = app
+        self.key = key
+        self.count = count
+        self.inputs = list(inputs)
+        self.name = name
+        self.date_time = date_time
+        self.srs = srs
+        self.nodata_value = nodata_value
+        self.dtype = dtype
+        self.app.Execute()
+
+    def __repr__(self):
+        return "{}('{}')".format(self.__class__.__name__, self.name)
+
+    def __str__(self):
+        return self.__format__()
+
+    def __format__(self, format_spec=''):
+        if format_spec and format_spec[0] in ('f', 'b'):
+            format_spec = format_spec[1:]
+        return self.name.__format__(format_spec)
+
+    def __len__(self):
+        return self.count
+
+    def write(self, out_filename):
+        """Computes the image, through the whole chain of operations, and
+        writes it.
+
+        Parameters
+        ----------
+        out_filename : str
+            Path to the output file.
+
+        Returns
+        -------
+        `Raster`
+            Output raster.
+        """
+        self.app.SetParameterString(self.key, out_filename)
+        if self.dtype:
+            self.app.SetParameterOutputImagePixelType(self.key,
+                                                      self.dtype.otb_dtype)
+        self.app.ExecuteAndWriteOutput()
+
+        out_raster = Raster(out_filename)
+        if self.date_time:
+            out_raster.date_time = self.date_time
+        if self.srs and (out_raster.srs is None
+                         or not self.srs.IsSame(out_raster.srs)):
+            out_raster.srs = self.srs
+        if self.nodata_value is not None:
+            out_raster.nodata_value = self.nodata_value
+        return out_raster
+
+    def fusion(self, pan):
+        """Sharpens the image with its corresponding panchromatic image, in
+        memory (see `Raster.fusion`).
+
+        Returns
+        -------
+        `OtbImage`
+        """
+        return OtbImage(_fusion_app(self, pan), self.count,
+                        inputs=(self, pan),
+                        name='{}_pan_sharpened'.format(self.name),
+                        date_time=self.date_time,
+                        srs=self.srs)
+
+    def radiometric_indices(self, *indices, **kw):
+        """Computes radiometric indices of the image, in memory (see
+        `Raster.radiometric_indices`).
+
+        Returns
+        -------
+        `OtbImage`
+        """
+        inames = [rindex.split(':')[1].lower() for rindex in indices]
+        return OtbImage(_radiometric_indices_app(self, indices, **kw),
+                        len(indices),
+                        inputs=(self,),
+                        name='{}_{}'.format(self.name, '_'.join(inames)),
+                        date_time=self.date_time,
+                        srs=self.srs)
+
+    def ndvi(self, red_idx, nir_idx):
+        """Computes the NDVI of the image, in memory (see `Raster.ndvi`).
+
+        Returns
+        -------
+        `OtbImage`
+        """
+        return self.radiometric_indices("Vegetation:NDVI",
+                                        red_idx=red_idx,
+                                        nir_idx=nir_idx)
+
+    def ndwi(self, nir_idx, mir_idx):
+        """Computes the NDWI of the image, in memory (see `Raster.ndwi`).
+
+        Returns
+        -------
+        `OtbImage`
+        """
+        return self.radiometric_indices("Water:NDWI",
+                                        nir_idx=nir_idx,
+                                        mir_idx=mir_idx)
+
+    def mndwi(self, green_idx, mir_idx):
+        """Computes the MNDWI of the image, in memory (see `Raster.mndwi`).
+
+        Returns
+        -------
+        `OtbImage`
+        """
+        return self.radiometric_indices("Water:MNDWI",
+                                        green_idx=green_idx,
+                                        mir_idx=mir_idx)
+
+    ndsi = mndwi
+
+    def remove_bands(self, *idxs):
+        """Removes the given bands of the image, in memory (see
+        `Raster.remove_bands`).
+
+        Returns
+        -------
+        `OtbImage`
+        """
+        return OtbImage(_extract_bands_app(
+                            self,
+                            [i for i in range(1, self.count + 1)
+                             if i not in idxs]),
+                        self.count - len(set(idxs)),
+                        inputs=(self,),
+                        name='{}_bands_removed'.format(self.name),
+                        date_time=self.date_time,
+                        srs=self.srs,
+                        dtype=self.dtype)
+
+    def append(self, *rasters):
+        """Concatenates the given images after this one, in memory (see
+        `concatenate_rasters`).
+
+        Returns
+        -------
+        `OtbImage`
+        """
+        return concatenate_rasters(self, *rasters, lazy=True)
+
+    def apply_mask(self, mask_raster, mask_value=1, set_value=None):
+        """Applies a mask to the image, in memory (see `Raster.apply_mask`).
+
+        Returns
+        -------
+        `OtbImage`
+        """
+        set_value = set_value \
+            if set_value is not None \
+            else _default_mask_value(self.dtype)
+        return _mask_image(self, mask_raster, mask_value, set_value)
+
+    # The smoothing step of a LSMS segmentation reads the image through
+    # _set_input_image(), so it can be connected in memory too. Other steps
+    # need files, which are written as usual.
+    _lsms_smoothing = Raster.__dict__['_lsms_smoothing']
+    lsms_segmentation = Raster.__dict__['lsms_segmentation']